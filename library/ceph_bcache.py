@@ -22,6 +22,15 @@ options:
     description:
       - GUID of journal partition. Defined by ceph community in /lib/udev/rules.d/95-ceph-osd.rules.
     required: True
+  workers:
+    description:
+      - How many OSDs are activated at the same time. The ids of the OSDs
+        are looked up with a single 'ceph osd dump' and only new ones are
+        created, and the types of the journal partitions set with one
+        sgdisk, before the disks are activated; /etc/fstab is rewritten
+        once at the end. The result has an C(osds) list with the id,
+        action and time of each OSD.
+    default: 4
 """
 
 EXAMPLES = """
@@ -30,10 +39,119 @@ EXAMPLES = """
     disks: "{{ ceph.disks }}"
     ssd_device: "{{ ceph.bcache_ssd_device }}"
     journal_guid: "{{ ceph.journal_guid }}
+    workers: 6
 """
 
+import json
 import os
 import re
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+FSTAB = '/etc/fstab'
+OSD_DIR = '/var/lib/ceph/osd/ceph-'
+
+
+class OSDError(Exception):
+    pass
+
+
+def run(module, cmd):
+    """ run_command which raises OSDError, as check_rc cannot be used in threads """
+    rc, out, err = module.run_command(cmd)
+    if rc != 0:
+        raise OSDError("%s failed (rc=%s): %s" % (' '.join(cmd), rc, err.strip()))
+    return out
+
+
+def bcache_uuids(count):
+    """ The filesystem uuids of /dev/bcache0..count-1, in that order """
+    # the disks have symlinks to /dev/bcacheX. we need the disks
+    # in increasing order by X.
+    uuids = [None] * count
+    for subdir, dirs, files in os.walk('/dev/disk/by-uuid/'):
+        for uuid in files:
+            path = os.path.realpath(os.path.join(subdir, uuid))
+            if 'bcache' in path:
+                bcache_index = int(re.search(r'\d+$', path).group(0))
+                if bcache_index < count:
+                    uuids[bcache_index] = uuid
+    return uuids
+
+
+def osd_ids(module, uuids):
+    """
+    uuid -> osd id. Existing OSDs come from one 'ceph osd dump', only the
+    others are created ('ceph osd create <uuid>' returns the same id each
+    time, so this gives the ids it would).
+    """
+    out = run(module, ['ceph', 'osd', 'dump', '-f', 'json'])
+    ids = dict((osd['uuid'], str(osd['osd'])) for osd in json.loads(out).get('osds', []))
+    for uuid in uuids:
+        if uuid not in ids:
+            ids[uuid] = run(module, ['ceph', 'osd', 'create', uuid]).strip()
+    return ids
+
+
+def journal_partition(ssd_device, partition_index):
+    if 'nvme' in ssd_device:
+        return '/dev/%sp%s' % (ssd_device, partition_index)
+    return '/dev/%s%s' % (ssd_device, partition_index)
+
+
+def set_journals(module, osds, ssd_device, journal_guid):
+    """
+    Sets the type of the journal partitions of osds with a single sgdisk,
+    the OSDs share the SSD and its partition table must be written once,
+    then gives them to ceph.
+    """
+    cmd = ['sgdisk']
+    for osd in osds:
+        cmd += ['-t', '%s:%s' % (osd['partition'], journal_guid)]
+    run(module, cmd + ['/dev/' + ssd_device])
+    run(module, ['chown', 'ceph:ceph'] + [journal_partition(ssd_device, osd['partition']) for osd in osds])
+
+
+def activate(module, osd, ssd_device):
+    """ Creates and activates a new OSD on its bcache device """
+    osd_id = osd['osd_id']
+    osd_dir = OSD_DIR + osd_id
+    bcache = '/dev/bcache%d' % osd['bcache']
+
+    os.makedirs(osd_dir)
+    run(module, ['mount', bcache, osd_dir])
+    run(module, ['ceph-osd', '-i', osd_id, '--mkfs', '--mkkey', '--osd-uuid', osd['uuid']])
+    os.remove(osd_dir + '/journal')
+    run(module, ['ln', '-s', journal_partition(ssd_device, osd['partition']), osd_dir + '/journal'])
+    run(module, ['ceph-osd', '-i', osd_id, '--mkjournal'])
+    run(module, ['umount', osd_dir])
+    run(module, ['ceph-disk', 'activate', bcache])
+    run(module, ['chown', '-R', 'ceph:ceph', osd_dir])
+
+
+def update_fstab(module, uuids, new_entries):
+    """
+    Rewrites /etc/fstab once: the ceph lines of disks which are gone are
+    dropped and the new ones added. Returns True if it changed.
+    """
+    with open(FSTAB) as f:
+        lines = f.readlines()
+    kept = [l for l in lines if 'ceph' not in l]
+    if kept and not kept[-1].endswith('\n'):
+        kept[-1] += '\n'
+    ceph = [l.rstrip('\n') for l in lines if 'ceph' in l]
+    ceph.extend(new_entries)
+    kept.extend('%s\n' % l for l in ceph if l.strip() and any(uuid in l for uuid in uuids))
+    if kept == lines:
+        return False
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(FSTAB), prefix='.fstab')
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(kept)
+    module.atomic_move(tmp, FSTAB)
+    return True
 
 
 def main():
@@ -43,111 +161,81 @@ def main():
             ssd_device=dict(required=True),
             ceph_init_ssd=dict(type='bool', required=True),
             journal_guid=dict(required=True),
+            workers=dict(type='int', default=4),
         ),
     )
     disks = module.params.get('disks')
     ssd_device = module.params.get('ssd_device')
     ceph_init_ssd = module.params.get('ceph_init_ssd')
     journal_guid = module.params.get('journal_guid')
-    changed = False
-    uuids_in_order = [None] * len(disks)
-
-    # the disks have symlinks to /dev/bcacheX. we need the disks
-    # in increasing order by X.
-    # Use regex to determine the bcache index
-
-    for subdir, dirs, files in os.walk('/dev/disk/by-uuid/'):
-      for uuid in files:
-        disk = os.path.join(subdir, uuid)
-        path = os.path.realpath(disk)
-
-        if 'bcache' in path:
-          bcache_index = int(re.search(r'\d+$', path).group(0))
-          uuids_in_order.pop(bcache_index)
-          uuids_in_order.insert(bcache_index,uuid)
-    cmd = ['grep', 'ceph', "/etc/fstab"]
-    rc, bcache_fstabs, err = module.run_command(cmd)
-    bcache_fstabs = bcache_fstabs.split('\n')
-
-    for i in range(0, len(uuids_in_order)):
-      # running this command with the uuid argument will return the same value each time
-      cmd = ['ceph', 'osd', 'create', uuids_in_order[i]]
-      rc, out, err = module.run_command(cmd, check_rc=True)
-      osd_id = out.rstrip()
-
-      bcache_index = i
-      partition_index = int(osd_id) % len(disks) + 1
-
-      # we configure new journal here if osd dir already exists
-      if os.path.exists('/var/lib/ceph/osd/ceph-' + osd_id) and ceph_init_ssd:
-        cmd = ['chown', 'ceph:ceph',
-               '/dev/' + ssd_device + str(partition_index)]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['sgdisk', '-t', str(partition_index) + ':' + journal_guid,
-               '/dev/' + ssd_device]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['ceph-osd', '-i', osd_id, '--mkjournal']
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-      # if first time running 'ceph osd create' against this uuid, create the osd dir
-      # and handle rest of activation. if directory exists, the device has already
-      # been activated.
-      if not os.path.exists('/var/lib/ceph/osd/ceph-' + osd_id):
-        os.makedirs('/var/lib/ceph/osd/ceph-' + osd_id)
-        changed = True
-
-        cmd = ['mount', '/dev/bcache' + str(bcache_index), '/var/lib/ceph/osd/ceph-' + osd_id]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['ceph-osd', '-i', osd_id, '--mkfs', '--mkkey', '--osd-uuid', uuids_in_order[i]]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        os.remove('/var/lib/ceph/osd/ceph-' + osd_id + '/journal')
-
-        if 'nvme' in ssd_device:
-            cmd = ['chown', 'ceph:ceph', '/dev/' + ssd_device + 'p' + str(partition_index)]
-        else:
-            cmd = ['chown', 'ceph:ceph', '/dev/' + ssd_device + str(partition_index)]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['sgdisk', '-t', str(partition_index) + ':' + journal_guid, '/dev/' + ssd_device]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        if 'nvme' in ssd_device:
-            cmd = ['ln', '-s', '/dev/' + ssd_device + 'p' + str(partition_index), '/var/lib/ceph/osd/ceph-' + osd_id + '/journal']
-        else:
-            cmd = ['ln', '-s', '/dev/' + ssd_device + str(partition_index), '/var/lib/ceph/osd/ceph-' + osd_id + '/journal']
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['ceph-osd', '-i', osd_id, '--mkjournal']
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['umount', '/var/lib/ceph/osd/ceph-' + osd_id]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['ceph-disk', 'activate', '/dev/bcache' + str(bcache_index)]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        cmd = ['chown', '-R', 'ceph:ceph', '/var/lib/ceph/osd/ceph-' + osd_id]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-        bcache_fstabs.append('UUID=%(uuid)s /var/lib/ceph/osd/ceph-%(osd_id)s'
-                             ' xfs defaults,noatime,largeio,inode64,swalloc '
-                             '0 0' % {'uuid': uuids_in_order[i],
-                                      'osd_id': osd_id})
-
+    workers = module.params.get('workers')
+
+    uuids = bcache_uuids(len(disks))
+    missing = [i for (i, uuid) in enumerate(uuids) if uuid is None]
+    if missing:
+        module.fail_json(msg="no filesystem uuid for %s" % ', '.join('/dev/bcache%d' % i for i in missing))
+
+    try:
+        ids = osd_ids(module, uuids)
+    except (OSDError, ValueError) as e:
+        module.fail_json(msg=str(e))
+
+    osds = []
+    for (bcache_index, uuid) in enumerate(uuids):
+        osd_id = ids[uuid]
+        osds.append(dict(uuid=uuid, osd_id=osd_id, bcache=bcache_index,
+                         partition=int(osd_id) % len(disks) + 1,
+                         action=None, changed=False, failed=False))
+
+    for osd in osds:
+        if not os.path.exists(OSD_DIR + osd['osd_id']):
+            # first time for this uuid: the device is activated
+            osd['action'] = 'activate'
+        elif ceph_init_ssd:
+            # we configure new journal here if osd dir already exists
+            osd['action'] = 'journal'
+
+    # the journals are all on the SSD, only what follows runs in parallel
+    journals = [osd for osd in osds if osd['action']]
+    if journals:
+        try:
+            set_journals(module, journals, ssd_device, journal_guid)
+        except OSDError as e:
+            module.fail_json(msg=str(e), osds=osds)
+
+    def do_osd(osd):
+        start = time.time()
+        try:
+            if osd['action'] == 'journal':
+                run(module, ['ceph-osd', '-i', osd['osd_id'], '--mkjournal'])
+            elif osd['action'] == 'activate':
+                activate(module, osd, ssd_device)
+                osd['changed'] = True
+        except (OSDError, OSError) as e:
+            osd.update(failed=True, msg=str(e))
+        osd['seconds'] = time.time() - start
+
+    pool = ThreadPool(max(1, min(workers, len(osds))))
+    try:
+        pool.map(do_osd, osds)
+    finally:
+        pool.close()
+        pool.join()
+
+    changed = any(osd['changed'] for osd in osds)
     if changed:
-      cmd = ['sed', '-i', '/ceph/d', '/etc/fstab']
-      rc, out, err = module.run_command(cmd, check_rc=True)
-      # add available mount items
-      with open("/etc/fstab", "a") as fstab:
-        for mount_item in filter(None, bcache_fstabs):
-          if any([ uuid in mount_item for uuid in uuids_in_order]):
-            fstab.write(mount_item + '\n') 
-
-    module.exit_json(changed=changed)
+        new_entries = ['UUID=%s %s%s xfs defaults,noatime,largeio,inode64,swalloc 0 0'
+                       % (osd['uuid'], OSD_DIR, osd['osd_id'])
+                       for osd in osds if osd['changed']]
+        try:
+            update_fstab(module, uuids, new_entries)
+        except (IOError, OSError) as e:
+            module.fail_json(msg="failed to update fstab: %s" % e, changed=changed, osds=osds)
+
+    failed = [osd['osd_id'] for osd in osds if osd['failed']]
+    if failed:
+        module.fail_json(msg="failed to set up osd %s" % ', '.join(failed), changed=changed, osds=osds)
+    module.exit_json(changed=changed, osds=osds)
 
 from ansible.module_utils.basic import *
 main()
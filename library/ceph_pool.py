@@ -10,11 +10,24 @@ description:
   There are three possible outcomes:
     1/ Create a new pool if it doesn't exist
     2/ Nothing: pool already exist
+    3/ With grow_pgs, raise pg_num and pgp_num of an existing pool which
+       has fewer PGs than its OSD count calls for, each by at most
+       pg_step at a time, waiting for all PGs to be active+clean before
+       each step
 options:
   pool_name:
     description:
-      - The pool in question: create it or ensure correct pg count
-    required: true
+      - The pool in question: create it or ensure correct pg count.
+        Required unless pools is given.
+    required: false
+  pools:
+    description:
+      - A list of pools to handle in one go, each a dict with name (or
+        pool_name) and any of osds, target_pgs_per_osd, max_pgs_per_osd
+        and pool_size, which default to the options of the module. The
+        state of all pools is read once. The result has a pools list with
+        what happened to each one.
+    required: false
   osds:
     description:
       - The osds count: pg count is calculated based on osd number
@@ -31,6 +44,20 @@ options:
     description:
       - Copies of PGs
     default: 3
+  grow_pgs:
+    description:
+      - Raise pg_num/pgp_num of existing pools to the calculated count.
+        PG counts are never lowered.
+    default: false
+  pg_step:
+    description:
+      - The most PGs added to a pool at a time.
+    default: 64
+  health_timeout:
+    description:
+      - Seconds to wait for the PGs to be active+clean before and after
+        each step. The module fails when they are not.
+    default: 1800
 """
 
 EXAMPLES = """
@@ -45,53 +72,181 @@ EXAMPLES = """
   register: pool_output
   run_once: true
   delegate_to: "{{ groups['ceph_monitors'][0] }}"
+
+# create or grow several pools, 32 PGs at a time
+- ceph_pool:
+    pools:
+      - name: volumes
+      - name: images
+        target_pgs_per_osd: 50
+    osds: "{{ groups['ceph_osds_ssd']|length * ceph.disks|length }}"
+    target_pgs_per_osd: "{{ ceph.target_pgs_per_osd }}"
+    max_pgs_per_osd: "{{ ceph.max_pgs_per_osd }}"
+    grow_pgs: yes
+    pg_step: 32
+  run_once: true
+  delegate_to: "{{ groups['ceph_monitors'][0] }}"
 """
 
+import json
 import time
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            pool_name=dict(required=True),
-            osds=dict(required=True, type='int'),
-            target_pgs_per_osd=dict(required=True, type='int'),
-            max_pgs_per_osd=dict(required=True, type='int'),
-            pool_size=dict(default=3, type='int'),
-        ),
-    )
+POOL_OPTIONS = ('osds', 'target_pgs_per_osd', 'max_pgs_per_osd', 'pool_size')
+HEALTH_INTERVAL = 10
+# a PG whose state has one of these (or a word starting with one, as in
+# backfill_wait or recovering) is still moving data; scrubbing, deep and
+# snaptrim are not
+UNSETTLED_PG_STATES = ('activating', 'backfill', 'creating', 'degraded', 'down',
+                       'incomplete', 'inconsistent', 'peered', 'peering', 'recover',
+                       'remapped', 'repair', 'stale', 'undersized', 'unknown', 'wait')
 
-    pool_name = module.params.get('pool_name')
-    osds = module.params.get('osds')
-    target_pgs_per_osd = module.params.get('target_pgs_per_osd')
-    max_pgs_per_osd = module.params.get('max_pgs_per_osd')
-    pool_size = module.params.get('pool_size')
 
+def desired_pg_count(osds, target_pgs_per_osd, max_pgs_per_osd, pool_size):
     # calculate desired pg count
     # read more about pg count here: http://ceph.com/pgcalc/
-    total_pg_count = osds * target_pgs_per_osd / pool_size
+    total_pg_count = osds * target_pgs_per_osd // pool_size
     i = 0
     desired_pg_count = 0
     # find the number which is power of 2 and larger than total_pg_count
     while desired_pg_count < total_pg_count:
         desired_pg_count = 2**i
         i += 1
-    while desired_pg_count * pool_size / osds > max_pgs_per_osd:
-        desired_pg_count = desired_pg_count / 2
-
-    # does the pool exist already?
-    cmd = ['ceph', 'osd', 'pool', 'get', pool_name, 'pg_num']
-    rc, out, err = module.run_command(cmd, check_rc=False)
-
-    # no
-    if rc != 0:
-        # create the pool
-        cmd = ['ceph', 'osd', 'pool', 'create', pool_name,
-               str(desired_pg_count), str(desired_pg_count)]
-        rc, out, err = module.run_command(cmd, check_rc=True)
-        module.exit_json(changed=True, msg="new pool was created")
-    # yes
+    while desired_pg_count * pool_size // osds > max_pgs_per_osd:
+        desired_pg_count = desired_pg_count // 2
+    return desired_pg_count
+
+
+def ceph_json(module, *args):
+    cmd = ['ceph'] + list(args) + ['-f', 'json']
+    rc, out, err = module.run_command(cmd, check_rc=True)
+    return json.loads(out)
+
+
+def current_pools(module):
+    ''' pool name -> (pg_num, pgp_num), from a single ceph call '''
+    rc, out, err = module.run_command(['ceph', 'osd', 'pool', 'ls', 'detail', '-f', 'json'])
+    if rc == 0:
+        pools = json.loads(out)
     else:
-        module.exit_json(changed=False)
+        # older releases have no 'pool ls detail'
+        pools = ceph_json(module, 'osd', 'dump')['pools']
+    return dict((p['pool_name'], (int(p['pg_num']), int(p['pg_placement_num'])))
+                for p in pools)
+
+
+def pg_clean(state_name):
+    ''' Whether a PG state is active and clean, with nothing left to move '''
+    states = state_name.split('+')
+    if 'active' not in states or 'clean' not in states:
+        return False
+    return not any(state.startswith(UNSETTLED_PG_STATES) for state in states)
+
+
+def wait_clean(module, timeout, result):
+    ''' Waits until every PG is active+clean, scrubbing or not '''
+    deadline = time.time() + timeout
+    while True:
+        pgmap = ceph_json(module, 'status')['pgmap']
+        clean = sum(s['count'] for s in pgmap.get('pgs_by_state', [])
+                    if pg_clean(s['state_name']))
+        if clean >= pgmap['num_pgs']:
+            return
+        if time.time() >= deadline:
+            module.fail_json(msg="only %s of %s PGs active+clean after %ss" %
+                             (clean, pgmap['num_pgs'], timeout), changed=True, pools=result)
+        time.sleep(HEALTH_INTERVAL)
+
+
+def grow_pool(module, pool, pg_num, pgp_num, results):
+    '''
+    Raises pg_num and pgp_num of a pool to pool['desired'] step by step.
+    pgp_num, which moves the data, never goes up by more than pg_step at
+    once, even when pg_num is already ahead of it (a run which timed out
+    between the two, or pg_num raised by hand).
+    '''
+    step = max(1, module.params['pg_step'])
+    timeout = module.params['health_timeout']
+    while pgp_num < max(pool['desired'], pg_num):
+        wait_clean(module, timeout, results)
+        if pgp_num >= pg_num:
+            pg_num = min(pool['desired'], pg_num + step)
+            module.run_command(['ceph', 'osd', 'pool', 'set', pool['name'], 'pg_num', str(pg_num)],
+                               check_rc=True)
+            pool['pg_num'] = pg_num
+            wait_clean(module, timeout, results)
+        pgp_num = min(pg_num, pgp_num + step)
+        module.run_command(['ceph', 'osd', 'pool', 'set', pool['name'], 'pgp_num', str(pgp_num)],
+                           check_rc=True)
+        pool['steps'].append(pgp_num)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            pool_name=dict(required=False),
+            pools=dict(required=False, type='list'),
+            osds=dict(required=True, type='int'),
+            target_pgs_per_osd=dict(required=True, type='int'),
+            max_pgs_per_osd=dict(required=True, type='int'),
+            pool_size=dict(default=3, type='int'),
+            grow_pgs=dict(default=False, type='bool'),
+            pg_step=dict(default=64, type='int'),
+            health_timeout=dict(default=1800, type='int'),
+        ),
+        required_one_of=[['pool_name', 'pools']],
+        mutually_exclusive=[['pool_name', 'pools']],
+        supports_check_mode=True,
+    )
+
+    entries = module.params['pools']
+    if entries is None:
+        entries = [dict(name=module.params['pool_name'])]
+
+    pools = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            module.fail_json(msg="pools must be a list of dicts, got %s" % entry)
+        name = entry.get('name', entry.get('pool_name'))
+        if not name:
+            module.fail_json(msg="every pool needs a name: %s" % entry)
+        try:
+            options = dict((o, int(entry.get(o, module.params[o]))) for o in POOL_OPTIONS)
+        except (TypeError, ValueError):
+            module.fail_json(msg="invalid pool: %s" % entry)
+        pools.append(dict(name=name, desired=desired_pg_count(**options),
+                          pg_num=None, action=None, steps=[]))
+
+    existing = current_pools(module)
+    changed = False
+    # missing pools are created first, growing the others may take a while
+    for pool in pools:
+        if pool['name'] in existing:
+            continue
+        pool['action'] = 'create'
+        changed = True
+        if not module.check_mode:
+            cmd = ['ceph', 'osd', 'pool', 'create', pool['name'],
+                   str(pool['desired']), str(pool['desired'])]
+            module.run_command(cmd, check_rc=True)
+        pool['pg_num'] = pool['desired']
+
+    for pool in pools:
+        if pool['name'] not in existing:
+            continue
+        pg_num, pgp_num = existing[pool['name']]
+        pool['pg_num'] = pg_num
+        if not module.params['grow_pgs'] or pgp_num >= pool['desired']:
+            continue
+        pool['action'] = 'grow'
+        changed = True
+        if not module.check_mode:
+            grow_pool(module, pool, pg_num, pgp_num, pools)
+
+    if module.params['pools'] is None:
+        if pools[0]['action'] == 'create':
+            module.exit_json(changed=True, msg="new pool was created")
+        module.exit_json(changed=changed, pg_num=pools[0]['pg_num'], steps=pools[0]['steps'])
+    module.exit_json(changed=changed, pools=pools)
 
 from ansible.module_utils.basic import *
 main()
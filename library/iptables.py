@@ -291,6 +291,18 @@ options:
         ACCEPT, DROP, QUEUE, RETURN. Only built in chains can have policies.
         This parameter requires the chain parameter. Ignores all other
         parameters."
+  ruleset:
+    description:
+      - "The complete rules of some chains, as a dict of tables, each a dict
+        of chains, each a list of rules or a dict with C(rules) and, for
+        built in chains, C(policy). A rule is a dict of the rule options of
+        this module (protocol, source, match, ctstate, jump, ...) or an
+        iptables rule specification string. The current rules are read
+        once with iptables-save, and every listed chain whose rules differ
+        is rewritten with a single iptables-restore --noflush, which
+        applies each table atomically. Chains which are not listed are left
+        alone. Ignores all other parameters but ip_version."
+    required: false
 '''
 
 EXAMPLES = '''
@@ -311,8 +323,44 @@ EXAMPLES = '''
 
 # Tag all outbound tcp packets with DSCP DiffServ class CS1
 - iptables: chain=OUTPUT jump=DSCP table=mangle set_dscp_mark_class=CS1 protocol=tcp
+
+# Converge the whole INPUT chain in one go
+- iptables:
+    ruleset:
+      filter:
+        INPUT:
+          - ctstate: ESTABLISHED,RELATED
+            jump: ACCEPT
+          - ctstate: NEW
+            protocol: tcp
+            match: tcp
+            destination_port: 22
+            jump: ACCEPT
+          - "-j REJECT --reject-with icmp-host-prohibited"
 '''
 
+import re
+import shlex
+import socket
+import struct
+
+BUILTIN_CHAINS = frozenset([
+    'INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING',
+])
+
+DEFAULT_REJECT = dict(
+    ipv4='icmp-port-unreachable',
+    ipv6='icmp6-port-unreachable',
+)
+
+# the spelling iptables-save uses for each option
+OPTION_ALIASES = {
+    '--protocol': '-p', '--source': '-s', '--destination': '-d',
+    '--match': '-m', '--jump': '-j', '--goto': '-g',
+    '--in-interface': '-i', '--out-interface': '-o', '--fragment': '-f',
+    '--source-port': '--sport', '--destination-port': '--dport',
+}
+
 
 def append_param(rule, param, flag, is_list):
     if is_list:
@@ -338,6 +386,16 @@ def append_jump(rule, param, jump):
         rule.extend(['-j', jump])
 
 
+# the options of a single rule, see desired_rule()
+RULE_OPTIONS = (
+    'protocol', 'source', 'destination', 'match', 'jump', 'to_destination',
+    'to_source', 'goto', 'in_interface', 'out_interface', 'fragment',
+    'set_counters', 'source_port', 'destination_port', 'to_ports',
+    'set_dscp_mark', 'set_dscp_mark_class', 'comment', 'ctstate', 'limit',
+    'limit_burst', 'uid_owner', 'reject_with', 'icmp_type',
+)
+
+
 def construct_rule(params):
     rule = []
     append_param(rule, params['protocol'], '-p', False)
@@ -417,6 +475,348 @@ def set_chain_policy(iptables_path, module, params):
     module.run_command(cmd, check_rc=True)
 
 
+# the options iptables-save prints before the matches, in its order
+BASE_OPTIONS = ('-s', '-d', '-i', '-o', '-p', '-f')
+
+# options of the protocol's match, which -p loads when they are used
+PROTOCOL_OPTIONS = frozenset([
+    '--sport', '--dport', '--tcp-flags', '--syn', '--tcp-option',
+    '--icmp-type', '--icmpv6-type',
+])
+PROTOCOL_NAMES = {
+    '1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'ipv6-icmp',
+    'icmpv6': 'ipv6-icmp',
+}
+PROTOCOL_MATCHES = {'ipv6-icmp': 'icmp6'}
+
+# the order iptables-save lists states in
+STATES = ('INVALID', 'NEW', 'RELATED', 'ESTABLISHED', 'UNTRACKED', 'SNAT', 'DNAT')
+
+# ICMPv4 type names, as iptables -p icmp -h lists them, and the type or
+# type/code iptables-save prints for them
+ICMP_TYPES = {
+    'echo-reply': '0', 'pong': '0',
+    'destination-unreachable': '3', 'network-unreachable': '3/0',
+    'host-unreachable': '3/1', 'protocol-unreachable': '3/2',
+    'port-unreachable': '3/3', 'fragmentation-needed': '3/4',
+    'source-route-failed': '3/5', 'network-unknown': '3/6',
+    'host-unknown': '3/7', 'network-prohibited': '3/9',
+    'host-prohibited': '3/10', 'tos-network-unreachable': '3/11',
+    'tos-host-unreachable': '3/12', 'communication-prohibited': '3/13',
+    'host-precedence-violation': '3/14', 'precedence-cutoff': '3/15',
+    'source-quench': '4', 'redirect': '5', 'network-redirect': '5/0',
+    'host-redirect': '5/1', 'tos-network-redirect': '5/2',
+    'tos-host-redirect': '5/3', 'echo-request': '8', 'ping': '8',
+    'router-advertisement': '9', 'router-solicitation': '10',
+    'time-exceeded': '11', 'ttl-exceeded': '11',
+    'ttl-zero-during-transit': '11/0', 'ttl-zero-during-reassembly': '11/1',
+    'parameter-problem': '12', 'ip-header-bad': '12/0',
+    'required-option-missing': '12/1', 'timestamp-request': '13',
+    'timestamp-reply': '14', 'address-mask-request': '17',
+    'address-mask-reply': '18',
+}
+
+# the limit match's rates, in units of 1/LIMIT_SCALE seconds
+LIMIT_SCALE = 10000
+LIMIT_UNITS = (
+    ('second', 'sec', 1), ('minute', 'min', 60), ('hour', 'hour', 3600),
+    ('day', 'day', 86400),
+)
+LIMIT_DEFAULT = '3/hour'
+LIMIT_BURST_DEFAULT = '5'
+
+
+def limit_rate(value):
+    ''' A --limit rate the way iptables-save prints it: 5/second is 5/sec '''
+    (rate, sep, unit) = value.partition('/')
+    seconds = 1
+    if sep:
+        for (name, short, unit_seconds) in LIMIT_UNITS:
+            if unit and name.startswith(unit.lower()):
+                seconds = unit_seconds
+                break
+        else:
+            return value
+    try:
+        period = LIMIT_SCALE * seconds // int(rate)
+    except (ValueError, ZeroDivisionError):
+        return value
+    if period <= 0:
+        return value
+    # the largest unit the rate is a whole number of, as libxt_limit's
+    # print_rate picks it
+    units = [(short, LIMIT_SCALE * unit_seconds)
+             for (name, short, unit_seconds) in reversed(LIMIT_UNITS)]
+    i = 1
+    while i < len(units):
+        mult = units[i][1]
+        if period > mult or mult // period < mult % period:
+            break
+        i += 1
+    return '%d/%s' % (units[i - 1][1] // period, units[i - 1][0])
+
+
+def port(value, protocol):
+    ''' A port, port range or service name as a number or range '''
+    ports = []
+    for item in value.split(':'):
+        if item and not item.isdigit():
+            try:
+                item = str(socket.getservbyname(item, protocol or 'tcp'))
+            except socket.error:
+                pass
+        ports.append(item)
+    return ':'.join(ports)
+
+
+def address(value, ip_version):
+    ''' An address as iptables-save prints it, with its prefix length '''
+    (addr, sep, mask) = value.partition('/')
+    if not valid_address(addr):
+        return value
+    if ip_version == 'ipv6':
+        return value if sep else value + '/128'
+    try:
+        packed = struct.unpack('!I', socket.inet_aton(addr))[0]
+        if not sep:
+            prefix = 32
+        elif mask.isdigit():
+            prefix = int(mask)
+        else:
+            bits = struct.unpack('!I', socket.inet_aton(mask))[0]
+            prefix = bin(bits).count('1')
+    except (socket.error, struct.error):
+        return value
+    if not 0 <= prefix <= 32:
+        return value
+    network = packed & (0xffffffff << (32 - prefix)) & 0xffffffff
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', network)), prefix)
+
+
+def normalize_option(match, flag, values, protocol):
+    ''' The values of an option of match as iptables-save prints them '''
+    if not values:
+        return values
+    if flag in ('--state', '--ctstate'):
+        states = set(v.upper() for v in ','.join(values).split(','))
+        return [','.join([s for s in STATES if s in states] +
+                         sorted(states - set(STATES)))]
+    if flag == '--limit':
+        return [limit_rate(values[0])]
+    if flag == '--icmp-type' and match == 'icmp':
+        return [ICMP_TYPES.get(values[0].lower(), values[0])]
+    if flag in ('--sport', '--dport'):
+        return [port(values[0], protocol)]
+    if flag in ('--sports', '--dports', '--ports'):
+        return [','.join(port(v, protocol) for v in values[0].split(','))]
+    return values
+
+
+def protocol_block(matches, protocol_match):
+    ''' The protocol's match, added to matches the first time it is used '''
+    for block in matches:
+        if block[0] == protocol_match:
+            return block
+    block = [protocol_match, []]
+    matches.append(block)
+    return block
+
+
+def rule_options(rule, ip_version):
+    '''
+    The options of a rule, as given to iptables, in the form iptables-save
+    prints them, so a desired rule compares equal to the one it became:
+    the base options (-s, -d, -i, -o, -p, -f) in iptables-save's order,
+    then each match in the order it was loaded and last the target, each
+    with its options, as (negated, option, values), in a fixed order.
+    Values are spelled out the way iptables-save does: prefix lengths, the
+    protocol's match, ICMP types as numbers, limit rates in the largest
+    whole unit, the default limit and REJECT's default.
+    '''
+    options = []
+    negate = False
+    for token in rule:
+        if token == '!':
+            negate = True
+        elif token.startswith('-') and not token.lstrip('-').isdigit():
+            options.append([negate, OPTION_ALIASES.get(token, token), []])
+            negate = False
+        elif options:
+            if negate:
+                # old style "-s ! 10.0.0.1"
+                options[-1][0] = True
+                negate = False
+            options[-1][2].append(token)
+
+    base = {}
+    for (negated, flag, values) in options:
+        if flag == '-p' and values:
+            values[0] = PROTOCOL_NAMES.get(values[0].lower(), values[0].lower())
+            base[flag] = (negated, flag, tuple(values))
+        elif flag in ('-s', '-d') and values:
+            values = [address(v, ip_version) for v in ','.join(values).split(',')]
+            base[flag] = (negated, flag, tuple(values))
+        elif flag in BASE_OPTIONS:
+            base[flag] = (negated, flag, tuple(values))
+    protocol = base.get('-p', (False, '-p', (None,)))[2][0]
+    protocol_match = PROTOCOL_MATCHES.get(protocol, protocol)
+
+    # [name, options] for each match, in order, then the target's
+    matches = []
+    target = None
+    current = None
+    for (negated, flag, values) in options:
+        if flag in BASE_OPTIONS or flag == '-c':
+            continue
+        if flag == '-m':
+            current = [values[0] if values else '', []]
+            matches.append(current)
+        elif flag in ('-j', '-g'):
+            target = current = ['%s %s' % (flag, values[0] if values else ''), []]
+        elif flag == '--syn':
+            # iptables-save spells it out
+            block = protocol_block(matches, protocol_match)
+            block[1].append((negated, '--tcp-flags', ('FIN,SYN,RST,ACK', 'SYN')))
+        elif flag in PROTOCOL_OPTIONS or current is None:
+            # loaded by -p the first time one of its options is used
+            block = protocol_block(matches, protocol_match)
+            block[1].append((negated, flag, tuple(normalize_option(block[0], flag, values, protocol))))
+        else:
+            current[1].append((negated, flag, tuple(normalize_option(current[0], flag, values, protocol))))
+
+    for block in matches:
+        if block[0] == 'limit':
+            flags = [o[1] for o in block[1]]
+            if '--limit' not in flags:
+                block[1].append((False, '--limit', (LIMIT_DEFAULT,)))
+            block[1] = [o for o in block[1]
+                        if o[1:] != ('--limit-burst', (LIMIT_BURST_DEFAULT,))]
+    if target is not None and target[0] == '-j REJECT' and not any(o[1] == '--reject-with' for o in target[1]):
+        target[1].append((False, '--reject-with', (DEFAULT_REJECT[ip_version],)))
+
+    result = [base[flag] for flag in BASE_OPTIONS if flag in base]
+    for block in matches:
+        # -m tcp with nothing to match is left out by iptables-save
+        if block[1] or block[0] != protocol_match:
+            result.append(('-m', block[0], tuple(sorted(block[1]))))
+    if target is not None:
+        result.append(('-j', target[0], tuple(sorted(target[1]))))
+    return tuple(result)
+
+
+def valid_address(value):
+    return bool(re.match(r'^[0-9a-fA-F:.]+$', value)) and any(c in value for c in '.:')
+
+
+def quote_arg(arg):
+    if arg and not re.search(r'[\s"\\]', arg):
+        return arg
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def desired_rule(rule):
+    ''' The iptables arguments of a ruleset entry '''
+    if isinstance(rule, basestring):
+        return shlex.split(rule)
+    params = dict((k, None) for k in RULE_OPTIONS)
+    params['match'] = []
+    params['ctstate'] = []
+    for (key, value) in rule.items():
+        if key not in RULE_OPTIONS:
+            raise ValueError("unsupported rule option %s" % key)
+        if key in ('match', 'ctstate'):
+            if not isinstance(value, list):
+                value = str(value).split(',')
+        elif value is not None:
+            value = str(value)
+        params[key] = value
+    return construct_rule(params)
+
+
+def parse_save(output):
+    ''' {table: {chain: (policy, [rule arguments])}} from iptables-save '''
+    tables = {}
+    chains = None
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line == 'COMMIT':
+            continue
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:], {})
+        elif line.startswith(':'):
+            name, policy = line[1:].split()[:2]
+            chains[name] = (None if policy == '-' else policy, [])
+        elif line.startswith('-A '):
+            args = shlex.split(line)
+            chains[args[1]][1].append(args[2:])
+    return tables
+
+
+def reconcile_ruleset(module, ip_version, ruleset):
+    '''
+    Compares the desired ruleset with iptables-save and rewrites the chains
+    which differ with one iptables-restore --noflush. Returns the names of
+    those chains, as table/chain, and the restore input.
+    '''
+    save_path = module.get_bin_path(BINS[ip_version] + '-save', True)
+    restore_path = module.get_bin_path(BINS[ip_version] + '-restore', True)
+
+    rc, out, err = module.run_command([save_path], check_rc=True)
+    current = parse_save(out)
+
+    changed = []
+    lines = []
+    for table in sorted(ruleset):
+        chains = ruleset[table] or {}
+        # iptables-restore wants every chain a rule may jump to declared
+        # before the rules, so the :chain lines of the table come first
+        declarations = []
+        table_lines = []
+        for chain in sorted(chains):
+            spec = chains[chain]
+            if isinstance(spec, dict):
+                policy = spec.get('policy')
+                rules = spec.get('rules') or []
+            else:
+                policy = None
+                rules = spec or []
+            builtin = chain in BUILTIN_CHAINS
+            if policy and not builtin:
+                module.fail_json(msg="only built in chains can have a policy: %s/%s" % (table, chain))
+            try:
+                rules = [desired_rule(rule) for rule in rules]
+            except ValueError as e:
+                module.fail_json(msg="%s/%s: %s" % (table, chain, e))
+
+            (current_policy, current_rules) = current.get(table, {}).get(chain, (None, None))
+            if current_rules is None and builtin:
+                current_rules = []
+            same_rules = (current_rules is not None and
+                          [rule_options(r, ip_version) for r in current_rules] ==
+                          [rule_options(r, ip_version) for r in rules])
+            if same_rules and (not policy or policy == current_policy):
+                continue
+
+            changed.append('%s/%s' % (table, chain))
+            if not builtin:
+                # creates the chain, or flushes it when it exists
+                declarations.append(':%s - [0:0]' % chain)
+            elif policy and policy != current_policy:
+                declarations.append(':%s %s [0:0]' % (chain, policy))
+            if builtin and not same_rules:
+                table_lines.append('-F %s' % chain)
+            if not same_rules or not builtin:
+                for rule in rules:
+                    table_lines.append(' '.join(['-A', chain] + [quote_arg(a) for a in rule]))
+        if declarations or table_lines:
+            lines.extend(['*%s' % table] + declarations + table_lines + ['COMMIT'])
+
+    restore = ''.join('%s\n' % line for line in lines)
+    if changed and not module.check_mode:
+        module.run_command([restore_path, '--noflush'], data=restore, check_rc=True)
+    return changed, restore
+
+
 def main():
     module = AnsibleModule(
         supports_check_mode=True,
@@ -469,12 +869,20 @@ def main():
                 default=None,
                 type='str',
                 choices=['ACCEPT', 'DROP', 'QUEUE', 'RETURN']),
+            ruleset=dict(required=False, default=None, type='dict'),
         ),
         mutually_exclusive=(
             ['set_dscp_mark', 'set_dscp_mark_class'],
             ['flush', 'policy'],
         ),
     )
+
+    if module.params['ruleset'] is not None:
+        changed, restore = reconcile_ruleset(module, module.params['ip_version'],
+                                             module.params['ruleset'])
+        module.exit_json(changed=bool(changed), chains=changed,
+                         ip_version=module.params['ip_version'], restore=restore)
+
     args = dict(
         changed=False,
         failed=False,
@@ -31,12 +31,13 @@ version_added: "1.1"
 options:
   vg:
     description:
-    - The volume group this logical volume is part of.
-    required: true
+    - The volume group this logical volume is part of. Required unless
+      C(lvs) is given.
+    required: false
   lv:
     description:
-    - The name of the logical volume.
-    required: true
+    - The name of the logical volume. Required unless C(lvs) is given.
+    required: false
   size:
     description:
     - The size of the logical volume, according to lvcreate(8) --size, by
@@ -79,6 +80,18 @@ options:
     - shrink if current size is higher than size requested
     required: false
     default: yes
+  lvs:
+    description:
+    - A list of logical volumes to manage in one go, each a dict with
+      C(vg) (or C(volume_group)), C(lv) (or C(name)) and any of C(size),
+      C(state), C(force), C(shrink), C(opts) and C(pvs), so a list such as
+      manage_disks.logical_volumes can be passed as is; other keys are
+      ignored. C(force) and C(shrink) given to the module are the defaults
+      of the entries. The state of every volume group and logical volume is read
+      once, all removals are done by a single lvremove, and the result has
+      an C(lvs) list with what happened to each one. Snapshots are not
+      supported here.
+    required: false
 notes:
   - Filesystems on top of the volume are not resized.
 '''
@@ -125,6 +138,13 @@ EXAMPLES = '''
 
 # Create a snapshot volume of the test logical volume.
 - lvol: vg=firefly lv=test snapshot=snap1 size=100m
+
+# Manage several logical volumes with a single module run
+- lvol:
+    lvs:
+      - {vg: firefly, lv: data, size: 100g, shrink: no}
+      - {vg: firefly, lv: scratch, size: 100%FREE}
+      - {vg: firefly, lv: old, state: absent, force: yes}
 '''
 
 import re
@@ -168,19 +188,216 @@ def get_lvm_version(module):
     return mkversion(m.group(1), m.group(2), m.group(3))
 
 
+# bytes per lvcreate(8) size unit
+UNIT_BYTES = dict(b=1, s=512, k=1024, m=1024 ** 2, g=1024 ** 3,
+                  t=1024 ** 4, p=1024 ** 5, e=1024 ** 6)
+
+# keys of a batch entry which are not lvol options, but may come along
+# with lists such as manage_disks.logical_volumes
+LV_ALIASES = dict(volume_group='vg', name='lv')
+LV_OPTIONS = ('vg', 'lv', 'size', 'state', 'force', 'shrink', 'opts', 'pvs')
+
+
+def lvm_report(module, tool, options, fields, json_report):
+    '''
+    The rows of a vgs or lvs report for every volume group, as dicts of the
+    given fields, with sizes in bytes.
+    '''
+    cmd = "%s %s --noheadings --nosuffix --units b -o %s" % (
+        module.get_bin_path(tool, required=True), options, ','.join(fields))
+    if json_report:
+        cmd += " --reportformat json"
+    else:
+        cmd += " --separator ';'"
+    rc, out, err = module.run_command(cmd)
+    if rc != 0:
+        module.fail_json(msg="%s failed" % tool, rc=rc, err=err)
+    if json_report:
+        rows = []
+        for report in json.loads(out)['report']:
+            for values in report.values():
+                rows.extend(values)
+        return rows
+    return [dict(zip(fields, line.strip().split(';')))
+            for line in out.splitlines() if line.strip()]
+
+
+def parse_batch_size(size):
+    '''
+    (size option, lvcreate size argument, bytes or (percent, whole, plus))
+    for a size as given to this module, or None if it is not valid.
+    '''
+    size = str(size)
+    if '%' in size:
+        (percent, whole) = size.split('%', 1)
+        try:
+            percent = int(percent.lstrip('+'))
+        except ValueError:
+            return None
+        if percent > 100 or whole not in ('VG', 'PVS', 'FREE'):
+            return None
+        return ('l', size, (percent, whole, '+' in size))
+    unit = 'm'
+    if size[-1].lower() in UNIT_BYTES:
+        unit = size[-1].lower()
+        size = size[:-1]
+    try:
+        if not size[0].isdigit():
+            raise ValueError()
+        return ('L', '%s%s' % (size, unit), int(float(size) * UNIT_BYTES[unit]))
+    except (ValueError, IndexError):
+        return None
+
+
+def plan_lv(module, spec, vgs, lvs):
+    '''
+    Returns (action, tool) for one batch entry: action is None, 'create',
+    'resize' or 'remove', and tool the lvextend/lvreduce command of a
+    resize. Fails the module for entries which cannot be applied.
+    '''
+    vg, lv = spec['vg'], spec['lv']
+    name = '%s/%s' % (vg, lv)
+    current = lvs.get((vg, lv))
+    this_vg = vgs.get(vg)
+
+    if spec['state'] == 'absent':
+        if current is None:
+            return (None, None)
+        if not spec['force']:
+            module.fail_json(msg="Sorry, no removal of logical volume %s without force=yes." % name)
+        return ('remove', None)
+
+    if this_vg is None:
+        module.fail_json(msg="Volume group %s does not exist." % vg)
+    if not spec['size']:
+        if current is None:
+            module.fail_json(msg="No size given for %s." % name)
+        return (None, None)
+    size = parse_batch_size(spec['size'])
+    if size is None:
+        module.fail_json(msg="Bad size specification of '%s' for %s" % (spec['size'], name))
+    if current is None:
+        return ('create', None)
+
+    (size_opt, size_arg, requested) = size
+    ext_size = this_vg['ext_size']
+    if size_opt == 'l':
+        (percent, whole, plus) = requested
+        requested = percent * this_vg['free' if whole == 'FREE' else 'size'] // 100
+        if plus:
+            requested += current
+    # lvcreate rounds sizes up to whole extents
+    requested = -(-requested // ext_size) * ext_size
+
+    if current < requested:
+        if size_opt == 'l' and this_vg['free'] <= 0:
+            module.fail_json(msg="Logical Volume %s could not be extended. Not enough free space left" % name)
+        return ('resize', module.get_bin_path("lvextend", required=True))
+    if spec['shrink'] and current > requested:
+        if requested == 0:
+            module.fail_json(msg="Sorry, no shrinking of %s to 0 permitted." % name)
+        if not spec['force']:
+            module.fail_json(msg="Sorry, no shrinking of %s without force=yes." % name)
+        return ('resize', '%s --force' % module.get_bin_path("lvreduce", required=True))
+    return (None, None)
+
+
+def batch_main(module, version_found, yesopt):
+    test_opt = ' --test' if module.check_mode else ''
+    # JSON reports came with LVM 2.02.158
+    json_report = version_found >= mkversion(2, 2, 158)
+
+    specs = []
+    for entry in module.params['lvs']:
+        if not isinstance(entry, dict):
+            module.fail_json(msg="lvs must be a list of dicts, got %s" % entry)
+        if entry.get('snapshot'):
+            module.fail_json(msg="Snapshots are not supported in lvs: %s" % entry)
+        spec = dict(state='present', force=module.params['force'], shrink=module.params['shrink'],
+                    size=None, opts='', pvs='')
+        for (key, value) in entry.items():
+            key = LV_ALIASES.get(key, key)
+            if key in LV_OPTIONS and value is not None:
+                spec[key] = value
+        if not spec.get('vg') or not spec.get('lv'):
+            module.fail_json(msg="Every entry of lvs needs a vg and an lv: %s" % entry)
+        if spec['state'] not in ('present', 'absent'):
+            module.fail_json(msg="state must be present or absent: %s" % entry)
+        spec['force'] = module.boolean(spec['force'])
+        spec['shrink'] = module.boolean(spec['shrink'])
+        spec['pvs'] = spec['pvs'].replace(",", " ")
+        specs.append(spec)
+
+    vgs = {}
+    for row in lvm_report(module, "vgs", "", ['vg_name', 'vg_size', 'vg_free', 'vg_extent_size'], json_report):
+        vgs[row['vg_name']] = dict(size=int(float(row['vg_size'])),
+                                   free=int(float(row['vg_free'])),
+                                   ext_size=int(float(row['vg_extent_size'])))
+    lvs = {}
+    for row in lvm_report(module, "lvs", "-a", ['vg_name', 'lv_name', 'lv_size'], json_report):
+        name = row['lv_name'].replace('[', '').replace(']', '')
+        lvs[(row['vg_name'], name)] = int(float(row['lv_size']))
+
+    # every entry is checked before anything is changed
+    plans = [(spec,) + plan_lv(module, spec, vgs, lvs) for spec in specs]
+    results = [dict(vg=spec['vg'], lv=spec['lv'], action=action, changed=False)
+               for (spec, action, tool) in plans]
+
+    removals = [r for r in results if r['action'] == 'remove']
+    if removals:
+        lvremove_cmd = module.get_bin_path("lvremove", required=True)
+        rc, _, err = module.run_command("%s %s --force %s" % (
+            lvremove_cmd, test_opt, ' '.join('%s/%s' % (r['vg'], r['lv']) for r in removals)))
+        if rc != 0:
+            module.fail_json(msg="Failed to remove logical volumes %s" % ', '.join(r['lv'] for r in removals),
+                             rc=rc, err=err, lvs=results)
+        for r in removals:
+            r['changed'] = True
+
+    for ((spec, action, tool), result) in zip(plans, results):
+        if action not in ('create', 'resize'):
+            continue
+        (size_opt, size_arg, _) = parse_batch_size(spec['size'])
+        if action == 'create':
+            lvcreate_cmd = module.get_bin_path("lvcreate", required=True)
+            cmd = "%s %s %s -n %s -%s %s %s %s %s" % (lvcreate_cmd, test_opt, yesopt, spec['lv'], size_opt,
+                                                     size_arg, spec['opts'], spec['vg'], spec['pvs'])
+            rc, _, err = module.run_command(cmd)
+            if rc != 0:
+                module.fail_json(msg="Creating logical volume '%s' failed" % spec['lv'], rc=rc, err=err, lvs=results)
+            result['changed'] = True
+            continue
+
+        cmd = "%s %s -%s %s %s/%s %s" % (tool, test_opt, size_opt, size_arg, spec['vg'], spec['lv'], spec['pvs'])
+        rc, out, err = module.run_command(cmd)
+        if "Reached maximum COW size" in out:
+            module.fail_json(msg="Unable to resize %s to %s" % (spec['lv'], size_arg), rc=rc, err=err, out=out, lvs=results)
+        elif rc == 0:
+            result['changed'] = True
+            result['msg'] = "Volume %s resized to %s" % (spec['lv'], size_arg)
+        elif "matches existing size" in err or "not larger than existing size" in err:
+            result['action'] = None
+        else:
+            module.fail_json(msg="Unable to resize %s to %s" % (spec['lv'], size_arg), rc=rc, err=err, lvs=results)
+
+    module.exit_json(changed=any(r['changed'] for r in results), lvs=results)
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            vg=dict(required=True),
-            lv=dict(required=True),
+            vg=dict(required=False),
+            lv=dict(required=False),
             size=dict(type='str'),
             opts=dict(type='str'),
             state=dict(choices=["absent", "present"], default='present'),
             force=dict(type='bool', default='no'),
             shrink=dict(type='bool', default='yes'),
             snapshot=dict(type='str', default=None),
-            pvs=dict(type='str')
+            pvs=dict(type='str'),
+            lvs=dict(type='list', default=None),
         ),
+        mutually_exclusive=[['lvs', 'vg'], ['lvs', 'lv']],
         supports_check_mode=True,
     )
 
@@ -194,6 +411,12 @@ def main():
     else:
         yesopt = ""
 
+    if module.params['lvs'] is not None:
+        batch_main(module, version_found, yesopt)
+
+    if not module.params['vg'] or not module.params['lv']:
+        module.fail_json(msg="vg and lv are required unless lvs is given")
+
     vg = module.params['vg']
     lv = module.params['lv']
     size = module.params['size']
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+# This is a virtual module that is entirely implemented as an action plugin
+# (plugins/action/push_files.py) and runs on the controller.
+
+DOCUMENTATION = '''
+module: push_files
+short_description: Copy or template several files in one task
+description:
+  - Copies every file of a directory, or a list of files, to the remote
+    host, rendering them first when C(template) is set.
+  - The checksum, mode, owner and group of every destination are read with
+    one command. The files which differ are sent with the connection's
+    transfer_files (a single sftp session with sshbb, one put_file per file
+    with other connections) and installed with one more command.
+options:
+  src:
+    description:
+      - Directory in the role's templates/ (files/ without C(template))
+        whose files are pushed, not recursively. Not used with C(files).
+    required: false
+  dest:
+    description:
+      - Directory the files of C(src) go to.
+    required: false
+  files:
+    description:
+      - Files to push instead of C(src), each a dict with C(src) and
+        C(dest), and optionally C(mode), C(owner) and C(group).
+    required: false
+  template:
+    description:
+      - Render the files as jinja2 templates, like the template module.
+    default: false
+  mode:
+    description:
+      - Mode of the files, unless set per file. Octal modes are compared
+        with the remote ones; a symbolic mode, like C(u=rw,g=r), is set
+        again on every run.
+    default: "0644"
+  owner:
+    description:
+      - Owner of the files, unless set per file.
+    required: false
+  group:
+    description:
+      - Group of the files, unless set per file.
+    required: false
+notes:
+  - Parent directories of the destinations are created when missing.
+  - Nothing is removed from the destination directories.
+'''
+
+EXAMPLES = '''
+- push_files:
+    template: yes
+    src: etc/serverspec
+    dest: /etc/serverspec/spec/localhost
+    mode: 0755
+
+- push_files:
+    template: yes
+    files:
+      - src: etc/openstack-dashboard/__init__.py
+        dest: /etc/openstack-dashboard/__init__.py
+      - src: etc/openstack-dashboard/local_settings.py
+        dest: /etc/openstack-dashboard/local_settings.py
+        group: www-data
+    mode: 0640
+'''
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#coding: utf-8 -*-
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+# This is a virtual module that is entirely implemented as an action plugin
+# (plugins/action/push_tree.py) and runs on the controller.
+
+DOCUMENTATION = '''
+module: push_tree
+short_description: Copy a directory tree as one tar stream
+description:
+  - Copies the files and symlinks under C(src) to C(dest) with the sshbb
+    connection's push_tree. The checksums of the remote files are read
+    with one command, and the files which differ are sent as a single tar
+    stream, compressed on the fly, and unpacked with a second one.
+  - Nothing is removed from C(dest). Files are owned by the user the task
+    runs as.
+  - Other connections than sshbb copy the files with the copy action.
+options:
+  src:
+    description:
+      - Directory in the role's files/.
+    required: true
+  dest:
+    description:
+      - Remote directory, created when missing.
+    required: true
+  compression:
+    description:
+      - C(zstd) when both ends have the zstd binary, gzip otherwise.
+    choices: [zstd, gzip, none]
+    default: zstd
+  mode:
+    description:
+      - Mode of the files, as chmod takes it, set on those sent and on
+        those whose mode differs. A symbolic mode is set on every file on
+        every run. Without it, files get the local mode less the umask.
+    required: false
+notes:
+  - In check mode the checksums and modes are compared, and nothing is
+    sent.
+'''
+
+EXAMPLES = '''
+- push_tree:
+    src: etc/rsyslog.d
+    dest: /etc/rsyslog.d
+    mode: 0644
+'''
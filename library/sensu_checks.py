@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014, Blue Box Group, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+DOCUMENTATION = '''
+---
+module: sensu_checks
+short_description: Manages many sensu check definitions in one go
+description:
+  - Writes the check files of sensu_check, sensu_process_check,
+    sensu_metrics_check and sensu_check_dict for a whole list of checks in
+    a single module run. Only files whose content changes are written, each
+    atomically.
+options:
+  checks:
+    description:
+      - List of checks. Each one takes the options of the module named by
+        its C(type) (C(check), C(process), C(metrics) or C(dict), default
+        C(check)), including C(state), C(plugin_dir) and C(only_on_ip).
+    required: true
+  check_dir:
+    description:
+      - Default check directory for the checks.
+    default: /etc/sensu/conf.d/checks
+  plugin_dir:
+    description:
+      - Default plugin directory for the checks.
+    default: /etc/sensu/plugins
+  batch:
+    description:
+      - Name of this set of checks. The files written for it are recorded
+        in C(.<batch>.checks) in check_dir, and the files of an earlier run
+        of the same batch which are no longer in checks are removed.
+    required: false
+'''
+
+EXAMPLES = '''
+- sensu_checks:
+    batch: common
+    checks:
+      - name: memory
+        plugin: check-mem.sh
+        args: "-w 90 -c 95"
+      - type: process
+        service: ntpd
+      - type: metrics
+        name: load-metrics
+        plugin: load-metrics.rb
+      - type: dict
+        name: check-raid
+        check: "{{ sensu_checks.common.check_raid }}"
+        state: absent
+'''
+
+import os
+import socket
+import tempfile
+
+# the options of each check type, with the defaults of its module
+CHECK_OPTIONS = dict(
+    check=dict(
+        name=None, use_sudo=False, handle=True, auto_resolve=True,
+        interval=30, occurrences=2, plugin=None, args='', prefix='',
+        env_vars='', command='', handler='default', tags=None,
+        dependencies=None, only_on_ip=None,
+    ),
+    process=dict(
+        service=None, short_service_name=None, warn_over=15, crit_over=30,
+        interval=30, occurrences=2, tags=None, dependencies=None,
+    ),
+    metrics=dict(
+        name=None, use_sudo=False, plugin=None, args='', tags=None,
+        prefix='', interval=60, only_on_ip='',
+    ),
+    dict=dict(
+        name=None, check=None, only_on_ip=None,
+    ),
+)
+REQUIRED = dict(
+    check=['name', 'plugin'],
+    process=['service'],
+    metrics=['name', 'plugin'],
+    dict=['name', 'check'],
+)
+COMMON_OPTIONS = ('type', 'state', 'plugin_dir', 'check_dir')
+
+
+def validIP(ip):
+    try:
+        socket.inet_aton(ip)
+        return True
+    except socket.error:
+        return False
+
+
+def on_ip(command, only_on_ip):
+    if only_on_ip is not None and validIP(only_on_ip):
+        command = "/etc/sensu/plugins/execute-on-ip.sh -i %s -c '%s'" % (only_on_ip, command)
+    return command
+
+
+def as_list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return [v.strip() for v in str(value).split(',')]
+
+
+def check_params(module, entry):
+    check_type = entry.get('type', 'check')
+    if check_type not in CHECK_OPTIONS:
+        module.fail_json(msg="unknown check type %s in %s" % (check_type, entry))
+    unknown = set(entry) - set(CHECK_OPTIONS[check_type]) - set(COMMON_OPTIONS)
+    if unknown:
+        module.fail_json(msg="unsupported options %s for a %s check: %s" %
+                         (', '.join(sorted(unknown)), check_type, entry))
+    missing = [o for o in REQUIRED[check_type] if entry.get(o) is None]
+    if missing:
+        module.fail_json(msg="missing %s for a %s check: %s" %
+                         (', '.join(missing), check_type, entry))
+    if entry.get('state', 'present') not in ('present', 'absent'):
+        module.fail_json(msg="state must be present or absent: %s" % entry)
+
+    params = dict(CHECK_OPTIONS[check_type])
+    params.update(entry)
+    params['type'] = check_type
+    params.setdefault('state', 'present')
+    params.setdefault('plugin_dir', module.params['plugin_dir'])
+    params.setdefault('check_dir', module.params['check_dir'])
+    for option in ('use_sudo', 'handle', 'auto_resolve'):
+        if option in params:
+            params[option] = module.boolean(params[option])
+    for option in ('tags', 'dependencies'):
+        if option in params:
+            params[option] = as_list(params[option])
+    return params
+
+
+def check_definition(p):
+    ''' (file name, check definition) for the params of one check '''
+    if p['type'] == 'process':
+        short_service_name = p['short_service_name'] or os.path.basename(p['service'])
+        command = "%s/check-procs.rb -p %s -w %s -c %s -W 1 -C 1" % (p['plugin_dir'], p['service'], p['warn_over'], p['crit_over'])
+        return '%s-service.json' % short_service_name, {
+            'checks': {
+                short_service_name: {
+                    'command': command,
+                    'standalone': True,
+                    'handlers': ['default'],
+                    'interval': int(p['interval']),
+                    'notification': "unexpected number of %s processes" % p['service'],
+                    'occurrences': int(p['occurrences']),
+                    'tags': p['tags'],
+                    'dependencies': p['dependencies']
+                }
+            }
+        }
+
+    if p['type'] == 'dict':
+        check = dict(p['check'])
+        if 'command' in check:
+            check['command'] = on_ip(check['command'], p['only_on_ip'])
+        return '%s.json' % p['name'], {'checks': {p['name']: check}}
+
+    command = p.get('command')
+    if not command:
+        command = '%s/%s %s' % (p['plugin_dir'], p['plugin'], p['args'])
+        if p.get('env_vars'):
+            command = '%s %s' % (p['env_vars'].replace(":", "=").replace(",", " "), command)
+        if p['prefix']:
+            command = '%s %s' % (p['prefix'], command)
+        if p['use_sudo']:
+            command = "sudo %s" % command
+        command = on_ip(command, p['only_on_ip'])
+
+    if p['type'] == 'metrics':
+        check = {
+            'type': 'metric',
+            'command': command,
+            'standalone': True,
+            'interval': int(p['interval']),
+            'handlers': ['metrics'],
+            'tags': p['tags'],
+        }
+    else:
+        check = {
+            'command': command,
+            'standalone': True,
+            'handlers': [p['handler']],
+            'interval': int(p['interval']),
+            'occurrences': int(p['occurrences']),
+            'auto_resolve': p['auto_resolve'],
+            'handle': p['handle'],
+            'tags': p['tags'],
+            'dependencies': p['dependencies']
+        }
+    return '%s.json' % p['name'], {'checks': {p['name']: check}}
+
+
+def read_check(path):
+    ''' The definition in path, or None if it is missing or unreadable '''
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def write_file(module, path, content):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.sensu_checks')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(content)
+    module.atomic_move(tmp, path)
+
+
+def manifest_path(check_dir, batch):
+    return os.path.join(check_dir, '.%s.checks' % batch)
+
+
+def read_manifest(path):
+    try:
+        with open(path) as fh:
+            return set(line.strip() for line in fh if line.strip())
+    except IOError:
+        return set()
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+            checks=dict(type='list', required=True),
+            check_dir=dict(default='/etc/sensu/conf.d/checks', required=False),
+            plugin_dir=dict(default='/etc/sensu/plugins', required=False),
+            batch=dict(default=None, required=False),
+        ),
+        supports_check_mode=True
+    )
+
+    # path -> definition, or None to remove it
+    desired = {}
+    for entry in module.params['checks']:
+        if not isinstance(entry, dict):
+            module.fail_json(msg="checks must be a list of dicts, got %s" % entry)
+        params = check_params(module, entry)
+        name, check = check_definition(params)
+        path = os.path.join(params['check_dir'], name)
+        if params['state'] == 'absent':
+            desired.setdefault(path, None)
+        else:
+            desired[path] = check
+
+    batch = module.params['batch']
+    if batch:
+        manifest = manifest_path(module.params['check_dir'], batch)
+        for path in read_manifest(manifest) - set(desired):
+            desired[path] = None
+
+    created = []
+    updated = []
+    removed = []
+    try:
+        for path in sorted(desired):
+            check = desired[path]
+            if check is None:
+                if os.path.isfile(path):
+                    removed.append(path)
+                    if not module.check_mode:
+                        os.remove(path)
+                continue
+            current = read_check(path)
+            if current == check:
+                continue
+            (updated if os.path.isfile(path) else created).append(path)
+            if not module.check_mode:
+                write_file(module, path, json.dumps(check, indent=4))
+
+        if batch and not module.check_mode:
+            present = sorted(p for (p, c) in desired.items() if c is not None)
+            if read_manifest(manifest) != set(present):
+                write_file(module, manifest, ''.join('%s\n' % p for p in present))
+    except (IOError, OSError) as e:
+        module.fail_json(msg="updating the checks failed: %s" % e,
+                         created=created, updated=updated, removed=removed)
+
+    module.exit_json(changed=bool(created or updated or removed),
+                     created=created, updated=updated, removed=removed)
+
+# this is magic, see lib/ansible/module_common.py
+from ansible.module_utils.basic import *
+
+main()
@@ -17,6 +17,19 @@ options:
     description:
       - Complete path to partition to be used for Swift
     required: false
+  disks:
+    description:
+      - A list of disks to prepare in one go, each a dict with C(disk) (or
+        C(dev)) or C(partition_path), and optionally C(mount_point) and
+        C(make_label), as in swift.disks. Disks which are already mounted
+        are left alone, the others are partitioned, formatted and mounted
+        by up to C(workers) at a time, and /etc/fstab is rewritten once.
+        The result has a C(disks) list with what happened to each one.
+    required: false
+  workers:
+    description:
+      - How many of the disks are prepared at the same time.
+    default: 8
 '''
 
 EXAMPLES = '''
@@ -29,11 +42,170 @@ EXAMPLES = '''
 # and mounted on /srv/node/sftmeta
 
 - swift_disk: partition_path=/dev/vgpool/sftmeta
+
+# prepare all the disks of a storage node
+- swift_disk:
+    disks: "{{ swift.disks }}"
+    workers: 12
 '''
 
 import os
 import pwd
 import grp
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+FSTAB = '/etc/fstab'
+FSTAB_OPTS = 'noatime,nodiratime,nobarrier,logbufs=8'
+
+
+class DiskError(Exception):
+    pass
+
+
+def disk_paths(dev, part_path, mount_point):
+    ''' (device path or None, partition path, mount point) of a disk '''
+    dev_path = None
+    if dev is not None:
+        dev_path = "/dev/%s" % dev
+        part_path = "/dev/%s1" % dev
+    if not mount_point:
+        # the partition name, e.g. /srv/node/sdb1
+        mount_point = "/srv/node/" + part_path.split("/")[-1]
+    return dev_path, part_path, mount_point
+
+
+def run(module, cmd):
+    ''' run_command which raises DiskError, as check_rc cannot be used in threads '''
+    rc, out, err = module.run_command(cmd)
+    if rc != 0:
+        raise DiskError("%s failed (rc=%s): %s" % (' '.join(cmd), rc, err.strip()))
+    return out
+
+
+def format_disk(module, dev_path, part_path, make_label):
+    ''' Partitions and formats a disk, returns the filesystem uuid '''
+    if dev_path is not None:
+        if make_label:
+            run(module, ['parted', '--script', dev_path, 'mklabel', 'gpt'])
+
+        # create partitions
+        run(module, ['parted', '--script', dev_path, 'mkpart', 'primary', '1', '100%'])
+
+    # make an xfs
+    run(module, ['mkfs.xfs', '-f', '-i', 'size=512', part_path])
+
+    # discover uuid
+    out = run(module, ['blkid', '-o', 'value', part_path])
+    return out.splitlines()[0]
+
+
+def mount_disk(module, mount_point):
+    if not os.path.isdir(mount_point):
+        os.makedirs(mount_point)
+
+    run(module, ['mount', mount_point])
+
+    swuid = pwd.getpwnam('swift').pw_uid
+    swgid = grp.getgrnam('swift').gr_gid
+    os.chown(mount_point, swuid, swgid)
+
+
+def update_fstab(module, entries):
+    '''
+    Rewrites /etc/fstab once with a line for each (uuid, mount point),
+    replacing the lines of those mount points which are already there.
+    '''
+    mount_points = set(m for (u, m) in entries)
+    try:
+        with open(FSTAB) as f:
+            lines = f.readlines()
+    except IOError:
+        lines = []
+
+    kept = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) > 1 and not fields[0].startswith('#') and fields[1] in mount_points:
+            continue
+        kept.append(line)
+    if kept and not kept[-1].endswith('\n'):
+        kept[-1] += '\n'
+    kept.extend("UUID=%s %s xfs %s 0 0\n" % (uuid, mount_point, FSTAB_OPTS)
+                for (uuid, mount_point) in entries)
+    if kept == lines:
+        return
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(FSTAB), prefix='.fstab')
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(kept)
+    module.atomic_move(tmp, FSTAB)
+
+
+def prepare_disks(module, disks, workers):
+    results = []
+    for entry in disks:
+        if not isinstance(entry, dict):
+            module.fail_json(msg="disks must be a list of dicts, got %s" % entry)
+        dev = entry.get('disk', entry.get('dev'))
+        if (dev is None) == (entry.get('partition_path') is None):
+            module.fail_json(msg="each disk needs either disk or partition_path: %s" % entry)
+        dev_path, part_path, mount_point = disk_paths(dev, entry.get('partition_path'),
+                                                      entry.get('mount_point'))
+        results.append(dict(dev=dev_path, partition=part_path, mount_point=mount_point,
+                            make_label=module.boolean(entry.get('make_label', False)),
+                            changed=False, failed=False))
+    if len(set(r['mount_point'] for r in results)) != len(results):
+        module.fail_json(msg="two disks have the same mount point")
+
+    pending = []
+    for r in results:
+        if r['dev'] is not None and not os.path.exists(r['dev']):
+            r.update(failed=True, msg="no such device: %s" % r['dev'])
+        elif not (os.path.exists(r['partition']) and os.path.ismount(r['mount_point'])):
+            pending.append(r)
+
+    def do_format(r):
+        start = time.time()
+        try:
+            r['uuid'] = format_disk(module, r['dev'], r['partition'], r['make_label'])
+        except (DiskError, OSError, IndexError) as e:
+            r.update(failed=True, msg=str(e))
+        r['seconds'] = time.time() - start
+
+    def do_mount(r):
+        start = time.time()
+        try:
+            mount_disk(module, r['mount_point'])
+            r['changed'] = True
+        except (DiskError, OSError, KeyError) as e:
+            r.update(failed=True, msg=str(e))
+        r['seconds'] += time.time() - start
+
+    pool = ThreadPool(max(1, min(workers, len(pending) or 1)))
+    try:
+        pool.map(do_format, pending)
+        formatted = [r for r in pending if not r['failed']]
+        if formatted:
+            try:
+                update_fstab(module, [(r['uuid'], r['mount_point']) for r in formatted])
+            except (IOError, OSError) as e:
+                module.fail_json(msg="failed to update fstab: %s" % e, disks=results)
+        pool.map(do_mount, formatted)
+    finally:
+        pool.close()
+        pool.join()
+
+    for r in results:
+        del r['make_label']
+    changed = any(r['changed'] for r in results)
+    failed = [r['partition'] for r in results if r['failed']]
+    if failed:
+        module.fail_json(msg="failed to prepare %s" % ', '.join(failed), changed=changed, disks=results)
+    module.exit_json(changed=changed, disks=results)
+
 
 def main():
     module = AnsibleModule(
@@ -42,70 +214,42 @@ def main():
             partition_path = dict(required=False, default=None),
             mount_point = dict(required=False, default=None),
             make_label = dict(required=False, default=False),
+            disks = dict(required=False, default=None, type='list'),
+            workers = dict(required=False, default=8, type='int'),
         ),
-        required_one_of = [['dev', 'partition_path']],
-        mutually_exclusive = [['dev', 'partition_path']]
+        required_one_of = [['dev', 'partition_path', 'disks']],
+        mutually_exclusive = [['dev', 'partition_path', 'disks']]
     )
 
-    dev = module.params.get('dev')
-    part_path = module.params.get('partition_path')
-
-    dev_path = None
+    if module.params.get('disks') is not None:
+        prepare_disks(module, module.params['disks'], module.params['workers'])
 
-    if not module.params.get('mount_point'):
-        mount_point = "/srv/node/"
-        if dev is not None:
-            dev_path = "/dev/%s" % dev
-            part_path = "/dev/%s1" % dev
-            mount_point += ("%s1" % dev)
-        else:
-            # Get the last part of partition path
-            mount_point += (part_path.split("/")[-1])
-    else:
-        mount_point = module.params.get('mount_point')
+    dev_path, part_path, mount_point = disk_paths(module.params.get('dev'),
+                                                  module.params.get('partition_path'),
+                                                  module.params.get('mount_point'))
 
     if dev_path is not None and not os.path.exists(dev_path):
-        module.fail_json(msg="no such device: %s" % dev)
+        module.fail_json(msg="no such device: %s" % module.params.get('dev'))
 
     if os.path.exists(part_path) and os.path.ismount(mount_point):
         module.exit_json(changed=False)
 
-    if dev_path is not None:
-        if module.params.get('make_label'):
-            cmd = ['parted', '--script', dev_path, 'mklabel', 'gpt']
-            rc, out, err = module.run_command(cmd, check_rc=True)    
-
-        # create partitions
-        cmd = ['parted', '--script', dev_path, 'mkpart', 'primary', '1', '100%']
-        rc, out, err = module.run_command(cmd, check_rc=True)
-
-    # make an xfs
-    cmd = ['mkfs.xfs', '-f', '-i', 'size=512', part_path]
-    rc, out, err = module.run_command(cmd, check_rc=True)
-
-    # discover uuid
-    cmd = ['blkid', '-o', 'value', part_path]
-    rc, out, err = module.run_command(cmd, check_rc=True)
-    fsuuid = out.splitlines()[0]
+    try:
+        fsuuid = format_disk(module, dev_path, part_path,
+                             module.boolean(module.params.get('make_label')))
+    except DiskError, e:
+        module.fail_json(msg=str(e))
 
     # write fstab
     try:
-        with open('/etc/fstab', 'a') as f:
-            f.write("UUID=%s %s xfs noatime,nodiratime,nobarrier,logbufs=8 0 0\n" % (fsuuid, mount_point))
+        update_fstab(module, [(fsuuid, mount_point)])
     except Exception, e:
         module.fail_json(msg="failed to update fstab: %s" % e)
 
-    # mount point
-    os.makedirs(mount_point)
-
-    # mount it
-    cmd = ['mount', mount_point]
-    rc, out, err = module.run_command(cmd, check_rc=True)
-
-    # chown it
-    swuid = pwd.getpwnam('swift').pw_uid
-    swgid = grp.getgrnam('swift').gr_gid
-    os.chown(mount_point, swuid, swgid)
+    try:
+        mount_disk(module, mount_point)
+    except DiskError, e:
+        module.fail_json(msg=str(e))
 
     module.exit_json(changed=True)
 
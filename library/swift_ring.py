@@ -19,6 +19,44 @@
 
 DOCUMENTATION = '''
 author: Craig Tracey
+module: swift_ring
+short_description: Manage swift ring builder files
+description:
+  - C(create), C(add) and C(rebalance) run the matching
+    swift-ring-builder command.
+  - C(sync) loads the builder once with the swift python package and makes
+    its devices match C(devices), adding new devices, setting the weight
+    and meta of existing ones and removing those no longer listed. The
+    builder is saved once, and rebalanced afterwards when C(rebalance) is
+    set and something changed or the ring file is missing. The builder is
+    created from part_power, replicas and min_part_hours if it does not
+    exist yet.
+options:
+  devices:
+    description:
+      - For C(sync), the devices of the ring, each a dict with C(zone)
+        (1 or z1), C(ip), C(port), C(device_name) and C(weight), and
+        optionally C(region) (default 1) and C(meta).
+    required: false
+  rebalance:
+    description:
+      - For C(sync), rebalance the ring and write its .ring.gz next to the
+        builder file when the devices changed or the ring file is missing.
+    default: false
+'''
+
+EXAMPLES = '''
+- swift_ring:
+    action: sync
+    ring_type: object
+    builder_file: /etc/swift/object.builder
+    part_power: 13
+    replicas: 3
+    min_part_hours: 1
+    rebalance: yes
+    devices:
+      - {zone: 1, ip: 172.16.0.111, port: 6000, device_name: sdb1, weight: 1000}
+      - {zone: 2, ip: 172.16.0.112, port: 6000, device_name: sdb1, weight: 1000}
 '''
 
 import os
@@ -58,12 +96,137 @@ def swift_ring_rebalance(module, builder_file, ring_type, force=False):
     return _run_ring_command(module, 'rebalance', builder_file, force)
 
 
+# The device sync below is shared with bin/swift-rings, which imports this
+# file; it only uses the builder it is given and raises ValueError.
+
+def ring_device(device):
+    ''' The builder form of an entry of devices '''
+    try:
+        return {
+            'region': int(device.get('region', 1)),
+            'zone': int(str(device['zone']).lstrip('z')),
+            'ip': device['ip'],
+            'port': int(device['port']),
+            'device': device['device_name'],
+            'meta': device.get('meta') or '',
+            'weight': float(device['weight']),
+        }
+    except (KeyError, ValueError, TypeError, AttributeError):
+        raise ValueError("invalid device, it needs zone, ip, port, "
+                         "device_name and weight: %s" % device)
+
+
+def desired_devices(devices):
+    ''' (ip, port, device) -> builder form, for a list of devices '''
+    desired = {}
+    for device in devices or []:
+        dev = ring_device(device)
+        key = (dev['ip'], dev['port'], dev['device'])
+        if key in desired:
+            raise ValueError("device %s:%s/%s is listed twice" % key)
+        desired[key] = dev
+    return desired
+
+
+def sync_devices(builder, desired):
+    '''
+    Makes the devices of builder match desired (see desired_devices()):
+    adds the new ones, sets the weight and meta of those which changed and
+    removes those no longer listed. Returns the added, updated and removed
+    devices, as ip:port/device.
+    '''
+    # devices removed but not rebalanced yet are still in builder.devs
+    pending = set(d['id'] for d in getattr(builder, '_remove_devs', []))
+    existing = {}
+    for dev in builder.devs:
+        if dev is not None and dev['id'] not in pending:
+            existing[(dev['ip'], dev['port'], dev['device'])] = dev
+
+    added, updated, removed = [], [], []
+    for key in sorted(set(existing) - set(desired)):
+        builder.remove_dev(existing[key]['id'])
+        removed.append("%s:%s/%s" % key)
+    for key in sorted(desired):
+        want = desired[key]
+        dev = existing.get(key)
+        name = "%s:%s/%s" % key
+        if dev is not None and (dev['region'], dev['zone']) != (want['region'], want['zone']):
+            # a device cannot move, it is removed and added again
+            builder.remove_dev(dev['id'])
+            dev = None
+        if dev is None:
+            builder.add_dev(want)
+            added.append(name)
+            continue
+        if float(dev['weight']) != want['weight']:
+            builder.set_dev_weight(dev['id'], want['weight'])
+            updated.append(name)
+        if dev.get('meta', '') != want['meta']:
+            dev['meta'] = want['meta']
+            if name not in updated:
+                updated.append(name)
+    return added, updated, removed
+
+
+def save_builder(builder, builder_file, changed, rebalance):
+    '''
+    Rebalances the builder when rebalance is set and it changed or its
+    .ring.gz is missing, writing the ring and then the builder, and saves
+    the builder alone when it changed otherwise. Returns whether it was
+    rebalanced.
+    '''
+    ring_file = os.path.splitext(builder_file)[0] + '.ring.gz'
+    rebalanced = rebalance and (changed or not os.path.exists(ring_file))
+    if rebalanced:
+        builder.rebalance()
+        builder.get_ring().save(ring_file)
+    if changed or rebalanced:
+        builder.save(builder_file)
+    return rebalanced
+
+
+def swift_ring_sync(module, builder_file, devices, part_power, replicas,
+                    min_part_hours, rebalance):
+    try:
+        from swift.common.ring import RingBuilder
+    except ImportError:
+        module.fail_json(msg="the swift python package is needed for sync")
+
+    if os.path.exists(builder_file):
+        builder = RingBuilder.load(builder_file)
+        created = False
+    else:
+        if None in (part_power, replicas, min_part_hours):
+            module.fail_json(msg="%s does not exist, part_power, replicas and "
+                                 "min_part_hours are needed to create it" %
+                             builder_file)
+        builder = RingBuilder(int(part_power), float(replicas),
+                              int(min_part_hours))
+        created = True
+
+    try:
+        desired = desired_devices(devices)
+    except ValueError as e:
+        module.fail_json(msg=str(e))
+
+    added, updated, removed = sync_devices(builder, desired)
+    changed = bool(created or added or updated or removed)
+    try:
+        rebalanced = save_builder(builder, builder_file, changed, rebalance)
+    except Exception as e:
+        module.fail_json(msg="rebalancing %s failed: %s" % (builder_file, e),
+                         added=added, updated=updated, removed=removed)
+
+    module.exit_json(changed=changed or rebalanced, rebalanced=rebalanced,
+                     added=added, updated=updated, removed=removed)
+
+
 def main():
 
     module = AnsibleModule(
         argument_spec=dict(
             action=dict(required=True,
-                        choices=['create', 'add', 'rebalance']),
+                        choices=['create', 'add', 'rebalance', 'sync']),
             ring_type=dict(required=True,
                            choices=['account', 'container', 'object']),
             builder_file=dict(required=True),
@@ -76,7 +239,9 @@ def main():
             device_name=dict(required=False),
             meta=dict(required=False),
             weight=dict(required=False),
-            force=dict(required=False, default=False)
+            force=dict(required=False, default=False),
+            devices=dict(required=False, type='list'),
+            rebalance=dict(required=False, type='bool', default=False),
         )
     )
 
@@ -104,10 +269,19 @@ def main():
                                        params['builder_file'],
                                        params['ring_type'],
                                        params['force'])
+    elif params['action'] == 'sync':
+        swift_ring_sync(module,
+                        params['builder_file'],
+                        params['devices'],
+                        params['part_power'],
+                        params['replicas'],
+                        params['min_part_hours'],
+                        params['rebalance'])
 
     module.exit_json(changed=changed)
 
 # this is magic, see lib/ansible/module_common.py
 from ansible.module_utils.basic import *
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import datetime
+import os
+import pipes
+import shutil
+import tempfile
+import time
+
+from ansible import constants as C
+from ansible.plugins.action import ActionBase
+from ansible.utils.boolean import boolean
+from ansible.utils.hashing import checksum
+from ansible.utils.unicode import to_bytes, to_str, to_unicode
+
+# Copies, or renders, several files in one task; see library/push_files.py.
+# The files which changed go through the connection's transfer_files, a
+# single sftp session with sshbb.
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    def _find_source(self, source, template):
+        subdir = 'templates' if template else 'files'
+        if self._task._role is not None:
+            return self._loader.path_dwim_relative(self._task._role._role_path, subdir, source)
+        return self._loader.path_dwim_relative(self._loader.get_basedir(), subdir, source)
+
+    def _render(self, source, task_vars):
+        ''' The same variables as the template action, then the rendered data '''
+        with open(source, 'r') as f:
+            template_data = to_unicode(f.read())
+
+        temp_vars = task_vars.copy()
+        temp_vars['template_host'] = os.uname()[1]
+        temp_vars['template_path'] = source
+        temp_vars['template_mtime'] = datetime.datetime.fromtimestamp(os.path.getmtime(source))
+        temp_vars['template_uid'] = os.stat(source).st_uid
+        temp_vars['template_fullpath'] = os.path.abspath(source)
+        temp_vars['template_run_date'] = datetime.datetime.now()
+        managed_str = C.DEFAULT_MANAGED_STR.format(
+            host=temp_vars['template_host'],
+            uid=temp_vars['template_uid'],
+            file=to_bytes(temp_vars['template_path'])
+        )
+        temp_vars['ansible_managed'] = time.strftime(managed_str, time.localtime(os.path.getmtime(source)))
+
+        searchpath = [self._loader._basedir, os.path.dirname(source)]
+        if self._task._role is not None:
+            if C.DEFAULT_ROLES_PATH:
+                searchpath[:0] = C.DEFAULT_ROLES_PATH
+            searchpath.insert(1, self._task._role._role_path)
+        self._templar.environment.loader.searchpath = searchpath
+
+        old_vars = self._templar._available_variables
+        self._templar.set_available_variables(temp_vars)
+        try:
+            return self._templar.template(template_data, preserve_trailing_newlines=True,
+                                          escape_backslashes=False, convert_data=False)
+        finally:
+            self._templar.set_available_variables(old_vars)
+
+    def _wanted_files(self, template):
+        ''' A dict(src, dest, mode, owner, group) for each file to push '''
+        args = self._task.args
+        defaults = dict((k, args.get(k)) for k in ('mode', 'owner', 'group'))
+        files = []
+        if args.get('files'):
+            for item in args['files']:
+                wanted = dict(defaults)
+                wanted.update(item)
+                wanted['src'] = self._find_source(item['src'], template)
+                files.append(wanted)
+        else:
+            src_dir = self._find_source(args['src'], template)
+            for name in sorted(os.listdir(src_dir)):
+                path = os.path.join(src_dir, name)
+                if os.path.isfile(path):
+                    wanted = dict(defaults, src=path, dest=os.path.join(args['dest'], name))
+                    files.append(wanted)
+        return files
+
+    @staticmethod
+    def _mode(wanted):
+        mode = wanted['mode'] or '0644'
+        if isinstance(mode, int):
+            # YAML reads an unquoted 0644 as an octal number
+            mode = '%o' % mode
+        return str(mode)
+
+    def _up_to_date(self, wanted, remote):
+        ''' Whether the remote (sha1, mode, owner, group) is as wanted '''
+        if len(remote) != 4 or remote[0] != wanted['checksum']:
+            return False
+        try:
+            if int(remote[1], 8) != int(self._mode(wanted), 8):
+                return False
+        except ValueError:
+            # a symbolic mode, like u=rw,g=r: install sets it again
+            return False
+        for (value, attr) in zip(remote[2:], ('owner', 'group')):
+            if wanted[attr] and str(wanted[attr]) != value:
+                return False
+        return True
+
+    def _install_command(self, tmp, changed):
+        ''' One shell command moving the sent files to their dest '''
+        lines = []
+        for (i, wanted) in enumerate(changed):
+            cmd = ['install', '-D', '-m', self._mode(wanted)]
+            if wanted['owner']:
+                cmd += ['-o', str(wanted['owner'])]
+            if wanted['group']:
+                cmd += ['-g', str(wanted['group'])]
+            cmd += [self._connection._shell.join_path(tmp, str(i)), wanted['dest']]
+            lines.append(' '.join(pipes.quote(c) for c in cmd))
+        return ' && '.join(lines)
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        args = self._task.args
+        template = boolean(args.get('template', False))
+        if not args.get('files') and (args.get('src') is None or args.get('dest') is None):
+            result['failed'] = True
+            result['msg'] = "files, or src and dest, are required"
+            return result
+
+        local_dir = tempfile.mkdtemp(prefix='push_files')
+        try:
+            try:
+                files = self._wanted_files(template)
+                for (i, wanted) in enumerate(files):
+                    if template:
+                        path = os.path.join(local_dir, str(i))
+                        with open(path, 'wb') as f:
+                            f.write(to_bytes(self._render(wanted['src'], task_vars)))
+                        wanted['src'] = path
+                    wanted['checksum'] = checksum(wanted['src'])
+            except Exception as e:
+                result['failed'] = True
+                result['msg'] = type(e).__name__ + ": " + str(e)
+                return result
+
+            # one line per dest, in order: `<sha1> <mode> <owner> <group>`,
+            # or nothing if it isn't there
+            cmd = '; '.join(
+                "{ sha1sum < %s | cut -c1-40; stat -c '%%a %%U %%G' %s; } 2>/dev/null | tr '\\n' ' '; echo" % (d, d)
+                for d in (pipes.quote(w['dest']) for w in files))
+            res = self._low_level_execute_command(cmd, sudoable=True)
+            if res['rc'] != 0:
+                result['failed'] = True
+                result['msg'] = "failed to read checksums: %s" % res['stderr']
+                return result
+            remote = res['stdout'].splitlines()
+            remote += [''] * (len(files) - len(remote))
+
+            changed = [w for (w, line) in zip(files, remote) if not self._up_to_date(w, line.split())]
+            result['changed'] = bool(changed)
+            result['files'] = [w['dest'] for w in files]
+            result['sent'] = [w['dest'] for w in changed]
+            if not changed or self._play_context.check_mode:
+                return result
+
+            remote_user = task_vars.get('ansible_ssh_user') or self._play_context.remote_user
+            tmp = self._make_tmp_path(remote_user)
+            try:
+                transfers = [('put', w['src'], self._connection._shell.join_path(tmp, str(i)))
+                             for (i, w) in enumerate(changed)]
+                if hasattr(self._connection, 'transfer_files'):
+                    dests = dict((t[2], w['dest']) for (t, w) in zip(transfers, changed))
+                    failed = [r for r in self._connection.transfer_files(transfers) if r['failed']]
+                    if failed:
+                        result['failed'] = True
+                        result['msg'] = '; '.join('%s: %s' % (dests[r['dest']], r['msg']) for r in failed)
+                        return result
+                else:
+                    for (op, src, dest) in transfers:
+                        self._transfer_file(src, dest)
+
+                self._fixup_perms2([tmp] + [dest for (op, src, dest) in transfers], remote_user, execute=False)
+                res = self._low_level_execute_command(self._install_command(tmp, changed), sudoable=True)
+                if res['rc'] != 0:
+                    result['failed'] = True
+                    result['msg'] = "failed to install files: %s" % to_str(res['stderr'])
+            finally:
+                self._remove_tmp_path(tmp)
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+        return result
@@ -0,0 +1,84 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from ansible.errors import AnsibleError
+from ansible.plugins.action import ActionBase
+from ansible.utils.unicode import to_str
+
+# Copies a directory tree as one tar stream; see library/push_tree.py. The
+# work is done by the connection's push_tree, which only sshbb has; other
+# connections get the copy action.
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        source = self._task.args.get('src', None)
+        dest = self._task.args.get('dest', None)
+        compression = self._task.args.get('compression', 'zstd')
+        mode = self._task.args.get('mode', None)
+        if source is None or dest is None:
+            result['failed'] = True
+            result['msg'] = "src and dest are required"
+            return result
+        if compression in ('none', ''):
+            compression = None
+        if isinstance(mode, int):
+            # YAML reads an unquoted 0644 as an octal number
+            mode = '%o' % mode
+        elif mode is not None:
+            mode = str(mode)
+
+        if not hasattr(self._connection, 'push_tree'):
+            # the copy action does the same, one file at a time
+            new_task = self._task.copy()
+            new_task.args = dict(src=source.rstrip('/') + '/', dest=dest.rstrip('/') + '/')
+            if mode is not None:
+                new_task.args['mode'] = mode
+            copy_action = self._shared_loader_obj.action_loader.get(
+                'copy',
+                task=new_task,
+                connection=self._connection,
+                play_context=self._play_context,
+                loader=self._loader,
+                templar=self._templar,
+                shared_loader_obj=self._shared_loader_obj,
+            )
+            result.update(copy_action.run(task_vars=task_vars))
+            return result
+
+        if self._task._role is not None:
+            source = self._loader.path_dwim_relative(self._task._role._role_path, 'files', source)
+        else:
+            source = self._loader.path_dwim_relative(self._loader.get_basedir(), 'files', source)
+
+        try:
+            result.update(self._connection.push_tree(source, dest, compression=compression, mode=mode,
+                                                       check=self._play_context.check_mode))
+        except AnsibleError as e:
+            result['failed'] = True
+            result['msg'] = to_str(e)
+        return result
@@ -0,0 +1,293 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import codecs
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.parsing.utils.jsonify import jsonify
+from ansible.plugins.cache.base import BaseCacheModule
+from ansible.utils.unicode import to_bytes
+from ansible.vars.unsafe_proxy import wrap_var
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Subsets the setup module can be asked for (gather_subset), plus 'min' for
+# the facts it always returns and 'local' for facts.d (ansible_local),
+# which come along with any of them.
+GATHERABLE = ('network', 'hardware', 'virtual', 'facter', 'ohai')
+
+HARDWARE_PREFIXES = (
+    'ansible_mem', 'ansible_swap', 'ansible_processor', 'ansible_bios_',
+    'ansible_product_',
+)
+HARDWARE_FACTS = frozenset([
+    'ansible_devices', 'ansible_mounts', 'ansible_lvm', 'ansible_form_factor',
+    'ansible_system_vendor', 'ansible_uptime_seconds',
+])
+NETWORK_FACTS = frozenset([
+    'ansible_interfaces', 'ansible_all_ipv4_addresses',
+    'ansible_all_ipv6_addresses', 'ansible_default_ipv4',
+    'ansible_default_ipv6',
+])
+
+# Per subset timeouts, e.g. "network=3600,hardware=86400"; subsets not listed
+# use fact_caching_timeout, and a timeout of 0 keeps a subset in memory only.
+SUBSET_TIMEOUTS = C.get_config(C.p, C.DEFAULTS, 'fact_caching_subset_timeouts',
+                               'ANSIBLE_CACHE_PLUGIN_SUBSET_TIMEOUTS',
+                               'network=3600,hardware=86400,virtual=86400,local=0',
+                               islist=True)
+
+
+def fact_subset(name, interfaces):
+    '''
+    Returns the subset a top level fact belongs to. interfaces are the
+    fact names of the host's interfaces (ansible_eth0, ...).
+    '''
+    if name in NETWORK_FACTS or name in interfaces:
+        return 'network'
+    if name in HARDWARE_FACTS or name.startswith(HARDWARE_PREFIXES):
+        return 'hardware'
+    if name.startswith('ansible_virtualization_'):
+        return 'virtual'
+    if name == 'ansible_local':
+        return 'local'
+    if name.startswith('facter_'):
+        return 'facter'
+    if name.startswith('ohai_'):
+        return 'ohai'
+    return 'min'
+
+
+def split_facts(facts):
+    ''' {subset: {fact: value}} '''
+    interfaces = set('ansible_%s' % i.replace('-', '_')
+                     for i in facts.get('ansible_interfaces') or [])
+    subsets = {}
+    for (name, value) in facts.items():
+        subsets.setdefault(fact_subset(name, interfaces), {})[name] = value
+    return subsets
+
+
+def wanted_subsets(gather_subset):
+    '''
+    The subsets a gather_subset value (as given to setup or a play)
+    collects, following the setup module's rules.
+    '''
+    if isinstance(gather_subset, basestring):
+        gather_subset = gather_subset.split(',')
+    include = set()
+    exclude = set()
+    for subset in gather_subset or ['all']:
+        subset = subset.strip()
+        target = exclude if subset.startswith('!') else include
+        subset = subset.lstrip('!')
+        target.update(GATHERABLE if subset == 'all' else [subset])
+    if not include:
+        include.update(GATHERABLE)
+    return (include - exclude) | set(['min', 'local'])
+
+
+class CacheModule(BaseCacheModule):
+    """
+    A JSON file cache which keeps each host's facts split by subset
+    (network, hardware, virtual, ...), each with its own timeout, in
+    <fact_caching_connection>/<host>/<subset>.json.
+
+    A subset older than its timeout is stale: it is still returned, and the
+    bb_* strategies gather it again at the start of the next play that wants
+    it (see stale_subsets()). A subset older than fact_caching_timeout has
+    expired and is no longer returned; without the 'min' subset a host has
+    no cached facts at all, so smart gathering collects them again.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        self._timeout = float(C.CACHE_PLUGIN_TIMEOUT)
+        self._subset_timeouts = {}
+        for item in SUBSET_TIMEOUTS:
+            subset, sep, timeout = item.partition('=')
+            try:
+                self._subset_timeouts[subset.strip()] = float(timeout)
+            except ValueError:
+                raise AnsibleError("invalid fact_caching_subset_timeouts entry: %s" % item)
+
+        self._cache = {}
+        # host -> {subset: {fact: value}}, see _remember()
+        self._known = {}
+        self._cache_dir = os.path.expanduser(os.path.expandvars(C.CACHE_PLUGIN_CONNECTION or '~/.ansible/bb_facts'))
+
+        if not os.path.exists(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir)
+            except (OSError, IOError) as e:
+                display.warning("error while trying to create cache dir %s : %s" % (self._cache_dir, to_bytes(e)))
+
+    def _subset_timeout(self, subset):
+        return self._subset_timeouts.get(subset, self._timeout)
+
+    def _subset_path(self, key, subset):
+        return os.path.join(self._cache_dir, key, subset + '.json')
+
+    def _subset_age(self, key, subset):
+        try:
+            return time.time() - os.stat(self._subset_path(key, subset)).st_mtime
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                display.warning("error while trying to stat %s : %s" % (self._subset_path(key, subset), to_bytes(e)))
+            return None
+
+    def _stored_subsets(self, key):
+        try:
+            names = os.listdir(os.path.join(self._cache_dir, key))
+        except (OSError, IOError):
+            return []
+        return [n[:-len('.json')] for n in names if n.endswith('.json')]
+
+    def _load(self, key):
+        subsets = {}
+        for subset in self._stored_subsets(key):
+            age = self._subset_age(key, subset)
+            if age is None or age > self._timeout:
+                continue
+            path = self._subset_path(key, subset)
+            try:
+                with codecs.open(path, 'r', encoding='utf-8') as f:
+                    subsets[subset] = json.load(f)
+            except ValueError as e:
+                display.warning("error while trying to read %s : %s. Most likely a corrupt file, so erasing it." % (path, to_bytes(e)))
+                os.remove(path)
+            except (OSError, IOError) as e:
+                display.warning("error while trying to read %s : %s" % (path, to_bytes(e)))
+        return subsets
+
+    def _write(self, key, subset, facts):
+        host_dir = os.path.join(self._cache_dir, key)
+        try:
+            if not os.path.isdir(host_dir):
+                os.makedirs(host_dir)
+            fd, tmp = tempfile.mkstemp(dir=host_dir, prefix='.' + subset)
+            with os.fdopen(fd, 'w') as f:
+                f.write(to_bytes(jsonify(facts)))
+            os.rename(tmp, self._subset_path(key, subset))
+        except (OSError, IOError) as e:
+            display.warning("error while trying to write %s : %s" % (self._subset_path(key, subset), to_bytes(e)))
+
+    def get(self, key):
+        if key in self._cache:
+            return self._cache[key]
+        if key == "":
+            raise KeyError
+
+        subsets = self._load(key)
+        if 'min' not in subsets:
+            raise KeyError
+
+        value = {}
+        for facts in subsets.values():
+            value.update(facts)
+        self._cache[key] = value
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        '''
+        Records the facts as they are now, so set() can tell the subsets it
+        was given anew from those carried over by FactCache.update(). The
+        values are wrapped first, as VariableManager.get_vars() does it in
+        place and would otherwise swap every string for a new object.
+        '''
+        wrap_var(value)
+        self._known[key] = split_facts(value)
+
+    def set(self, key, value):
+
+        self._cache[key] = value
+
+        known = self._known.get(key, {})
+        for (subset, facts) in split_facts(value).items():
+            old = known.get(subset)
+            if (old is not None and set(old) == set(facts) and
+                    all(old[name] is facts[name] for name in facts)):
+                # carried over from what we had, not gathered again
+                continue
+            if self._subset_timeout(subset) > 0:
+                self._write(key, subset, facts)
+        self._remember(key, value)
+
+    def stale_subsets(self, key, gather_subset=None):
+        '''
+        Returns the subsets of the host's facts which are past their timeout,
+        or were never gathered, out of those gather_subset collects, for the
+        strategies to refresh.
+        '''
+        wanted = wanted_subsets(gather_subset)
+        stale = set()
+        for subset in set(self._stored_subsets(key)) | set(['min', 'network', 'hardware', 'virtual']):
+            if subset not in wanted or self._subset_timeout(subset) <= 0:
+                continue
+            age = self._subset_age(key, subset)
+            if age is None or age >= self._subset_timeout(subset):
+                stale.add(subset)
+        return stale
+
+    def gather_subset_arg(self, subsets):
+        ''' The setup gather_subset which collects the given subsets. '''
+        return ','.join(sorted(s for s in subsets if s in GATHERABLE)) or '!all'
+
+    def keys(self):
+        keys = set(self._cache)
+        for k in os.listdir(self._cache_dir):
+            if k.startswith('.'):
+                continue
+            age = self._subset_age(k, 'min')
+            if age is not None and age <= self._timeout:
+                keys.add(k)
+        return list(keys)
+
+    def contains(self, key):
+        if key in self._cache:
+            return True
+        age = self._subset_age(key, 'min')
+        return age is not None and age <= self._timeout
+
+    def delete(self, key):
+        self._cache.pop(key, None)
+        self._known.pop(key, None)
+        shutil.rmtree(os.path.join(self._cache_dir, key), ignore_errors=True)
+
+    def flush(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def copy(self):
+        ret = dict()
+        for key in self.keys():
+            ret[key] = self.get(key)
+        return ret
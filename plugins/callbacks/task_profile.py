@@ -0,0 +1,345 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Records per-host, per-task timings and writes them out at the end of the
+# run, when task_profile_dir (ANSIBLE_TASK_PROFILE_DIR) is set:
+#
+#   <dir>/<timestamp>-trace.jsonl  one record per (play, role, task, host)
+#   <dir>/<timestamp>-tasks.csv    p50/p95/max per task across hosts
+#
+# Each record separates the time a host spent waiting to be given the task
+# ("queue": from the host finishing its previous task, or the play starting,
+# until a worker took the task) from the time the task took to run ("exec":
+# from the worker taking it until its result came back). The per-host start
+# and worker come from the v2_runner_on_start and v2_runner_on_queued
+# callbacks sent by the bb_* strategies; with other strategies the task
+# start is used instead.
+#
+# bin/chrome-trace turns the trace into a Chrome Trace Event file.
+#
+# When task_profile_db (ANSIBLE_TASK_PROFILE_DB) is set, the p50/p95/max
+# exec time of every task, and of every role (a role's time on a host being
+# the exec time of all its tasks there), is also added to that SQLite file,
+# keyed by playbook, URSULA_ENV, git revision and the hosts the play ran
+# against. bin/profile-report compares the latest run with the ones before
+# it. Either setting enables the callback.
+#
+# If the connection plugin keeps per-host connection health (sshbb's retry
+# and circuit breaker counters), hosts which had connection trouble during
+# the run are listed at the end, and the counters are written to
+# <dir>/<timestamp>-connections.json.
+
+import csv
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import time
+
+from ansible.constants import DEFAULTS, DEFAULT_TRANSPORT, get_config, load_config_file
+from ansible.plugins import connection_loader
+from ansible.plugins.callback import CallbackBase
+
+
+def percentile(values, pct):
+    ''' nearest-rank percentile of a non-empty list '''
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, rank)]
+
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    playbook TEXT NOT NULL,
+    env TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    failed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    kind TEXT NOT NULL,
+    play TEXT NOT NULL,
+    host_group TEXT NOT NULL,
+    role TEXT NOT NULL,
+    task TEXT NOT NULL,
+    hosts INTEGER NOT NULL,
+    p50 REAL NOT NULL,
+    p95 REAL NOT NULL,
+    max REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_playbook_env ON runs (playbook, env, id);
+CREATE INDEX IF NOT EXISTS timings_run ON timings (run_id);
+'''
+
+
+def git_revision(path):
+    '''
+    Returns (top level, HEAD) of the git checkout containing path, or
+    (None, '') when it isn't in one.
+    '''
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', '--show-toplevel', 'HEAD'],
+            cwd=path, stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None, ''
+    lines = out.decode('utf-8').split()
+    if len(lines) != 2:
+        return None, ''
+    return lines[0], lines[1]
+
+
+class CallbackModule(CallbackBase):
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        p, cfg_path = load_config_file()
+        self.profile_dir = get_config(p, DEFAULTS, 'task_profile_dir',
+                                      'ANSIBLE_TASK_PROFILE_DIR', None,
+                                      ispath=True)
+        self.profile_db = get_config(p, DEFAULTS, 'task_profile_db',
+                                     'ANSIBLE_TASK_PROFILE_DB', None,
+                                     ispath=True)
+        self.disabled = not (self.profile_dir or self.profile_db)
+        if self.profile_dir and not os.path.isdir(self.profile_dir):
+            # created up front, as sshbb traces connections into it as well
+            os.makedirs(self.profile_dir)
+
+        self.playbook = None
+        self.run_start = time.time()
+        self.play = None
+        self.play_start = None
+        # play name -> hosts pattern it ran against
+        self.play_hosts = {}
+        # task uuid -> (play, role, name, action) as seen on the original task
+        self.tasks = {}
+        # task uuid -> time of v2_playbook_on_task_start
+        self.task_start = {}
+        # (task uuid, host) -> time the strategy handed the task over
+        self.started = {}
+        # (task uuid, host) -> (time, worker slot, pid) once a worker has it
+        self.queued = {}
+        # host -> time the host finished its previous task
+        self.ready = {}
+        self.records = []
+
+    def _remember_task(self, task):
+        role = task._role.get_name() if task._role else ''
+        self.tasks[str(task._uuid)] = (self.play, role, task.get_name(),
+                                  task.action)
+
+    def v2_playbook_on_start(self, playbook):
+        self.playbook = playbook._file_name
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name()
+        self.play_start = time.time()
+        hosts = play.hosts
+        if isinstance(hosts, list):
+            hosts = ','.join(hosts)
+        self.play_hosts[self.play] = hosts or ''
+        self.ready = {}
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._remember_task(task)
+        self.task_start.setdefault(str(task._uuid), time.time())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._remember_task(task)
+        self.task_start.setdefault(str(task._uuid), time.time())
+
+    def v2_runner_on_start(self, host, task):
+        if str(task._uuid) not in self.tasks:
+            self._remember_task(task)
+        self.started[(str(task._uuid), host.get_name())] = time.time()
+
+    def v2_runner_on_queued(self, host, task, worker, pid):
+        self.queued[(str(task._uuid), host.get_name())] = (time.time(),
+                                                           worker, pid)
+
+    def _record(self, result, status):
+        end = time.time()
+        host = result._host.get_name()
+        uuid = str(result._task._uuid)
+        play, role, name, action = self.tasks.get(
+            uuid, (self.play, '', result._task.get_name(), result._task.action))
+
+        start = self.started.pop((uuid, host), None)
+        if start is None:
+            start = self.task_start.get(uuid, end)
+        queued, worker, pid = self.queued.pop((uuid, host),
+                                              (start, None, None))
+        ready = self.ready.get(host, self.play_start or start)
+        ready = min(ready, start)
+        self.ready[host] = end
+
+        self.records.append({
+            'play': play, 'role': role, 'task': name, 'task_uuid': uuid,
+            'action': action, 'host': host, 'status': status,
+            'ready': ready, 'start': start, 'queued': queued, 'end': end,
+            'worker': worker, 'pid': pid,
+            'queue': queued - ready, 'exec': end - queued,
+        })
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, 'unreachable')
+
+    def _summarize(self):
+        tasks = {}
+        order = []
+        for r in self.records:
+            key = (r['play'], r['role'], r['task_uuid'])
+            if key not in tasks:
+                tasks[key] = []
+                order.append(key)
+            tasks[key].append(r)
+
+        rows = []
+        for key in order:
+            recs = tasks[key]
+            execs = [r['exec'] for r in recs]
+            queues = [r['queue'] for r in recs]
+            slowest = max(recs, key=lambda r: r['exec'])
+            rows.append([
+                key[0], key[1], recs[0]['task'], key[2], len(recs),
+                '%.3f' % percentile(execs, 50), '%.3f' % percentile(execs, 95),
+                '%.3f' % max(execs), slowest['host'],
+                '%.3f' % percentile(queues, 50), '%.3f' % percentile(queues, 95),
+                '%.3f' % max(queues),
+                '%.3f' % (max(r['end'] for r in recs) -
+                          min(r['queued'] for r in recs)),
+            ])
+        return rows
+
+    def _history_rows(self):
+        '''
+        Returns (kind, play, host group, role, task, hosts, p50, p95, max)
+        for every task and role, keyed by name, as task uuids differ from
+        one run to the next. Tasks sharing a name are pooled.
+        '''
+        groups = {}
+        order = []
+
+        def add(key, host, secs):
+            if key not in groups:
+                groups[key] = {}
+                order.append(key)
+            per_host = groups[key]
+            per_host[host] = per_host.get(host, 0.0) + secs
+
+        for r in self.records:
+            play_hosts = self.play_hosts.get(r['play'], '')
+            add(('task', r['play'], play_hosts, r['role'], r['task']),
+                r['host'] + '\0' + r['task_uuid'], r['exec'])
+            if r['role']:
+                add(('role', r['play'], play_hosts, r['role'], ''),
+                    r['host'], r['exec'])
+
+        rows = []
+        for key in order:
+            execs = list(groups[key].values())
+            rows.append(key + (len(execs), percentile(execs, 50),
+                               percentile(execs, 95), max(execs)))
+        return rows
+
+    def _store_history(self, stats):
+        playbook = self.playbook or ''
+        toplevel, revision = git_revision(
+            os.path.dirname(os.path.abspath(playbook or '.')))
+        if toplevel and playbook:
+            playbook = os.path.relpath(os.path.abspath(playbook), toplevel)
+        env = os.path.normpath(os.environ.get('URSULA_ENV', '') or '.')
+        if env == '.':
+            env = ''
+        failed = sum(1 for h in stats.processed
+                     if stats.failures.get(h) or stats.dark.get(h))
+
+        conn = sqlite3.connect(self.profile_db, timeout=30)
+        try:
+            with conn:
+                conn.executescript(HISTORY_SCHEMA)
+                cur = conn.execute(
+                    'INSERT INTO runs (started, finished, playbook, env, '
+                    'revision, failed) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.run_start, time.time(), playbook, env, revision,
+                     failed))
+                run_id = cur.lastrowid
+                conn.executemany(
+                    'INSERT INTO timings (run_id, kind, play, host_group, '
+                    'role, task, hosts, p50, p95, max) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(run_id,) + row for row in self._history_rows()])
+        finally:
+            conn.close()
+
+        self._display.display("Task timings added to %s as run %d"
+                              % (self.profile_db, run_id))
+
+    def _connection_health(self):
+        conn_cls = connection_loader.get(DEFAULT_TRANSPORT, class_only=True)
+        health_counters = getattr(conn_cls, 'health_counters', None)
+        if health_counters is None:
+            return {}
+        return health_counters(since=self.run_start)
+
+    def v2_playbook_on_stats(self, stats):
+        if self.profile_db:
+            self._store_history(stats)
+
+        health = self._connection_health()
+        for host in sorted(health):
+            counters = health[host]
+            self._display.display("Connection health of %s: circuit %s, %s" % (
+                host, counters['state'], ', '.join(
+                    '%s=%d' % (k, v) for (k, v) in sorted(counters.items())
+                    if k != 'state')))
+
+        if not self.profile_dir:
+            return
+
+        prefix = os.path.join(self.profile_dir,
+                              time.strftime('%Y%m%d-%H%M%S'))
+
+        with open(prefix + '-trace.jsonl', 'w') as fh:
+            for r in self.records:
+                fh.write(json.dumps(r, sort_keys=True) + '\n')
+
+        with open(prefix + '-tasks.csv', 'wb') as fh:
+            writer = csv.writer(fh)
+            writer.writerow([
+                'play', 'role', 'task', 'task_uuid', 'hosts',
+                'exec_p50', 'exec_p95', 'exec_max', 'slowest_host',
+                'queue_p50', 'queue_p95', 'queue_max', 'wall',
+            ])
+            writer.writerows(self._summarize())
+
+        if health:
+            with open(prefix + '-connections.json', 'w') as fh:
+                json.dump(health, fh, indent=2, sort_keys=True)
+
+        self._display.display("Task profile written to %s-{trace.jsonl,tasks.csv}"
+                              % prefix)
@@ -19,12 +19,22 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import atexit
+import errno
 import fcntl
+import hashlib
+import json
 import os
 import pipes
 import pty
+import random
+import re
 import select
+import stat
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
 
 from ansible import constants as C
@@ -42,6 +52,274 @@ except ImportError:
 
 SSHPASS_AVAILABLE = None
 
+# Largest read from ssh's stdout or stderr at a time; a pipe rarely holds
+# more than this.
+READ_SIZE = 65536
+
+# When set, every ssh/scp/sftp invocation is appended to connections.jsonl
+# here, for bin/chrome-trace (see also the task_profile callback).
+TRACE_DIR = C.get_config(C.p, C.DEFAULTS, 'task_profile_dir',
+                         'ANSIBLE_TASK_PROFILE_DIR', None, ispath=True)
+
+# Whether the bb_* strategies start ControlMasters for every host at the
+# start of a play (see Connection.prewarm_masters).
+PREWARM_MASTERS = C.get_config(C.p, 'ssh_connection', 'control_master_prewarm',
+                               'ANSIBLE_SSH_CONTROL_MASTER_PREWARM', True,
+                               boolean=True)
+
+STALE_CONTROL_SOCKET = re.compile(r'Control socket connect\((.+)\): Connection refused')
+
+# How push_tree compresses its tar stream, and how the remote end undoes it.
+COMPRESSORS = dict(zstd=['zstd', '-q', '-c'], gzip=['gzip', '-6', '-n', '-c'])
+DECOMPRESSORS = dict(zstd=['zstd', '-dcq'], gzip=['gzip', '-dc'])
+
+# `ssh -O exit` commands for the masters prewarm_masters() found or started,
+# run when ansible exits; only the process which prewarmed them stops them.
+_MASTERS = {}
+_MASTERS_PID = None
+
+# Connection health, shared by the worker processes through one small file
+# per host (see HostHealth). After CIRCUIT_THRESHOLD ssh failures (255)
+# within CIRCUIT_WINDOW seconds, exec_command fails at once instead of
+# retrying, and lets a single attempt through every CIRCUIT_COOLDOWN
+# seconds to see whether the host is back.
+HEALTH_DIR = C.get_config(C.p, 'ssh_connection', 'health_dir',
+                          'ANSIBLE_SSH_HEALTH_DIR', '~/.ansible/sshbb-health',
+                          ispath=True)
+CIRCUIT_THRESHOLD = C.get_config(C.p, 'ssh_connection', 'circuit_threshold',
+                                 'ANSIBLE_SSH_CIRCUIT_THRESHOLD', 3, integer=True)
+CIRCUIT_WINDOW = C.get_config(C.p, 'ssh_connection', 'circuit_window',
+                              'ANSIBLE_SSH_CIRCUIT_WINDOW', 60, floating=True)
+CIRCUIT_COOLDOWN = C.get_config(C.p, 'ssh_connection', 'circuit_cooldown',
+                                'ANSIBLE_SSH_CIRCUIT_COOLDOWN', 30, floating=True)
+# longest pause between two retries; the pause is drawn at random from
+# [0, min(RETRY_MAX_PAUSE, 2 ** attempt)] so retrying workers spread out
+RETRY_MAX_PAUSE = 30
+# how long events are kept for health_counters()
+HEALTH_EVENTS_TTL = 86400
+
+
+def _run_parallel(commands, limit, timeout):
+    '''
+    Runs the commands, at most limit at a time, killing any still running
+    after timeout seconds. Returns (returncode, stderr) for each command.
+    stdout is discarded, and stderr goes to a file rather than a pipe, as a
+    backgrounded ControlMaster keeps it open.
+    '''
+    results = [None] * len(commands)
+    waiting = list(enumerate(commands))
+    running = []
+    devnull = open(os.devnull, 'r+')
+    try:
+        while waiting or running:
+            while waiting and len(running) < limit:
+                i, cmd = waiting.pop(0)
+                err = tempfile.TemporaryFile()
+                try:
+                    p = subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=err)
+                except OSError as e:
+                    err.close()
+                    results[i] = (None, str(e))
+                    continue
+                running.append((i, p, err, time.time() + timeout))
+
+            still_running = []
+            for (i, p, err, deadline) in running:
+                if p.poll() is None and time.time() > deadline:
+                    Connection._terminate_process(p)
+                    p.wait()
+                if p.poll() is None:
+                    still_running.append((i, p, err, deadline))
+                    continue
+                err.seek(0)
+                results[i] = (p.returncode, err.read())
+                err.close()
+            if len(still_running) == len(running) and running:
+                time.sleep(0.02)
+            running = still_running
+    finally:
+        devnull.close()
+    return results
+
+
+def _which(binary):
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path, binary), os.X_OK):
+            return True
+    return False
+
+
+class _CountingReader(object):
+    ''' A file object's read() and close(), counting the bytes read '''
+
+    def __init__(self, fh):
+        self._fh = fh
+        self.count = 0
+
+    def read(self, size):
+        data = self._fh.read(size)
+        self.count += len(data)
+        return data
+
+    def close(self):
+        self._fh.close()
+
+
+def _sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HostHealth(object):
+    '''
+    The circuit breaker state of one host: recent ssh failures, whether the
+    circuit is open and until when, and a log of events (retries, failures,
+    fast failures, probes, opens and closes) for health_counters(). Each
+    method reads, updates and writes the host's file under an exclusive
+    lock, so the worker processes see each other's updates.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        name = re.sub(r'[^A-Za-z0-9._:-]', '_', host or 'unknown')
+        self.path = os.path.join(HEALTH_DIR, name + '.json')
+
+    def _update(self, func):
+        makedirs_safe(HEALTH_DIR, 0o700)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = b''
+            while True:
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                state = json.loads(data) if data else {}
+            except ValueError:
+                state = {}
+            state.setdefault('failures', [])
+            state.setdefault('open_until', 0)
+            state.setdefault('events', [])
+
+            now = time.time()
+            result = func(state, now)
+
+            state['failures'] = [t for t in state['failures'] if t > now - CIRCUIT_WINDOW]
+            state['events'] = [e for e in state['events'] if e[0] > now - HEALTH_EVENTS_TTL]
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(state))
+            return result
+        finally:
+            os.close(fd)
+
+    def _quiet(self):
+        # nothing to read or write for a host that has never failed
+        return not os.path.exists(self.path)
+
+    def allow(self):
+        '''
+        Returns 'closed' if commands may run as usual, 'probe' if this one
+        is the single attempt let through an open circuit, 'wait' if another
+        process is probing the host right now, or None if the circuit is
+        open and the command should fail at once.
+        '''
+        if self._quiet():
+            return 'closed'
+
+        def check(state, now):
+            if not state['open_until']:
+                return 'closed'
+            if now < state['open_until']:
+                if state.get('probing'):
+                    return 'wait'
+                state['events'].append([now, 'fast_fail'])
+                return None
+            # keep the circuit open for everyone else while we probe
+            state['open_until'] = now + CIRCUIT_COOLDOWN
+            state['probing'] = True
+            state['events'].append([now, 'probe'])
+            return 'probe'
+        return self._update(check)
+
+    def failure(self, probing):
+        '''
+        Records an ssh failure; returns True if the circuit is now open.
+        '''
+        def fail(state, now):
+            state['probing'] = False
+            state['failures'].append(now)
+            state['events'].append([now, 'failure'])
+            recent = [t for t in state['failures'] if t > now - CIRCUIT_WINDOW]
+            if probing or len(recent) >= CIRCUIT_THRESHOLD:
+                if not state['open_until'] or probing:
+                    state['events'].append([now, 'open'])
+                state['open_until'] = now + CIRCUIT_COOLDOWN
+                return True
+            return False
+        return self._update(fail)
+
+    def retry(self):
+        if self._quiet():
+            return
+        self._update(lambda state, now: state['events'].append([now, 'retry']))
+
+    def success(self):
+        if self._quiet():
+            return
+
+        def close(state, now):
+            if state['open_until']:
+                state['events'].append([now, 'close'])
+            state['open_until'] = 0
+            state['probing'] = False
+            state['failures'] = []
+        self._update(close)
+
+
+def health_counters(since=0):
+    '''
+    Returns {host: dict(state, <event>=count, ...)} for every host with
+    connection events after since, for callbacks to report.
+    '''
+    counters = {}
+    if not os.path.isdir(HEALTH_DIR):
+        return counters
+    now = time.time()
+    for name in sorted(os.listdir(HEALTH_DIR)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(HEALTH_DIR, name)) as fh:
+                state = json.load(fh)
+        except (IOError, OSError, ValueError):
+            continue
+        events = [e for e in state.get('events', []) if e[0] >= since]
+        if not events:
+            continue
+        host = counters[name[:-len('.json')]] = dict(
+            state='open' if state.get('open_until', 0) > now else 'closed')
+        for (ts, kind) in events:
+            host[kind] = host.get(kind, 0) + 1
+    return counters
+
+
+def stop_masters():
+    '''
+    Stops the ControlMasters prewarmed by this process.
+    '''
+    if _MASTERS_PID != os.getpid() or not _MASTERS:
+        return
+    commands = list(_MASTERS.values())
+    _MASTERS.clear()
+    display.debug('stopping %d ssh ControlMasters' % len(commands))
+    _run_parallel(commands, 25, 10)
+
 
 class Connection(ConnectionBase):
     ''' ssh based connections '''
@@ -54,6 +332,8 @@ class Connection(ConnectionBase):
         super(Connection, self).__init__(*args, **kwargs)
 
         self.host = self._play_context.remote_addr
+        self._master_checked = False
+        self._persistent = False
 
     # The connection is created by running ssh/scp/sftp from the exec_command,
     # put_file, and fetch_file methods, so we don't need to do any connection
@@ -234,6 +514,144 @@ class Connection(ConnectionBase):
 
         return self._command
 
+    def _control_command(self, op):
+        '''
+        Returns the `ssh -O <op>` command for this host's ControlMaster, or
+        None if there is no master to control: ControlPersist isn't set, or
+        a password is used, which would need sshpass.
+        '''
+        if self._play_context.password:
+            return None
+        self._persistent = False
+        cmd = self._build_command('ssh', '-O', op, self.host)
+        if not self._persistent:
+            return None
+        return list(map(to_bytes, cmd))
+
+    @staticmethod
+    def _master_alive(returncode, stderr):
+        '''
+        Interprets the result of `ssh -O check`, removing the socket left
+        behind by a master which is gone; otherwise ssh would refuse to start
+        a new master on that path, and every connection would pay for a full
+        handshake until the socket was cleaned up.
+        '''
+        if returncode == 0:
+            return True
+        m = STALE_CONTROL_SOCKET.search(to_str(stderr or ''))
+        if m:
+            display.debug('removing stale ControlPath %s' % m.group(1))
+            try:
+                os.unlink(m.group(1))
+            except OSError:
+                pass
+        return False
+
+    def _control_socket(self, cmd):
+        '''
+        Returns the path of the ControlPath socket cmd uses, or None if it
+        can't be told without asking ssh (tokens other than %h, %p, %r, or
+        no remote user set).
+        '''
+        path = None
+        for arg in cmd:
+            if arg.startswith(b'ControlPath='):
+                path = to_str(arg[len(b'ControlPath='):])
+        if path is None:
+            return None
+        tokens = {'%': '%', 'h': self.host, 'p': str(self._play_context.port or 22),
+                  'r': self._play_context.remote_user}
+        unknown = []
+
+        def expand(m):
+            value = tokens.get(m.group(1))
+            if value is None:
+                unknown.append(m.group(1))
+                return ''
+            return value
+
+        path = re.sub(r'%(.)', expand, path)
+        if unknown:
+            return None
+        return path
+
+    def _check_master(self):
+        '''
+        Checks once per connection, before the first command reuses it, that
+        the host's ControlMaster is alive. When its socket is there, which is
+        the case for every task after the first one (or after
+        prewarm_masters), that is taken as the answer, rather than running
+        `ssh -O check` for every task; a socket whose master died is removed
+        by _run as soon as ssh trips over it.
+        '''
+        if self._master_checked:
+            return
+        self._master_checked = True
+        cmd = self._control_command('check')
+        if cmd is None:
+            return
+        path = self._control_socket(cmd)
+        if path is not None:
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    return
+            except OSError:
+                # no master to check
+                return
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if not self._master_alive(p.returncode, stderr):
+            display.vvvv(u'SSH: no live ControlMaster, connecting afresh', host=self.host)
+
+    # for callbacks, which only get at the class through connection_loader
+    health_counters = staticmethod(health_counters)
+
+    @staticmethod
+    def prewarm_masters(connections, limit):
+        '''
+        Makes sure each of the connections has a live ControlMaster, starting
+        the missing ones in parallel, at most limit at a time. Masters are
+        stopped when ansible exits. Returns the hosts whose master could not
+        be started; their tasks will try to connect as usual.
+        '''
+        global _MASTERS_PID
+
+        if not PREWARM_MASTERS:
+            return []
+
+        checks = []
+        for conn in connections:
+            cmd = conn._control_command('check')
+            if cmd is not None:
+                checks.append((conn, cmd))
+        if not checks:
+            return []
+
+        timeout = max(conn._play_context.timeout for (conn, cmd) in checks) + 2
+        results = _run_parallel([cmd for (conn, cmd) in checks], limit, timeout)
+        cold = [conn for ((conn, cmd), (rc, stderr)) in zip(checks, results)
+                if not conn._master_alive(rc, stderr)]
+
+        starts = [list(map(to_bytes, conn._build_command('ssh', conn.host, 'exit 0')))
+                  for conn in cold]
+        display.debug('starting %d of %d ssh ControlMasters' % (len(starts), len(checks)))
+        results = _run_parallel(starts, limit, timeout)
+
+        if _MASTERS_PID != os.getpid():
+            _MASTERS.clear()
+            _MASTERS_PID = os.getpid()
+            atexit.register(stop_masters)
+
+        failed = []
+        for conn, (rc, stderr) in zip(cold, results):
+            if rc != 0:
+                display.vvv(u'SSH: could not start ControlMaster: %s' % to_unicode(stderr or '').strip(), host=conn.host)
+                failed.append(conn.host)
+        for conn, cmd in checks:
+            if conn.host not in failed:
+                _MASTERS[conn.host] = conn._control_command('exit')
+        return failed
+
     def _send_initial_data(self, fh, in_data):
         '''
         Writes initial data to the stdin filehandle of the subprocess and closes
@@ -244,12 +662,43 @@ class Connection(ConnectionBase):
         display.debug('Sending initial data')
 
         try:
-            fh.write(in_data)
+            if hasattr(in_data, 'read'):
+                # a stream (see push_tree), copied as it is produced
+                sent = 0
+                for chunk in iter(lambda: in_data.read(65536), b''):
+                    fh.write(chunk)
+                    sent += len(chunk)
+            else:
+                fh.write(in_data)
+                sent = len(in_data)
             fh.close()
         except (OSError, IOError):
             raise AnsibleConnectionFailure('SSH Error: data could not be sent to the remote host. Make sure this host can be reached over ssh')
 
-        display.debug('Sent initial data (%d bytes)' % len(in_data))
+        display.debug('Sent initial data (%d bytes)' % sent)
+
+    def _trace_op(self, op, cmd, start, returncode):
+        '''
+        Records one ssh/scp/sftp invocation made by this worker process.
+        '''
+        if not TRACE_DIR:
+            return
+        binary = cmd[2] if cmd[0] == b'sshpass' else cmd[0]
+        line = json.dumps(dict(
+            pid=os.getpid(), host=self.host, op=op, binary=binary,
+            start=start, end=time.time(), rc=returncode,
+        )) + '\n'
+        try:
+            # a single short O_APPEND write, so concurrent workers don't
+            # interleave their lines
+            fd = os.open(os.path.join(TRACE_DIR, 'connections.jsonl'),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except (OSError, IOError) as e:
+            display.debug('could not record connection trace: %s' % e)
 
     # Used by _run() to kill processes on failures
     @staticmethod
@@ -260,6 +709,20 @@ class Connection(ConnectionBase):
         except (OSError, IOError):
             pass
 
+    @staticmethod
+    def _read_chunk(fd):
+        '''
+        Reads what is available from a non-blocking pipe, up to READ_SIZE
+        bytes. Returns '' at EOF, and None if there was nothing to read
+        after all.
+        '''
+        try:
+            return os.read(fd, READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+
     # This is separate from _run() because we need to do the same thing for stdout
     # and stderr.
     def _examine_output(self, source, state, chunk, sudoable):
@@ -381,8 +844,14 @@ class Connection(ConnectionBase):
         # Output is accumulated into tmp_*, complete lines are extracted into
         # an array, then checked and removed or copied to stdout or stderr. We
         # set any flags based on examining the output in self._flags.
+        #
+        # The output itself is kept as a list of chunks, joined once the
+        # process has exited, so modules returning megabytes of JSON cost one
+        # copy rather than one per read; only the (short) remainder of a line
+        # still being negotiated is kept in tmp_*.
 
-        stdout = stderr = ''
+        stdout = []
+        stderr = []
         tmp_stdout = tmp_stderr = ''
 
         self._flags = dict(
@@ -390,23 +859,27 @@ class Connection(ConnectionBase):
             become_error=False, become_nopasswd_error=False
         )
 
-        # select timeout should be longer than the connect timeout, otherwise
+        # poll timeout should be longer than the connect timeout, otherwise
         # they will race each other when we can't connect, and the connect
         # timeout usually fails
         timeout = 2 + self._play_context.timeout
-        rpipes = [p.stdout, p.stderr]
+        stdout_fd = p.stdout.fileno()
+        stderr_fd = p.stderr.fileno()
+        rpipes = set([stdout_fd, stderr_fd])
+        poller = select.poll()
         for fd in rpipes:
             fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            poller.register(fd, select.POLLIN | select.POLLPRI)
 
         # If we can send initial data without waiting for anything, we do so
-        # before we call select.
+        # before we call poll.
 
         if states[state] == 'ready_to_send' and in_data:
             self._send_initial_data(stdin, in_data)
             state += 1
 
         while True:
-            rfd, wfd, efd = select.select(rpipes, [], [], timeout)
+            rfd = [fd for (fd, event) in poller.poll(timeout * 1000)]
 
             # We pay attention to timeouts only while negotiating a prompt.
 
@@ -417,24 +890,30 @@ class Connection(ConnectionBase):
                     if p.poll() is not None:
                         break
                     self._terminate_process(p)
-                    raise AnsibleError('Timeout (%ds) waiting for privilege escalation prompt: %s' % (timeout, stdout))
+                    raise AnsibleError('Timeout (%ds) waiting for privilege escalation prompt: %s' % (timeout, ''.join(stdout)))
 
             # Read whatever output is available on stdout and stderr, and stop
             # listening to the pipe if it's been closed.
 
-            if p.stdout in rfd:
-                chunk = p.stdout.read()
+            if stdout_fd in rfd:
+                chunk = self._read_chunk(stdout_fd)
                 if chunk == '':
-                    rpipes.remove(p.stdout)
-                tmp_stdout += chunk
-                display.debug("stdout chunk (state=%s):\n>>>%s<<<\n" % (state, chunk))
-
-            if p.stderr in rfd:
-                chunk = p.stderr.read()
+                    rpipes.discard(stdout_fd)
+                    poller.unregister(stdout_fd)
+                if chunk is not None:
+                    tmp_stdout += chunk
+                    if C.DEFAULT_DEBUG:
+                        display.debug("stdout chunk (state=%s):\n>>>%s<<<\n" % (state, chunk))
+
+            if stderr_fd in rfd:
+                chunk = self._read_chunk(stderr_fd)
                 if chunk == '':
-                    rpipes.remove(p.stderr)
-                tmp_stderr += chunk
-                display.debug("stderr chunk (state=%s):\n>>>%s<<<\n" % (state, chunk))
+                    rpipes.discard(stderr_fd)
+                    poller.unregister(stderr_fd)
+                if chunk is not None:
+                    tmp_stderr += chunk
+                    if C.DEFAULT_DEBUG:
+                        display.debug("stderr chunk (state=%s):\n>>>%s<<<\n" % (state, chunk))
 
             # We examine the output line-by-line until we have negotiated any
             # privilege escalation prompt and subsequent success/error message.
@@ -443,16 +922,18 @@ class Connection(ConnectionBase):
             if state < states.index('ready_to_send'):
                 if tmp_stdout:
                     output, unprocessed = self._examine_output('stdout', states[state], tmp_stdout, sudoable)
-                    stdout += output
+                    stdout.append(output)
                     tmp_stdout = unprocessed
 
                 if tmp_stderr:
                     output, unprocessed = self._examine_output('stderr', states[state], tmp_stderr, sudoable)
-                    stderr += output
+                    stderr.append(output)
                     tmp_stderr = unprocessed
             else:
-                stdout += tmp_stdout
-                stderr += tmp_stderr
+                if tmp_stdout:
+                    stdout.append(tmp_stdout)
+                if tmp_stderr:
+                    stderr.append(tmp_stderr)
                 tmp_stdout = tmp_stderr = ''
 
             # If we see a privilege escalation prompt, we send the password.
@@ -513,12 +994,12 @@ class Connection(ConnectionBase):
                 # When ssh has ControlMaster (+ControlPath/Persist) enabled, the
                 # first connection goes into the background and we never see EOF
                 # on stderr. If we see EOF on stdout and the process has exited,
-                # we're probably done. We call select again with a zero timeout,
+                # we're probably done. We call poll again with a zero timeout,
                 # just to make certain we don't miss anything that may have been
-                # written to stderr between the time we called select() and when
+                # written to stderr between the time we called poll() and when
                 # we learned that the process had finished.
 
-                if p.stdout not in rpipes:
+                if stdout_fd not in rpipes:
                     timeout = 0
                     continue
 
@@ -536,6 +1017,14 @@ class Connection(ConnectionBase):
         # completely (see also issue #848)
         stdin.close()
 
+        stdout = ''.join(stdout)
+        stderr = ''.join(stderr)
+
+        if self._persistent and p.returncode != 0:
+            # the master behind the socket is gone; don't let the next
+            # connection trip over it too
+            self._master_alive(p.returncode, stderr)
+
         if C.HOST_KEY_CHECKING:
             if cmd[0] == b"sshpass" and p.returncode == 6:
                 raise AnsibleError('Using a SSH password instead of a key is not possible because Host Key checking is enabled and sshpass does not support this.  Please add this host\'s fingerprint to your known_hosts file to manage this host.')
@@ -566,8 +1055,11 @@ class Connection(ConnectionBase):
         else:
             args = ('ssh', self.host, cmd)
 
+        self._check_master()
         cmd = self._build_command(*args)
+        start = time.time()
         (returncode, stdout, stderr) = self._run(cmd, in_data, sudoable=sudoable)
+        self._trace_op('exec', cmd, start, returncode)
 
         return (returncode, stdout, stderr)
 
@@ -584,9 +1076,28 @@ class Connection(ConnectionBase):
         Will not retry if
         * remaining_tries is <2
         * retries limit reached
+        * the host's circuit breaker opened (see HostHealth)
+
+        While a host's circuit is open, fails at once without running ssh,
+        except for one probe every CIRCUIT_COOLDOWN seconds, whose outcome
+        other commands for the host wait for.
         """
 
+        health = HostHealth(self.host)
+        circuit = health.allow()
+        while circuit == 'wait':
+            # the probe decides for us; if its worker dies, the circuit
+            # times out and the next allow() probes again
+            time.sleep(0.5)
+            circuit = health.allow()
+        if circuit is None:
+            raise AnsibleConnectionFailure("Failed to connect to the host via ssh: %d failures in the last %ds, "
+                                           "not retrying for up to %ds" % (CIRCUIT_THRESHOLD, CIRCUIT_WINDOW, CIRCUIT_COOLDOWN))
+
         remaining_tries = int(C.ANSIBLE_SSH_RETRIES) + 1
+        if circuit == 'probe':
+            display.vv("ssh_retry: probing host after its circuit opened", host=self.host)
+            remaining_tries = 1
         cmd_summary = "%s..." % args[0]
         for attempt in range(remaining_tries):
             try:
@@ -595,23 +1106,26 @@ class Connection(ConnectionBase):
                 # 1-254 = remote command return code
                 # 255 = failure from the ssh command itself
                 if return_tuple[0] != 255:
+                    health.success()
                     break
                 else:
                     raise AnsibleConnectionFailure("Failed to connect to the host via ssh.")
             except (AnsibleConnectionFailure, Exception) as e:
-                if attempt == remaining_tries - 1:
+                opened = False
+                if isinstance(e, AnsibleConnectionFailure):
+                    opened = health.failure(circuit == 'probe')
+                if opened or attempt == remaining_tries - 1:
                     raise
                 else:
-                    pause = 2 ** attempt - 1
-                    if pause > 30:
-                        pause = 30
+                    pause = random.uniform(0, min(RETRY_MAX_PAUSE, 2 ** attempt))
 
                     if isinstance(e, AnsibleConnectionFailure):
-                        msg = "ssh_retry: attempt: %d, ssh return code is 255. cmd (%s), pausing for %d seconds" % (attempt, cmd_summary, pause)
+                        msg = "ssh_retry: attempt: %d, ssh return code is 255. cmd (%s), pausing for %.1f seconds" % (attempt, cmd_summary, pause)
                     else:
-                        msg = "ssh_retry: attempt: %d, caught exception(%s) from cmd (%s), pausing for %d seconds" % (attempt, e, cmd_summary, pause)
+                        msg = "ssh_retry: attempt: %d, caught exception(%s) from cmd (%s), pausing for %.1f seconds" % (attempt, e, cmd_summary, pause)
 
                     display.vv(msg, host=self.host)
+                    health.retry()
 
                     time.sleep(pause)
                     continue
@@ -631,6 +1145,7 @@ class Connection(ConnectionBase):
         # accept them for hostnames and IPv4 addresses too.
         host = '[%s]' % self.host
 
+        self._check_master()
         if C.DEFAULT_SCP_IF_SSH:
             cmd = self._build_command('scp', in_path, u'{0}:{1}'.format(host, pipes.quote(out_path)))
             in_data = None
@@ -639,7 +1154,9 @@ class Connection(ConnectionBase):
             in_data = u"put {0} {1}\n".format(pipes.quote(in_path), pipes.quote(out_path))
 
         in_data = to_bytes(in_data, nonstring='passthru')
+        start = time.time()
         (returncode, stdout, stderr) = self._run(cmd, in_data)
+        self._trace_op('put', cmd, start, returncode)
 
         if returncode != 0:
             raise AnsibleError("failed to transfer file to {0}:\n{1}\n{2}".format(to_str(out_path), to_str(stdout), to_str(stderr)))
@@ -655,6 +1172,7 @@ class Connection(ConnectionBase):
         # accept them for hostnames and IPv4 addresses too.
         host = '[%s]' % self.host
 
+        self._check_master()
         if C.DEFAULT_SCP_IF_SSH:
             cmd = self._build_command('scp', u'{0}:{1}'.format(host, pipes.quote(in_path)), out_path)
             in_data = None
@@ -663,14 +1181,252 @@ class Connection(ConnectionBase):
             in_data = u"get {0} {1}\n".format(pipes.quote(in_path), pipes.quote(out_path))
 
         in_data = to_bytes(in_data, nonstring='passthru')
+        start = time.time()
         (returncode, stdout, stderr) = self._run(cmd, in_data)
+        self._trace_op('fetch', cmd, start, returncode)
 
         if returncode != 0:
             raise AnsibleError("failed to transfer file from {0}:\n{1}\n{2}".format(in_path, stdout, stderr))
 
+    def transfer_files(self, transfers):
+        '''
+        Runs a list of ('put', local path, remote path) and ('fetch', remote
+        path, local path) transfers, in order, through a single sftp session
+        rather than one sftp or scp process per file.
+
+        Returns a dict(op, src, dest, failed, msg) for each transfer. sftp
+        stops a batch at the first failure, which it reports for the last
+        command it echoed, so whatever followed is sent again in a new
+        session. With scp_if_ssh, the files are sent one by one instead.
+        '''
+
+        results = []
+        batch = []
+        for (op, src, dest) in transfers:
+            if op not in ('put', 'fetch'):
+                raise AnsibleError("unsupported transfer operation: %s" % op)
+            display.vvv(u"{0} {1} TO {2}".format(op.upper(), src, dest), host=self.host)
+            result = dict(op=op, src=src, dest=dest, failed=False, msg='')
+            if op == 'put' and not os.path.exists(to_bytes(src, errors='strict')):
+                result.update(failed=True, msg="file or module does not exist: {0}".format(to_str(src)))
+            else:
+                batch.append(result)
+            results.append(result)
+
+        if C.DEFAULT_SCP_IF_SSH:
+            for result in batch:
+                transfer = self.put_file if result['op'] == 'put' else self.fetch_file
+                try:
+                    transfer(result['src'], result['dest'])
+                except AnsibleError as e:
+                    result.update(failed=True, msg=to_str(e))
+            return results
+
+        # scp and sftp require square brackets for IPv6 addresses, but
+        # accept them for hostnames and IPv4 addresses too.
+        host = '[%s]' % self.host
+
+        self._check_master()
+        while batch:
+            cmd = self._build_command('sftp', to_bytes(host))
+            in_data = u''.join(
+                u"{0} {1} {2}\n".format('put' if r['op'] == 'put' else 'get',
+                                        pipes.quote(r['src']), pipes.quote(r['dest']))
+                for r in batch
+            )
+            start = time.time()
+            (returncode, stdout, stderr) = self._run(cmd, to_bytes(in_data))
+            self._trace_op('batch', cmd, start, returncode)
+
+            if returncode == 0:
+                break
+
+            attempted = len([l for l in stdout.splitlines() if l.startswith('sftp> ')])
+            if attempted == 0:
+                # nothing ran at all, so retrying won't help
+                for result in batch:
+                    result.update(failed=True, msg=to_str(stderr))
+                break
+            batch[attempted - 1].update(failed=True, msg=to_str(stderr).strip())
+            batch = batch[attempted:]
+
+        return results
+
+    def _remote_shell(self, script):
+        cmd = '/bin/sh -c %s' % pipes.quote(script)
+        if self._play_context.become:
+            cmd = self._play_context.make_become_cmd(cmd, executable='/bin/sh')
+        return cmd
+
+    def push_tree(self, local_dir, remote_dir, compression='zstd', mode=None, check=False):
+        '''
+        Copies the files under local_dir to remote_dir as a single tar
+        stream over one ssh command, rather than file by file. Only files
+        whose sha1 differs from the remote copy's are sent; nothing is
+        removed from remote_dir. Symlinks, including those to directories,
+        are sent as links and not followed.
+
+        compression may be 'zstd', 'gzip' or None; zstd is used only when
+        both ends have the zstd binary, and gzip otherwise.
+
+        mode, as chmod takes it, is set on the files sent and on those whose
+        mode differs; a symbolic mode is set on every file each time. With
+        check, nothing is sent and the result says what would be.
+
+        Returns dict(changed, files, sent, chmod, bytes), sent and chmod
+        being the relative paths of the files that were copied and those
+        whose mode was set, and bytes the archive size.
+        '''
+
+        if compression not in ('zstd', 'gzip', None):
+            raise AnsibleError("unsupported compression: %s" % compression)
+        if not os.path.isdir(to_bytes(local_dir, errors='strict')):
+            raise AnsibleFileNotFound("directory does not exist: {0}".format(to_str(local_dir)))
+
+        display.vvv(u"PUSH {0} TO {1}".format(local_dir, remote_dir), host=self.host)
+
+        # one line saying whether zstd is available, then `<sha1>  ./path`
+        # for every file already there, `link:<target>  ./path` for every
+        # symlink and `mode:<octal>  ./path` for every file
+        script = ('if command -v zstd >/dev/null 2>&1; then echo zstd; else echo nozstd; fi; '
+                  'cd %s 2>/dev/null || exit 0; find . -type f -exec sha1sum {} +; '
+                  "find . -type l -printf 'link:%%l  %%p\\n'; "
+                  "find . -type f -printf 'mode:%%m  %%p\\n'" % pipes.quote(remote_dir))
+        (returncode, stdout, stderr) = self.exec_command(self._remote_shell(script), sudoable=True)
+        if returncode != 0:
+            raise AnsibleError("failed to read checksums from {0}:\n{1}\n{2}".format(to_str(remote_dir), to_str(stdout), to_str(stderr)))
+
+        lines = stdout.splitlines()
+        remote_zstd = bool(lines) and lines[0].strip() == 'zstd'
+        remote = {}
+        remote_modes = {}
+        for line in lines[1:]:
+            # sha1sum escapes names containing backslashes or newlines;
+            # those files are just sent again
+            checksum, sep, path = line.partition('  ./')
+            if not sep or checksum.startswith('\\'):
+                continue
+            if checksum.startswith('mode:'):
+                remote_modes[path] = checksum[5:]
+            else:
+                remote[path] = checksum
+        try:
+            octal_mode = None if mode is None else int(mode, 8)
+        except ValueError:
+            octal_mode = None
+
+        local_root = to_bytes(local_dir, errors='strict')
+        files = []
+        sent = []
+        chmod = []
+        for (dirpath, dirnames, filenames) in os.walk(local_root):
+            dirnames.sort()
+            # os.walk lists symlinks to directories with the directories,
+            # without going into them; they are sent as links, like the
+            # others
+            links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            for name in sorted(filenames + links):
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, local_root)
+                files.append(rel)
+                if os.path.islink(path):
+                    checksum = 'link:' + to_str(os.readlink(path))
+                else:
+                    checksum = _sha1(path)
+                differs = remote.get(to_str(rel)) != checksum
+                if differs:
+                    sent.append(rel)
+                if mode is None or os.path.islink(path):
+                    continue
+                # what tar gives a new file depends on the umask
+                if differs or octal_mode is None or remote_modes.get(to_str(rel)) != '%o' % octal_mode:
+                    chmod.append(rel)
+
+        result = dict(changed=bool(sent or chmod), files=len(files), sent=[to_str(rel) for rel in sent],
+                      chmod=[to_str(rel) for rel in chmod], bytes=0)
+        if check or not result['changed']:
+            return result
+
+        cd = 'cd %s' % pipes.quote(remote_dir)
+        if chmod:
+            set_mode = 'chmod %s -- %s' % (pipes.quote(mode), ' '.join(pipes.quote(to_str(rel)) for rel in chmod))
+        if not sent:
+            (returncode, stdout, stderr) = self.exec_command(self._remote_shell('%s && %s' % (cd, set_mode)), sudoable=True)
+            if returncode != 0:
+                raise AnsibleError("failed to set the mode of files in {0}:\n{1}\n{2}".format(to_str(remote_dir), to_str(stdout), to_str(stderr)))
+            return result
+
+        if compression == 'zstd' and not (remote_zstd and _which('zstd')):
+            display.vvv(u"zstd is not available on both ends, using gzip", host=self.host)
+            compression = 'gzip'
+
+        # the archive is written by a thread into the compressor, or a pipe,
+        # while ssh reads the other end, so it is never held in memory
+        compressor = None
+        if compression is None:
+            (rfd, wfd) = os.pipe()
+            (out, stream) = (os.fdopen(wfd, 'wb'), os.fdopen(rfd, 'rb'))
+            unpack = 'tar -xf - --no-same-owner'
+        else:
+            compressor_err = tempfile.TemporaryFile()
+            compressor = subprocess.Popen(COMPRESSORS[compression], stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=compressor_err)
+            (out, stream) = (compressor.stdin, compressor.stdout)
+            unpack = '%s | tar -xf - --no-same-owner' % ' '.join(DECOMPRESSORS[compression])
+        for fh in (out, stream):
+            # or ssh would inherit the write end, and tar never see the end
+            flags = fcntl.fcntl(fh.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(fh.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        stream = _CountingReader(stream)
+
+        errors = []
+
+        def write_archive():
+            try:
+                archive = tarfile.open(fileobj=out, mode='w|')
+                for rel in sent:
+                    archive.add(os.path.join(local_root, rel), arcname=rel, recursive=False)
+                archive.close()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    out.close()
+                except (OSError, IOError):
+                    pass
+
+        writer = threading.Thread(target=write_archive)
+        writer.daemon = True
+        writer.start()
+        script = 'mkdir -p %s && %s && %s' % (pipes.quote(remote_dir), cd, unpack)
+        if chmod:
+            script += ' && ' + set_mode
+        try:
+            # not exec_command: a stream can't be sent again on a retry
+            (returncode, stdout, stderr) = self._exec_command(self._remote_shell(script), in_data=stream, sudoable=True)
+        finally:
+            # if ssh stopped reading, this unblocks the writer
+            stream.close()
+            writer.join()
+            if compressor is not None:
+                compressor.wait()
+        if errors:
+            raise AnsibleError("failed to archive {0}: {1}".format(to_str(local_dir), to_str(errors[0])))
+        if compressor is not None and compressor.returncode != 0:
+            compressor_err.seek(0)
+            raise AnsibleError("{0} failed: {1}".format(compression, to_str(compressor_err.read())))
+        if returncode != 0:
+            raise AnsibleError("failed to unpack files into {0}:\n{1}\n{2}".format(to_str(remote_dir), to_str(stdout), to_str(stderr)))
+
+        result['bytes'] = stream.count
+        return result
+
     def close(self):
         # If we have a persistent ssh connection (ControlPersist), we can ask it
         # to stop listening. Otherwise, there's nothing to do here.
+        #
+        # BB Mod: masters outlive the task on purpose; those started by
+        # prewarm_masters() are stopped by stop_masters() when ansible exits.
 
         # TODO: reenable once winrm issues are fixed
         # temporarily disabled as we are forced to currently close connections after every task because of winrm
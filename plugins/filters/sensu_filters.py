@@ -1,17 +1,19 @@
 
 
 def sensu_dependencies(check_name, hostvars, host_groups, check_groups):
+    hosts = set()
+    for group in check_groups.split(','):
+        if group in host_groups:
+            hosts.update(host_groups[group])
     deps = set()
-    check_groups = check_groups.split(',')
-    for group in check_groups:
-        if not group in host_groups:
-            continue
-        for host in host_groups[group]:
-            client_name = '{}.{}-{}'.format(host, hostvars[host]['ansible_domain'], hostvars[host]['stack_env'])
-            if 'monitoring' in hostvars[host]:
-                if 'client_name' in hostvars[host]['monitoring']:
-                    client_name = hostvars[host]['monitoring']['client_name']
-            deps.add("{}/{}".format(client_name, check_name))
+    for host in hosts:
+        # each hostvars[host] runs the whole variable precedence
+        host_vars = hostvars[host]
+        client_name = '{}.{}-{}'.format(host, host_vars['ansible_domain'], host_vars['stack_env'])
+        if 'monitoring' in host_vars:
+            if 'client_name' in host_vars['monitoring']:
+                client_name = host_vars['monitoring']['client_name']
+        deps.add("{}/{}".format(client_name, check_name))
     return sorted(list(deps))
 
 
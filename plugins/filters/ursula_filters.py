@@ -4,8 +4,10 @@ import os
 def ursula_controller_ips(hostvars, groups, controller_name='controller'):
     controller_ips = set()
     for host in groups[controller_name]:
-        controller_primary_interface = hostvars[host]['primary_interface']
-        ip = hostvars[host][controller_primary_interface]['ipv4']['address']
+        # each hostvars[host] runs the whole variable precedence
+        host_vars = hostvars[host]
+        controller_primary_interface = host_vars['primary_interface']
+        ip = host_vars[controller_primary_interface]['ipv4']['address']
         controller_ips.add(ip)
     return sorted(list(controller_ips))
 
@@ -0,0 +1,251 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import time
+
+from ansible import constants as C
+from ansible.compat.six import iteritems
+from ansible.errors import AnsibleError
+from ansible.playbook.block import Block
+from ansible.playbook.task import Task
+from ansible.plugins import connection_loader
+from ansible.plugins.strategy import StrategyBase
+from ansible.template import Templar
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+
+# With strategy_preflight, every host is pinged (through become, if the play
+# uses it) before the first task of the play, and with
+# strategy_preflight_facts a minimal set of facts is gathered instead.
+PREFLIGHT = C.get_config(C.p, C.DEFAULTS, 'strategy_preflight',
+                         'ANSIBLE_STRATEGY_PREFLIGHT', False, boolean=True)
+PREFLIGHT_FACTS = C.get_config(C.p, C.DEFAULTS, 'strategy_preflight_facts',
+                               'ANSIBLE_STRATEGY_PREFLIGHT_FACTS', False,
+                               boolean=True)
+
+# How long to block on the results queue when no host can be given a task.
+# This only bounds how quickly a terminated run or a dead worker is noticed;
+# an arriving result wakes the strategy immediately.
+RESULT_WAIT_TIMEOUT = 1.0
+
+
+class StrategyModule(StrategyBase):
+    '''
+    What bb_linear, bb_free and bb_window have in common: task start and
+    worker callbacks, and the connection prewarm, preflight and fact
+    refresh phases run before the first task of a play. It is not a
+    strategy of its own; the others load it with
+    strategy_loader.get('bb_base', class_only=True).
+    '''
+
+    def __init__(self, tqm):
+        super(StrategyModule, self).__init__(tqm)
+        self._noop_task = None
+
+    def run(self, iterator, play_context, result=True):
+        if type(self) is StrategyModule:
+            raise AnsibleError("bb_base is the base of the bb_* strategies, use bb_linear, bb_free or bb_window")
+        return super(StrategyModule, self).run(iterator, play_context, result)
+
+    def _queue_task(self, host, task, task_vars, play_context):
+        # let timing callbacks (e.g. task_profile) see when each host's task
+        # actually left the strategy, as opposed to v2_playbook_on_task_start
+        # which fires once per task
+        self._tqm.send_callback('v2_runner_on_start', host, task)
+        super(StrategyModule, self)._queue_task(host, task, task_vars, play_context)
+        # and which worker slot (and forked pid) picked it up
+        slot = (self._cur_worker - 1) % len(self._workers)
+        worker_prc = self._workers[slot][0]
+        self._tqm.send_callback('v2_runner_on_queued', host, task, slot,
+                                worker_prc.pid if worker_prc else None)
+
+    def _get_task_vars(self, play, host, task):
+        return self._variable_manager.get_vars(loader=self._loader, play=play, host=host, task=task)
+
+    def _get_noop_task(self, iterator):
+        if self._noop_task is None:
+            noop_task = Task()
+            noop_task.action = 'meta'
+            # a fresh dict, as Task() shares its default args between instances
+            noop_task.args = dict(_raw_params='noop')
+            noop_task.set_loader(iterator._play._loader)
+            self._noop_task = noop_task
+        return self._noop_task
+
+    def _get_play_hosts(self, iterator):
+        '''
+        The hosts left which the play runs on in this pass: unlike
+        _get_hosts_left(), only those within --limit and the current serial
+        batch, which are the only ones the phases before the first task may
+        touch.
+        '''
+        return [
+            host for host in self._inventory.get_hosts(iterator._play.hosts)
+            if host.name not in self._tqm._unreachable_hosts and
+            not iterator.is_failed(host)
+        ]
+
+    def _hosts_done(self, phase):
+        '''
+        The names of the hosts which went through phase ('prewarm' or
+        'preflight'), or the (host name, subset) pairs of the facts
+        refreshed ('facts'), earlier in this run. Kept on the TaskQueueManager, as
+        it lives for the whole run while strategies are created per play,
+        and so that the bb_* strategies share them.
+        '''
+        done = getattr(self._tqm, '_bb_hosts_done', None)
+        if done is None:
+            done = self._tqm._bb_hosts_done = dict(prewarm=set(), preflight=set(), facts=set())
+        return done[phase]
+
+    def _prewarm_connections(self, iterator, play_context, hosts):
+        '''
+        Gives the connection plugin of every host not seen before in this
+        run the chance to connect ahead of the first task, in parallel (see
+        sshbb's prewarm_masters).
+        '''
+        task = self._get_noop_task(iterator)
+        prewarmed = self._hosts_done('prewarm')
+        by_class = {}
+        for host in hosts:
+            if host.name in prewarmed:
+                continue
+            prewarmed.add(host.name)
+            task_vars = self._get_task_vars(iterator._play, host, task)
+            templar = Templar(loader=self._loader, variables=task_vars)
+            try:
+                host_context = play_context.set_task_and_variable_override(task=task, variables=task_vars, templar=templar)
+                host_context.post_validate(templar=templar)
+            except AnsibleError as e:
+                display.debug("not prewarming %s: %s" % (host.name, e))
+                continue
+            if not host_context.remote_addr:
+                host_context.remote_addr = host.address
+            conn_cls = connection_loader.get(host_context.connection, class_only=True)
+            if conn_cls is None or not hasattr(conn_cls, 'prewarm_masters'):
+                continue
+            conn = connection_loader.get(host_context.connection, host_context, None)
+            by_class.setdefault(conn_cls, []).append(conn)
+
+        for conn_cls, connections in iteritems(by_class):
+            display.debug("prewarming %d connections" % len(connections))
+            failed = conn_cls.prewarm_masters(connections, len(self._workers))
+            if failed:
+                display.debug("could not prewarm connections to %s" % ', '.join(failed))
+
+    def _get_preflight_task(self, iterator):
+        task = Task(block=Block(play=iterator._play))
+        task.name = 'preflight'
+        if PREFLIGHT_FACTS:
+            task.action = 'setup'
+            task.args = dict(gather_subset='!all')
+        else:
+            task.action = 'ping'
+            task.args = dict()
+        task.set_loader(self._loader)
+        return task
+
+    def _preflight(self, iterator, play_context, hosts):
+        '''
+        Runs the preflight task on every host not checked before in this
+        run, as many at a time as there are forks, and waits for all of
+        them, so hosts which are unreachable, or where become fails, are out
+        of the play before its first task instead of timing out one by one.
+        '''
+        preflighted = self._hosts_done('preflight')
+        hosts = [host for host in hosts if host.name not in preflighted]
+        if not PREFLIGHT or not hosts:
+            return
+
+        task = self._get_preflight_task(iterator)
+        self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+        for host in hosts:
+            if self._tqm._terminated:
+                break
+            preflighted.add(host.name)
+            task_vars = self._get_task_vars(iterator._play, host, task)
+            self.add_tqm_variables(task_vars, play=iterator._play)
+            self._blocked_hosts[host.name] = True
+            self._queue_task(host, task, task_vars, play_context)
+        self._wait_on_pending_results(iterator)
+
+    def _refresh_facts(self, iterator, play_context, hosts):
+        '''
+        With a fact cache which keeps track of stale subsets (bb_facts),
+        gathers the stale subsets the play wants (its gather_subset) on the
+        hosts which have cached facts, and so skip smart gathering, in one
+        batch before the first task. Hosts needing the same subsets share a
+        setup task; failures leave the cached facts in place.
+        '''
+        play = iterator._play
+        cache = getattr(self._variable_manager._fact_cache, '_plugin', None)
+        if (not hasattr(cache, 'stale_subsets') or C.DEFAULT_GATHERING != 'smart' or
+                play.gather_facts is False):
+            return
+
+        gather_subset = play.gather_subset
+        if gather_subset is None:
+            gather_subset = C.DEFAULT_GATHER_SUBSET
+        refreshed = self._hosts_done('facts')
+        pending = {}
+        for host in hosts:
+            if host.name not in self._variable_manager._fact_cache:
+                continue
+            subsets = frozenset(s for s in cache.stale_subsets(host.name, gather_subset)
+                                if (host.name, s) not in refreshed)
+            if subsets:
+                pending.setdefault(subsets, []).append(host)
+
+        for (subsets, subset_hosts) in iteritems(pending):
+            task = Task(block=Block(play=play))
+            task.name = 'refresh facts (%s)' % ', '.join(sorted(subsets))
+            task.action = 'setup'
+            task.args = dict(gather_subset=cache.gather_subset_arg(subsets))
+            task.ignore_errors = True
+            task.set_loader(self._loader)
+            self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+            for host in subset_hosts:
+                if self._tqm._terminated:
+                    break
+                refreshed.update((host.name, s) for s in subsets)
+                task_vars = self._get_task_vars(play, host, task)
+                self.add_tqm_variables(task_vars, play=play)
+                self._blocked_hosts[host.name] = True
+                self._queue_task(host, task, task_vars, play_context)
+        if pending:
+            self._wait_on_pending_results(iterator)
+
+    def _wait_for_results(self, timeout=RESULT_WAIT_TIMEOUT):
+        '''
+        Blocks until a result is available on the final queue, or until the
+        timeout expires, without consuming anything from the queue.
+        '''
+        if self._tqm.has_dead_workers():
+            raise AnsibleError("A worker was found in a dead state")
+
+        poll = getattr(self._final_q, '_poll', None)
+        if poll is None:
+            time.sleep(0.001)
+        else:
+            poll(timeout)
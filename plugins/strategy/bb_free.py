@@ -19,12 +19,11 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import time
+from collections import deque
 
 from ansible.errors import AnsibleError
 from ansible.playbook.included_file import IncludedFile
-from ansible.plugins import action_loader
-from ansible.plugins.strategy import StrategyBase
+from ansible.plugins import action_loader, strategy_loader
 from ansible.template import Templar
 from ansible.executor.play_iterator import PlayIterator
 
@@ -35,7 +34,31 @@ except ImportError:
     display = Display()
 
 
-class StrategyModule(StrategyBase):
+BaseStrategyModule = strategy_loader.get('bb_base', class_only=True)
+
+
+class StrategyModule(BaseStrategyModule):
+
+    def _get_hosts_left(self, iterator):
+        return [
+            host for host in self._inventory.get_hosts(
+                iterator._play.hosts,
+                ignore_limits_and_restrictions=True
+            ) if host.name not in self._tqm._unreachable_hosts and
+            not iterator.is_failed(host)
+        ]
+
+    def _requeue_hosts(self, iterator, ready_hosts):
+        '''
+        Appends to ready_hosts every host left which is neither blocked nor
+        in it already. Results can be read outside of the main loop, by the
+        handlers of a flush_handlers meta task for one, and unblock their
+        host without it rejoining the queue.
+        '''
+        queued = set(host.name for host in ready_hosts)
+        for host in self._get_hosts_left(iterator):
+            if host.name not in queued and not self._blocked_hosts.get(host.name, False):
+                ready_hosts.append(host)
 
     def run(self, iterator, play_context):
         '''
@@ -44,43 +67,54 @@ class StrategyModule(StrategyBase):
         some hosts may finish very quickly if run tasks result in little or no
         work being done versus other systems.
 
-        The algorithm used here also tries to be more "fair" when iterating
-        through hosts by remembering the last host in the list to be given a task
-        and starting the search from there as opposed to the top of the hosts
-        list again, which would end up favoring hosts near the beginning of the
-        list.
+        Hosts which may have a task to run are kept in a round-robin queue,
+        so iteration stays "fair" without favoring hosts near the beginning
+        of the list. A host leaves the queue when a task is queued for it and
+        rejoins when its result comes back, so each pass only looks at hosts
+        which can actually be given work. When there are none, we block on
+        the results queue rather than polling it. Meta tasks may read the
+        results of other hosts, so the unblocked ones are queued again after
+        them, and once nothing is running every host left is looked at again
+        before the play ends.
         '''
 
-        # the last host to be given a task
-        last_host = 0
-
         result = True
 
-        work_to_do = True
-        while work_to_do and not self._tqm._terminated:
-            hosts_left = [
-                host for host in self._inventory.get_hosts(
-                    iterator._play.hosts,
-                    ignore_limits_and_restrictions=True
-                ) if host.name not in self._tqm._unreachable_hosts and
-                not iterator.is_failed(host)
-            ]
+        self._prewarm_connections(iterator, play_context, self._get_play_hosts(iterator))
+        self._preflight(iterator, play_context, self._get_play_hosts(iterator))
+        self._refresh_facts(iterator, play_context, self._get_play_hosts(iterator))
+        hosts_left = self._get_hosts_left(iterator)
+
+        # hosts which are not blocked and may have a task to run, in the
+        # order they will next be looked at
+        ready_hosts = deque(hosts_left)
+        # whether the last pass looked at every host left, with nothing
+        # running
+        full_pass = False
+
+        while not self._tqm._terminated:
             if len(hosts_left) == 0:
                 self._tqm.send_callback('v2_playbook_on_no_hosts_remaining')
                 result = False
                 break
 
-            work_to_do = False        # assume we have no more work to do
-            starting_host = last_host # save current position so we know when we've
-                                      # looped back around and need to break
+            dispatched = False
 
-            # try and find an unblocked host with a task to run
-            host_results = []
-            while True:
-                host = hosts_left[last_host]
+            # give a task to every ready host that has one, moving hosts with
+            # nothing left to do out of the ready queue
+            for i in range(len(ready_hosts)):
+                host = ready_hosts.popleft()
                 display.debug("next free host: %s" % host)
                 host_name = host.get_name()
 
+                if host_name in self._tqm._unreachable_hosts or iterator.is_failed(host):
+                    continue
+
+                # a blocked host rejoins the queue when its result arrives
+                if self._blocked_hosts.get(host_name, False):
+                    display.debug("%s is blocked, skipping for now" % host_name)
+                    continue
+
                 # peek at the next task for the host, to see if there's
                 # anything to do do for this host
                 (state, task) = iterator.get_next_task_for_host(host, peek=True)
@@ -91,82 +125,88 @@ class StrategyModule(StrategyBase):
                     host not in self._inventory._restriction):
 
                     display.debug(
-                        "%s is restricted, skipping for now" % host_name)
-
-                elif host_name not in self._tqm._unreachable_hosts and task:
-
-                    # set the flag so the outer loop knows we've still found
-                    # some work which needs to be done
-                    work_to_do = True
-
-                    display.debug("this host has work to do")
-
-                    # check to see if this host is blocked (still executing a previous task)
-                    if host_name not in self._blocked_hosts or not self._blocked_hosts[host_name]:
-                        # pop the task, mark the host blocked, and queue it
-                        self._blocked_hosts[host_name] = True
-                        (state, task) = iterator.get_next_task_for_host(host)
-
-                        try:
-                            action = action_loader.get(task.action, class_only=True)
-                        except KeyError:
-                            # we don't care here, because the action may simply not have a
-                            # corresponding action plugin
-                            action = None
-
-                        display.debug("getting variables")
-                        task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, host=host, task=task)
-                        self.add_tqm_variables(task_vars, play=iterator._play)
-                        templar = Templar(loader=self._loader, variables=task_vars)
-                        display.debug("done getting variables")
-
-                        run_once = templar.template(task.run_once) or action and getattr(action, 'BYPASS_HOST_LOOP', False)
-                        if run_once:
-                            if action and getattr(action, 'BYPASS_HOST_LOOP', False):
-                                raise AnsibleError("The '%s' module bypasses the host loop, which is currently not supported in the free strategy " \
-                                                   "and would instead execute for every host in the inventory list." % task.action, obj=task._ds)
-                            else:
-                                display.warning("Using run_once with the free strategy is not currently supported. This task will still be " \
-                                                "executed for every host in the inventory list.")
-
-                        # check to see if this task should be skipped, due to it being a member of a
-                        # role which has already run (and whether that role allows duplicate execution)
-                        if task._role and task._role.has_run(host):
-                            # If there is no metadata, the default behavior is to not allow duplicates,
-                            # if there is metadata, check to see if the allow_duplicates flag was set to true
-                            if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
-                                display.debug("'%s' skipped because role has already run" % task)
-                                continue
-
-                        if task.action == 'meta':
-                            self._execute_meta(task, play_context, iterator)
-                            self._blocked_hosts[host_name] = False
-                        else:
-                            # handle step if needed, skip meta actions as they are used internally
-                            if not self._step or self._take_step(task, host_name):
-                                if task.any_errors_fatal:
-                                    display.warning("Using any_errors_fatal with the free strategy is not supported, as tasks are executed independently on each host")
-                                self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
-                                self._queue_task(host, task, task_vars, play_context)
+                        "%s is restricted, skipping" % host_name)
+                    continue
+
+                if not task:
+                    display.debug("%s has no more tasks" % host_name)
+                    continue
+
+                display.debug("this host has work to do")
+                dispatched = True
+
+                # pop the task, mark the host blocked, and queue it
+                self._blocked_hosts[host_name] = True
+                (state, task) = iterator.get_next_task_for_host(host)
+
+                try:
+                    action = action_loader.get(task.action, class_only=True)
+                except KeyError:
+                    # we don't care here, because the action may simply not have a
+                    # corresponding action plugin
+                    action = None
+
+                display.debug("getting variables")
+                task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, host=host, task=task)
+                self.add_tqm_variables(task_vars, play=iterator._play)
+                templar = Templar(loader=self._loader, variables=task_vars)
+                display.debug("done getting variables")
+
+                run_once = templar.template(task.run_once) or action and getattr(action, 'BYPASS_HOST_LOOP', False)
+                if run_once:
+                    if action and getattr(action, 'BYPASS_HOST_LOOP', False):
+                        raise AnsibleError("The '%s' module bypasses the host loop, which is currently not supported in the free strategy " \
+                                           "and would instead execute for every host in the inventory list." % task.action, obj=task._ds)
                     else:
-                        display.debug("%s is blocked, skipping for now" % host_name)
-
-                # move on to the next host and make sure we
-                # haven't gone past the end of our hosts list
-                last_host += 1
-                if last_host > len(hosts_left) - 1:
-                    last_host = 0
+                        display.warning("Using run_once with the free strategy is not currently supported. This task will still be " \
+                                        "executed for every host in the inventory list.")
+
+                # check to see if this task should be skipped, due to it being a member of a
+                # role which has already run (and whether that role allows duplicate execution)
+                if task._role and task._role.has_run(host):
+                    # If there is no metadata, the default behavior is to not allow duplicates,
+                    # if there is metadata, check to see if the allow_duplicates flag was set to true
+                    if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
+                        display.debug("'%s' skipped because role has already run" % task)
+                        self._blocked_hosts[host_name] = False
+                        ready_hosts.append(host)
+                        continue
 
-                # if we've looped around back to the start, break out
-                if last_host == starting_host:
-                    break
+                if task.action == 'meta':
+                    self._execute_meta(task, play_context, iterator)
+                    self._blocked_hosts[host_name] = False
+                    # clear_host_errors brings hosts back, and handlers
+                    # unblock those whose results they read
+                    hosts_left = self._get_hosts_left(iterator)
+                    self._requeue_hosts(iterator, ready_hosts)
+                else:
+                    # handle step if needed, skip meta actions as they are used internally
+                    if not self._step or self._take_step(task, host_name):
+                        if task.any_errors_fatal:
+                            display.warning("Using any_errors_fatal with the free strategy is not supported, as tasks are executed independently on each host")
+                        self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+                        self._queue_task(host, task, task_vars, play_context)
+                    else:
+                        self._blocked_hosts[host_name] = False
+                        ready_hosts.append(host)
 
             results = self._process_pending_results(iterator)
-            host_results.extend(results)
+
+            # every host with a result is unblocked again; drop the ones
+            # which failed or became unreachable
+            lost_hosts = False
+            for res in results:
+                host = self._inventory.get_host(res._host.name)
+                if host.name in self._tqm._unreachable_hosts or iterator.is_failed(host):
+                    lost_hosts = True
+                else:
+                    ready_hosts.append(host)
+            if lost_hosts:
+                hosts_left = self._get_hosts_left(iterator)
 
             try:
                 included_files = IncludedFile.process_include_results(
-                    host_results,
+                    results,
                     self._tqm,
                     iterator=iterator,
                     inventory=self._inventory,
@@ -188,8 +228,8 @@ class StrategyModule(StrategyBase):
                         display.warning(str(e))
                         continue
 
+                    task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, task=included_file._task)
                     for new_block in new_blocks:
-                        task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, task=included_file._task)
                         final_block = new_block.filter_tagged_tasks(play_context, task_vars)
                         for host in hosts_left:
                             if host in included_file._hosts:
@@ -201,8 +241,26 @@ class StrategyModule(StrategyBase):
                     iterator.add_tasks(host, all_blocks[host])
                 display.debug("done adding collected blocks to iterator")
 
-            # pause briefly so we don't spin lock
-            time.sleep(0.001)
+            if self._pending_results == 0:
+                if full_pass and not dispatched:
+                    # nothing is running and no host has anything left to do
+                    break
+                # no host is waiting on a result, so the next pass looks at
+                # every one left, including those whose result was read
+                # elsewhere
+                hosts_left = self._get_hosts_left(iterator)
+                self._requeue_hosts(iterator, ready_hosts)
+                full_pass = True
+                continue
+            full_pass = False
+
+            if not dispatched and not results:
+                # every host with work is waiting on a worker, so sleep
+                # until one of them reports back
+                self._wait_for_results()
+
+        # collect any results still outstanding
+        self._wait_on_pending_results(iterator)
 
         # run the base class run() method, which executes the cleanup function
         # and runs any outstanding handlers which have been triggered
@@ -19,17 +19,21 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import time
+
+from ansible import constants as C
 from ansible.compat.six import iteritems, text_type
 
 from ansible.errors import AnsibleError
 from ansible.executor.play_iterator import PlayIterator
 from ansible.playbook.block import Block
 from ansible.playbook.included_file import IncludedFile
-from ansible.playbook.task import Task
-from ansible.plugins import action_loader
-from ansible.plugins.strategy import StrategyBase
+from ansible.plugins import action_loader, strategy_loader
 from ansible.template import Templar
 from ansible.utils.unicode import to_unicode
+from ansible.utils.vars import combine_vars
+from ansible.vars import preprocess_vars
+from ansible.vars.unsafe_proxy import wrap_var
 
 try:
     from __main__ import display
@@ -38,7 +42,188 @@ except ImportError:
     display = Display()
 
 
-class StrategyModule(StrategyBase):
+BaseStrategyModule = strategy_loader.get('bb_base', class_only=True)
+
+
+class StrategyModule(BaseStrategyModule):
+
+    def __init__(self, tqm):
+        super(StrategyModule, self).__init__(tqm)
+        # host-independent variable layers per task, see _get_task_vars()
+        self._shared_task_vars = {}
+        self._task_vars_stats = dict(hits=0, misses=0, saved=0.0)
+        # the peeked (state, task) of each host for _get_next_task_lockstep()
+        # and how many hosts wait in each (cur_block, run_state); a host is
+        # only peeked again once something has moved its iterator state
+        self._lockstep_peeks = {}
+        self._lockstep_counts = {}
+
+    def _set_lockstep_peek(self, host_name, state_task):
+        '''
+        Replaces the cached peek for a host, keeping the per (cur_block,
+        run_state) counts in step. A state_task of None forgets the host,
+        so it will be peeked again on the next pass.
+        '''
+        def _count(state_task, delta):
+            (s, t) = state_task
+            if t and s.run_state != PlayIterator.ITERATING_COMPLETE:
+                key = (s.cur_block, s.run_state)
+                self._lockstep_counts[key] = self._lockstep_counts.get(key, 0) + delta
+
+        old_state_task = self._lockstep_peeks.pop(host_name, None)
+        if old_state_task is not None:
+            _count(old_state_task, -1)
+        if state_task is not None:
+            self._lockstep_peeks[host_name] = state_task
+            _count(state_task, 1)
+
+    def _invalidate_lockstep(self, host_names=None):
+        '''
+        Forgets the cached peeks for the given hosts, or for all hosts, after
+        their iterator state was changed by something other than
+        _get_next_task_lockstep() (results, includes, failures, meta tasks).
+        '''
+        if host_names is None:
+            self._lockstep_peeks = {}
+            self._lockstep_counts = {}
+            return
+        for name in host_names:
+            self._set_lockstep_peek(name, None)
+
+    def _get_shared_task_vars(self, play, task):
+        '''
+        Returns the host-independent layers of VariableManager.get_vars()
+        for the given task: role defaults, play/role/task vars, role and
+        include params and the magic variables which do not depend on the
+        host. These are computed for the first host to run the task and
+        reused for every other host.
+        '''
+        shared = self._shared_task_vars.get(id(task))
+        if shared is not None and shared['task'] is task:
+            self._task_vars_stats['hits'] += 1
+            self._task_vars_stats['saved'] += shared['cost']
+            return shared
+
+        start = time.time()
+        vm = self._variable_manager
+
+        dep_chain = []
+        if task._block:
+            dep_chain = task._block.get_dep_chain()
+
+        defaults = dict()
+        for role in play.get_roles():
+            defaults = combine_vars(defaults, role.get_default_vars())
+        if task._role is not None:
+            defaults = combine_vars(defaults, task._role.get_default_vars(dep_chain=dep_chain))
+
+        # these are merged one at a time per host, rather than folded into a
+        # single dict here, as merge_hash is not associative
+        play_vars = [play.get_vars()]
+        if not C.DEFAULT_PRIVATE_ROLE_VARS:
+            for role in play.get_roles():
+                play_vars.append(role.get_vars(include_params=False))
+        if task._role:
+            play_vars.append(task._role.get_vars(dep_chain=dep_chain, include_params=False))
+        play_vars.append(task.get_vars())
+
+        params = []
+        if task._role:
+            params.append(task._role.get_role_params(dep_chain=dep_chain))
+        params.append(task.get_include_params())
+        params.append(vm._extra_vars)
+
+        magic = vm._get_magic_variables(
+            loader=self._loader,
+            play=play,
+            host=None,
+            task=task,
+            include_hostvars=True,
+            include_delegate_to=True,
+        )
+        groups = dict()
+        if self._inventory is not None:
+            for (group_name, group) in iteritems(self._inventory.groups):
+                groups[group_name] = [h.name for h in group.get_hosts()]
+
+        shared = dict(
+            task=task,
+            defaults=defaults,
+            play_vars=play_vars,
+            params=params,
+            magic=magic,
+            groups=groups,
+            cost=time.time() - start,
+        )
+        self._shared_task_vars[id(task)] = shared
+        self._task_vars_stats['misses'] += 1
+        return shared
+
+    def _get_task_vars(self, play, host, task):
+        '''
+        Equivalent to VariableManager.get_vars(play=play, host=host, task=task),
+        but only the host-specific layers (group/host vars, facts, the vars
+        cache and registered facts) are computed per host; everything else
+        comes from _get_shared_task_vars(). Plays with vars_files fall back to
+        get_vars(), since those file names are templated per host.
+        '''
+        vm = self._variable_manager
+        if play.get_vars_files():
+            return vm.get_vars(loader=self._loader, play=play, host=host, task=task)
+
+        shared = self._get_shared_task_vars(play, task)
+        all_vars = shared['defaults']
+
+        if 'all' in vm._group_vars_files:
+            for item in preprocess_vars(vm._group_vars_files['all']):
+                all_vars = combine_vars(all_vars, item)
+
+        all_vars = combine_vars(all_vars, host.get_group_vars())
+
+        for group in sorted(host.get_groups(), key=lambda g: g.depth):
+            if group.name in vm._group_vars_files and group.name != 'all':
+                for data in vm._group_vars_files[group.name]:
+                    for item in preprocess_vars(data):
+                        all_vars = combine_vars(all_vars, item)
+
+        all_vars = combine_vars(all_vars, host.get_vars())
+
+        host_name = host.get_name()
+        if host_name in vm._host_vars_files:
+            for data in vm._host_vars_files[host_name]:
+                for item in preprocess_vars(data):
+                    all_vars = combine_vars(all_vars, item)
+
+        try:
+            all_vars = combine_vars(all_vars, wrap_var(vm._fact_cache.get(host.name, dict())))
+        except KeyError:
+            pass
+
+        for item in shared['play_vars']:
+            all_vars = combine_vars(all_vars, item)
+
+        all_vars = combine_vars(all_vars, vm._vars_cache.get(host_name, dict()))
+        all_vars = combine_vars(all_vars, vm._nonpersistent_fact_cache.get(host.name, dict()))
+
+        for item in shared['params']:
+            all_vars = combine_vars(all_vars, item)
+
+        magic = shared['magic'].copy()
+        magic['group_names'] = sorted([group.name for group in host.get_groups() if group.name != 'all'])
+        if self._inventory is not None:
+            magic['groups'] = shared['groups']
+        all_vars = combine_vars(all_vars, magic)
+
+        if 'environment' not in all_vars:
+            all_vars['environment'] = task.environment
+        else:
+            display.warning("The variable 'environment' appears to be used already, which is also used internally for environment variables set on the task/block/play. You should use a different variable name to avoid conflicts with this internal variable")
+
+        if task.delegate_to is not None:
+            all_vars['ansible_delegated_vars'] = vm._get_delegated_vars(self._loader, play, task, all_vars)
+
+        all_vars['vars'] = all_vars.copy()
+        return all_vars
 
     def _get_next_task_lockstep(self, hosts, iterator):
         '''
@@ -47,55 +232,38 @@ class StrategyModule(StrategyBase):
         all hosts.
         '''
 
-        noop_task = Task()
-        noop_task.action = 'meta'
-        noop_task.args['_raw_params'] = 'noop'
-        noop_task.set_loader(iterator._play._loader)
+        noop_task = self._get_noop_task(iterator)
 
-        host_tasks = {}
         display.debug("building list of next tasks for hosts")
+        host_tasks = self._lockstep_peeks
+        current = set()
         for host in hosts:
+            current.add(host.name)
+            if host.name in host_tasks:
+                continue
             if (host not in self._inventory._restriction and
                     iterator._host_states[host.name].run_state is not
                     PlayIterator.ITERATING_SETUP):
+                self._set_lockstep_peek(host.name, (None, None))
                 continue
-            host_tasks[host.name] = iterator.get_next_task_for_host(host, peek=True)
+            self._set_lockstep_peek(host.name, iterator.get_next_task_for_host(host, peek=True))
+        for name in set(host_tasks).difference(current):
+            self._set_lockstep_peek(name, None)
         display.debug("done building task lists")
 
-        num_setups = 0
-        num_tasks  = 0
-        num_rescue = 0
-        num_always = 0
-
         display.debug("counting tasks in each state of execution")
-        host_tasks_to_run = [(host, state_task)
-                             for host, state_task in iteritems(host_tasks)
-                             if state_task and state_task[1]]
-
-        if host_tasks_to_run:
-            lowest_cur_block = min(
-                (s.cur_block for h, (s, t) in host_tasks_to_run
-                if s.run_state != PlayIterator.ITERATING_COMPLETE))
+        waiting = [key for key, count in iteritems(self._lockstep_counts) if count]
+        if waiting:
+            lowest_cur_block = min(cur_block for (cur_block, run_state) in waiting)
         else:
-            # empty host_tasks_to_run will just run till the end of the function
+            # nothing to run will just run till the end of the function
             # without ever touching lowest_cur_block
             lowest_cur_block = None
 
-        for (k, v) in host_tasks_to_run:
-            (s, t) = v
-
-            if s.cur_block > lowest_cur_block:
-                # Not the current block, ignore it
-                continue
-
-            if s.run_state == PlayIterator.ITERATING_SETUP:
-                num_setups += 1
-            elif s.run_state == PlayIterator.ITERATING_TASKS:
-                num_tasks += 1
-            elif s.run_state == PlayIterator.ITERATING_RESCUE:
-                num_rescue += 1
-            elif s.run_state == PlayIterator.ITERATING_ALWAYS:
-                num_always += 1
+        num_setups = self._lockstep_counts.get((lowest_cur_block, PlayIterator.ITERATING_SETUP), 0)
+        num_tasks  = self._lockstep_counts.get((lowest_cur_block, PlayIterator.ITERATING_TASKS), 0)
+        num_rescue = self._lockstep_counts.get((lowest_cur_block, PlayIterator.ITERATING_RESCUE), 0)
+        num_always = self._lockstep_counts.get((lowest_cur_block, PlayIterator.ITERATING_ALWAYS), 0)
         display.debug("done counting tasks in each state of execution")
 
         def _advance_selected_hosts(hosts, cur_block, cur_state):
@@ -118,6 +286,7 @@ class StrategyModule(StrategyBase):
                     continue
                 if s.run_state == cur_state and s.cur_block == cur_block:
                     new_t = iterator.get_next_task_for_host(host)
+                    self._set_lockstep_peek(host.name, None)
                     rvals.append((host, t))
                 else:
                     rvals.append((host, noop_task))
@@ -153,231 +322,269 @@ class StrategyModule(StrategyBase):
         display.debug("all hosts are done, so returning None's for all hosts")
         return [(host, None) for host in hosts]
 
-    def run(self, iterator, play_context):
+    def _get_hosts_left(self, iterator):
+        return [
+            host for host in self._inventory.get_hosts(
+                iterator._play.hosts,
+                ignore_limits_and_restrictions=True
+            ) if host.name not in self._tqm._unreachable_hosts and
+            not iterator.is_failed(host)
+        ]
+
+    def _run_lockstep_pass(self, iterator, play_context, hosts_left):
         '''
-        The linear strategy is simple - get the next task and queue
-        it for all hosts, then wait for the queue to drain before
-        moving on to the next task
+        Queues the next task in lock step for every host in hosts_left, waits
+        for all of the results and then processes any included files and
+        any_errors_fatal. Returns a (work_to_do, result) tuple; result is
+        False if the play ran out of hosts and None if it must be aborted.
         '''
 
-        # iteratate over each task, while there is one left to run
-        result     = True
-        work_to_do = True
-        while work_to_do and not self._tqm._terminated:
-
-            try:
-                display.debug("getting the remaining hosts for this loop")
-                hosts_left = [
-                    host for host in self._inventory.get_hosts(
-                        iterator._play.hosts,
-                        ignore_limits_and_restrictions=True
-                    ) if host.name not in self._tqm._unreachable_hosts and
-                    not iterator.is_failed(host)
-                ]
-                display.debug("done getting the remaining hosts for this loop")
+        # queue up this task for each host in the inventory
+        callback_sent = False
+        work_to_do = False
 
-                # queue up this task for each host in the inventory
-                callback_sent = False
-                work_to_do = False
+        host_results = []
+        host_tasks = self._get_next_task_lockstep(hosts_left, iterator)
 
-                host_results = []
-                host_tasks = self._get_next_task_lockstep(hosts_left, iterator)
+        # skip control
+        skip_rest   = False
+        choose_step = True
 
-                # skip control
-                skip_rest   = False
-                choose_step = True
+        # flag set if task is set to any_errors_fatal
+        any_errors_fatal = False
 
-                # flag set if task is set to any_errors_fatal
-                any_errors_fatal = False
+        results = []
+        for (host, task) in host_tasks:
+            if not task:
+                continue
 
-                results = []
-                for (host, task) in host_tasks:
-                    if not task:
-                        continue
+            if self._tqm._terminated:
+                break
 
-                    if self._tqm._terminated:
-                        break
+            run_once = False
+            work_to_do = True
 
-                    run_once = False
-                    work_to_do = True
+            # test to see if the task across all hosts points to an action plugin which
+            # sets BYPASS_HOST_LOOP to true, or if it has run_once enabled. If so, we
+            # will only send this task to the first host in the list.
 
-                    # test to see if the task across all hosts points to an action plugin which
-                    # sets BYPASS_HOST_LOOP to true, or if it has run_once enabled. If so, we
-                    # will only send this task to the first host in the list.
+            try:
+                action = action_loader.get(task.action, class_only=True)
+            except KeyError:
+                # we don't care here, because the action may simply not have a
+                # corresponding action plugin
+                action = None
+
+            # check to see if this task should be skipped, due to it being a member of a
+            # role which has already run (and whether that role allows duplicate execution)
+            if task._role and task._role.has_run(host):
+                # If there is no metadata, the default behavior is to not allow duplicates,
+                # if there is metadata, check to see if the allow_duplicates flag was set to true
+                if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
+                    display.debug("'%s' skipped because role has already run" % task)
+                    continue
 
-                    try:
-                        action = action_loader.get(task.action, class_only=True)
-                    except KeyError:
-                        # we don't care here, because the action may simply not have a
-                        # corresponding action plugin
-                        action = None
-
-                    # check to see if this task should be skipped, due to it being a member of a
-                    # role which has already run (and whether that role allows duplicate execution)
-                    if task._role and task._role.has_run(host):
-                        # If there is no metadata, the default behavior is to not allow duplicates,
-                        # if there is metadata, check to see if the allow_duplicates flag was set to true
-                        if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
-                            display.debug("'%s' skipped because role has already run" % task)
-                            continue
-
-                    if task.action == 'meta':
-                        self._execute_meta(task, play_context, iterator)
+            if task.action == 'meta':
+                self._execute_meta(task, play_context, iterator)
+                if task.args.get('_raw_params') != 'noop':
+                    self._invalidate_lockstep()
+            else:
+                # handle step if needed, skip meta actions as they are used internally
+                if self._step and choose_step:
+                    if self._take_step(task):
+                        choose_step = False
                     else:
-                        # handle step if needed, skip meta actions as they are used internally
-                        if self._step and choose_step:
-                            if self._take_step(task):
-                                choose_step = False
-                            else:
-                                skip_rest = True
-                                break
-
-                        display.debug("getting variables")
-                        task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, host=host, task=task)
-                        self.add_tqm_variables(task_vars, play=iterator._play)
-                        templar = Templar(loader=self._loader, variables=task_vars)
-                        display.debug("done getting variables")
-
-                        run_once = templar.template(task.run_once) or action and getattr(action, 'BYPASS_HOST_LOOP', False)
-
-                        if task.any_errors_fatal or run_once:
-                            any_errors_fatal = True
-
-                        if not callback_sent:
-                            display.debug("sending task start callback, copying the task so we can template it temporarily")
-                            saved_name = task.name
-                            display.debug("done copying, going to template now")
-                            try:
-                                task.name = text_type(templar.template(task.name, fail_on_undefined=False))
-                                display.debug("done templating")
-                            except:
-                                # just ignore any errors during task name templating,
-                                # we don't care if it just shows the raw name
-                                display.debug("templating failed for some reason")
-                                pass
-                            display.debug("here goes the callback...")
-                            self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
-                            task.name = saved_name
-                            callback_sent = True
-                            display.debug("sending task start callback")
-
-                        self._blocked_hosts[host.get_name()] = True
-                        self._queue_task(host, task, task_vars, play_context)
-
-                    # if we're bypassing the host loop, break out now
-                    if run_once:
+                        skip_rest = True
                         break
 
-                    results += self._process_pending_results(iterator, one_pass=True)
+                display.debug("getting variables")
+                task_vars = self._get_task_vars(iterator._play, host, task)
+                self.add_tqm_variables(task_vars, play=iterator._play)
+                templar = Templar(loader=self._loader, variables=task_vars)
+                display.debug("done getting variables")
 
-                # go to next host/task group
-                if skip_rest:
-                    continue
-
-                display.debug("done queuing things up, now waiting for results queue to drain")
-                results += self._wait_on_pending_results(iterator)
-                host_results.extend(results)
+                run_once = templar.template(task.run_once) or action and getattr(action, 'BYPASS_HOST_LOOP', False)
 
-                if not work_to_do and len(iterator.get_failed_hosts()) > 0:
-                    display.debug("out of hosts to run on")
-                    self._tqm.send_callback('v2_playbook_on_no_hosts_remaining')
-                    result = False
-                    break
+                if task.any_errors_fatal or run_once:
+                    any_errors_fatal = True
 
+                if not callback_sent:
+                    display.debug("sending task start callback, copying the task so we can template it temporarily")
+                    saved_name = task.name
+                    display.debug("done copying, going to template now")
+                    try:
+                        task.name = text_type(templar.template(task.name, fail_on_undefined=False))
+                        display.debug("done templating")
+                    except:
+                        # just ignore any errors during task name templating,
+                        # we don't care if it just shows the raw name
+                        display.debug("templating failed for some reason")
+                        pass
+                    display.debug("here goes the callback...")
+                    self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+                    task.name = saved_name
+                    callback_sent = True
+                    display.debug("sending task start callback")
+
+                self._blocked_hosts[host.get_name()] = True
+                self._queue_task(host, task, task_vars, play_context)
+
+            # if we're bypassing the host loop, break out now
+            if run_once:
+                break
+
+            results += self._process_pending_results(iterator, one_pass=True)
+
+        # go to next host/task group
+        if skip_rest:
+            return True, True
+
+        display.debug("done queuing things up, now waiting for results queue to drain")
+        results += self._wait_on_pending_results(iterator)
+        host_results.extend(results)
+
+        # a failure may move other hosts too (run_once), so only a clean
+        # set of results lets us keep the other hosts' cached peeks
+        if any(res.is_failed() or res.is_unreachable() for res in results):
+            self._invalidate_lockstep()
+        else:
+            self._invalidate_lockstep(res._host.name for res in results)
+
+        if not work_to_do and len(iterator.get_failed_hosts()) > 0:
+            display.debug("out of hosts to run on")
+            self._tqm.send_callback('v2_playbook_on_no_hosts_remaining')
+            return False, False
+
+        try:
+            included_files = IncludedFile.process_include_results(
+                host_results,
+                self._tqm,
+                iterator=iterator,
+                inventory=self._inventory,
+                loader=self._loader,
+                variable_manager=self._variable_manager
+            )
+        except AnsibleError as e:
+            return False, None
+
+        include_failure = False
+        if len(included_files) > 0:
+            display.debug("we have included files to process")
+            noop_task = self._get_noop_task(iterator)
+
+            display.debug("generating all_blocks data")
+            all_blocks = dict((host, []) for host in hosts_left)
+            display.debug("done generating all_blocks data")
+            for included_file in included_files:
+                display.debug("processing included file: %s" % included_file._filename)
+                # included hosts get the task list while those excluded get an equal-length
+                # list of noop tasks, to make sure that they continue running in lock-step
                 try:
-                    included_files = IncludedFile.process_include_results(
-                        host_results,
-                        self._tqm,
-                        iterator=iterator,
-                        inventory=self._inventory,
+                    new_blocks = self._load_included_file(included_file, iterator=iterator)
+
+                    # the vars used to filter on tags are the same
+                    # for every block of this include
+                    task_vars = self._variable_manager.get_vars(
                         loader=self._loader,
-                        variable_manager=self._variable_manager
+                        play=iterator._play,
+                        task=included_file._task,
                     )
+
+                    display.debug("iterating over new_blocks loaded from include file")
+                    for new_block in new_blocks:
+                        display.debug("filtering new block on tags")
+                        final_block = new_block.filter_tagged_tasks(play_context, task_vars)
+                        display.debug("done filtering new block on tags")
+
+                        noop_block = Block(parent_block=task._block)
+                        noop_block.block  = [noop_task for t in new_block.block]
+                        noop_block.always = [noop_task for t in new_block.always]
+                        noop_block.rescue = [noop_task for t in new_block.rescue]
+
+                        for host in hosts_left:
+                            if host in included_file._hosts:
+                                all_blocks[host].append(final_block)
+                            else:
+                                all_blocks[host].append(noop_block)
+                    display.debug("done iterating over new_blocks loaded from include file")
+
                 except AnsibleError as e:
-                    return False
+                    for host in included_file._hosts:
+                        self._tqm._failed_hosts[host.name] = True
+                        iterator.mark_host_failed(host)
+                    display.error(to_unicode(e), wrap_text=False)
+                    include_failure = True
+                    continue
+
+            # finally go through all of the hosts and append the
+            # accumulated blocks to their list of tasks
+            display.debug("extending task lists for all hosts with included blocks")
+
+            for host in hosts_left:
+                iterator.add_tasks(host, all_blocks[host])
+            self._invalidate_lockstep()
+
+            display.debug("done extending task lists")
+            display.debug("done processing included files")
+
+        display.debug("results queue empty")
 
-                include_failure = False
-                if len(included_files) > 0:
-                    display.debug("we have included files to process")
-                    noop_task = Task()
-                    noop_task.action = 'meta'
-                    noop_task.args['_raw_params'] = 'noop'
-                    noop_task.set_loader(iterator._play._loader)
-
-                    display.debug("generating all_blocks data")
-                    all_blocks = dict((host, []) for host in hosts_left)
-                    display.debug("done generating all_blocks data")
-                    for included_file in included_files:
-                        display.debug("processing included file: %s" % included_file._filename)
-                        # included hosts get the task list while those excluded get an equal-length
-                        # list of noop tasks, to make sure that they continue running in lock-step
-                        try:
-                            new_blocks = self._load_included_file(included_file, iterator=iterator)
-
-                            display.debug("iterating over new_blocks loaded from include file")
-                            for new_block in new_blocks:
-                                task_vars = self._variable_manager.get_vars(
-                                    loader=self._loader,
-                                    play=iterator._play,
-                                    task=included_file._task,
-                                )
-                                display.debug("filtering new block on tags")
-                                final_block = new_block.filter_tagged_tasks(play_context, task_vars)
-                                display.debug("done filtering new block on tags")
-
-                                noop_block = Block(parent_block=task._block)
-                                noop_block.block  = [noop_task for t in new_block.block]
-                                noop_block.always = [noop_task for t in new_block.always]
-                                noop_block.rescue = [noop_task for t in new_block.rescue]
-
-                                for host in hosts_left:
-                                    if host in included_file._hosts:
-                                        all_blocks[host].append(final_block)
-                                    else:
-                                        all_blocks[host].append(noop_block)
-                            display.debug("done iterating over new_blocks loaded from include file")
-
-                        except AnsibleError as e:
-                            for host in included_file._hosts:
-                                self._tqm._failed_hosts[host.name] = True
-                                iterator.mark_host_failed(host)
-                            display.error(to_unicode(e), wrap_text=False)
-                            include_failure = True
-                            continue
-
-                    # finally go through all of the hosts and append the
-                    # accumulated blocks to their list of tasks
-                    display.debug("extending task lists for all hosts with included blocks")
-
-                    for host in hosts_left:
-                        iterator.add_tasks(host, all_blocks[host])
-
-                    display.debug("done extending task lists")
-                    display.debug("done processing included files")
-
-                display.debug("results queue empty")
-
-                display.debug("checking for any_errors_fatal")
-                failed_hosts = []
-                for res in results:
-                    if res.is_failed() or res.is_unreachable():
-                        failed_hosts.append(res._host.name)
-
-                # if any_errors_fatal and we had an error, mark all hosts as failed
-                if any_errors_fatal and len(failed_hosts) > 0:
-                    for host in hosts_left:
-                        # don't double-mark hosts, or the iterator will potentially
-                        # fail them out of the rescue/always states
-                        if host.name not in failed_hosts:
-                            self._tqm._failed_hosts[host.name] = True
-                            iterator.mark_host_failed(host)
-                display.debug("done checking for any_errors_fatal")
+        display.debug("checking for any_errors_fatal")
+        failed_hosts = []
+        for res in results:
+            if res.is_failed() or res.is_unreachable():
+                failed_hosts.append(res._host.name)
+
+        # if any_errors_fatal and we had an error, mark all hosts as failed
+        if any_errors_fatal and len(failed_hosts) > 0:
+            for host in hosts_left:
+                # don't double-mark hosts, or the iterator will potentially
+                # fail them out of the rescue/always states
+                if host.name not in failed_hosts:
+                    self._tqm._failed_hosts[host.name] = True
+                    iterator.mark_host_failed(host)
+            self._invalidate_lockstep()
+        display.debug("done checking for any_errors_fatal")
+
+        return work_to_do, True
+
+    def run(self, iterator, play_context):
+        '''
+        The linear strategy is simple - get the next task and queue
+        it for all hosts, then wait for the queue to drain before
+        moving on to the next task
+        '''
+
+        self._prewarm_connections(iterator, play_context, self._get_play_hosts(iterator))
+        self._preflight(iterator, play_context, self._get_play_hosts(iterator))
+        self._refresh_facts(iterator, play_context, self._get_play_hosts(iterator))
+
+        # iteratate over each task, while there is one left to run
+        result     = True
+        work_to_do = True
+        while work_to_do and not self._tqm._terminated:
+
+            try:
+                display.debug("getting the remaining hosts for this loop")
+                hosts_left = self._get_hosts_left(iterator)
+                display.debug("done getting the remaining hosts for this loop")
+
+                work_to_do, result = self._run_lockstep_pass(iterator, play_context, hosts_left)
+                if result is None:
+                    return False
+                if not result:
+                    break
 
             except (IOError, EOFError) as e:
                 display.debug("got IOError/EOFError in task loop: %s" % e)
                 # most likely an abort, return failed
                 return False
 
+        stats = self._task_vars_stats
+        display.debug("task vars cache: %d hits, %d misses, ~%.3fs of get_vars saved" %
+                      (stats['hits'], stats['misses'], stats['saved']))
+        self._shared_task_vars = {}
+
         # run the base class run() method, which executes the cleanup function
         # and runs any outstanding handlers which have been triggered
 
@@ -0,0 +1,220 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from ansible.compat.six import text_type
+from ansible.constants import DEFAULTS, get_config, load_config_file
+from ansible.executor.play_iterator import PlayIterator
+from ansible.plugins import action_loader, strategy_loader
+from ansible.template import Templar
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+LinearStrategyModule = strategy_loader.get('bb_linear', class_only=True)
+
+# Actions which change state shared between hosts, so every host has to
+# reach them together.
+BARRIER_ACTIONS = frozenset(['meta', 'include', 'include_role', 'group_by', 'add_host'])
+
+
+def _get_window_size():
+    p, cfg_path = load_config_file()
+    return get_config(p, DEFAULTS, 'strategy_window', 'ANSIBLE_STRATEGY_WINDOW',
+                      3, integer=True)
+
+
+class StrategyModule(LinearStrategyModule):
+    '''
+    A pipelined version of bb_linear: within a block, a host which has
+    finished its task may start the next one while slower hosts are still
+    busy, as long as it stays at most ``strategy_window`` tasks ahead of the
+    slowest host (ANSIBLE_STRATEGY_WINDOW, default 3).
+
+    Hosts still meet in lock step, exactly as with bb_linear, at includes,
+    meta tasks (flush_handlers and friends), group_by/add_host, run_once and
+    any_errors_fatal tasks, and at block and rescue/always boundaries.
+    Handlers run at the end of the play as usual. Plays using serial, and
+    runs using --step, are handled entirely by bb_linear.
+    '''
+
+    def __init__(self, tqm):
+        super(StrategyModule, self).__init__(tqm)
+        self._window = _get_window_size()
+        # tasks queued per host since the last lock step pass
+        self._window_pos = {}
+        # block of the task each host is currently running in the window
+        self._window_block = {}
+        self._window_started = set()
+
+    def _is_barrier(self, task):
+        if task.action in BARRIER_ACTIONS:
+            return True
+        if task.run_once or task.any_errors_fatal:
+            return True
+        try:
+            action = action_loader.get(task.action, class_only=True)
+        except KeyError:
+            action = None
+        return bool(action and getattr(action, 'BYPASS_HOST_LOOP', False))
+
+    def _queue_windowed_task(self, iterator, play_context, host):
+        '''
+        Pops the next task for the host and queues it, as bb_linear would
+        for a single host.
+        '''
+        (state, task) = iterator.get_next_task_for_host(host)
+        self._window_pos[host.name] = self._window_pos.get(host.name, 0) + 1
+
+        if task._role and task._role.has_run(host):
+            if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
+                display.debug("'%s' skipped because role has already run" % task)
+                return
+
+        display.debug("getting variables")
+        task_vars = self._get_task_vars(iterator._play, host, task)
+        self.add_tqm_variables(task_vars, play=iterator._play)
+        display.debug("done getting variables")
+
+        if task._uuid not in self._window_started:
+            saved_name = task.name
+            try:
+                templar = Templar(loader=self._loader, variables=task_vars)
+                task.name = text_type(templar.template(task.name, fail_on_undefined=False))
+            except:
+                # just ignore any errors during task name templating,
+                # we don't care if it just shows the raw name
+                display.debug("templating failed for some reason")
+            self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+            task.name = saved_name
+            self._window_started.add(task._uuid)
+
+        self._window_block[host.name] = state.cur_block
+        self._blocked_hosts[host.name] = True
+        self._queue_task(host, task, task_vars, play_context)
+
+    def _advance_window(self, iterator, play_context, hosts_left):
+        '''
+        Queues the next task for every idle host which may run ahead.
+        Returns the number of tasks taken off the iterator.
+        '''
+        idle = []
+        blocks = []
+        for host in hosts_left:
+            if self._blocked_hosts.get(host.name, False):
+                blocks.append(self._window_block[host.name])
+                continue
+            if (host not in self._inventory._restriction and
+                    iterator._host_states[host.name].run_state is not
+                    PlayIterator.ITERATING_SETUP):
+                continue
+            (state, task) = iterator.get_next_task_for_host(host, peek=True)
+            if task is None or state.run_state == PlayIterator.ITERATING_COMPLETE:
+                continue
+            blocks.append(state.cur_block)
+            idle.append((host, state, task))
+
+        if not blocks:
+            return 0
+        lowest_cur_block = min(blocks)
+
+        # hosts still working through the current stretch of the block; a
+        # host that reached a barrier no longer holds the others back
+        candidates = [
+            host for (host, state, task) in idle
+            if state.run_state == PlayIterator.ITERATING_TASKS and
+            state.cur_block == lowest_cur_block and
+            not self._is_barrier(task)
+        ]
+        positions = [self._window_pos.get(h.name, 0) for h in candidates]
+        positions += [
+            self._window_pos.get(h.name, 0) for h in hosts_left
+            if self._blocked_hosts.get(h.name, False)
+        ]
+        if not positions:
+            return 0
+        slowest = min(positions)
+
+        queued = 0
+        for host in candidates:
+            if self._tqm._terminated:
+                break
+            if self._window_pos.get(host.name, 0) - slowest >= self._window:
+                continue
+            self._queue_windowed_task(iterator, play_context, host)
+            queued += 1
+        return queued
+
+    def run(self, iterator, play_context):
+        '''
+        Runs tasks within the window while it can, and falls back to a
+        bb_linear lock step pass whenever every host is idle and none of
+        them may run ahead.
+        '''
+        play = iterator._play
+        if play.serial or self._step or self._window < 1:
+            display.debug("running play in lock step")
+            return super(StrategyModule, self).run(iterator, play_context)
+
+        self._prewarm_connections(iterator, play_context, self._get_play_hosts(iterator))
+        self._preflight(iterator, play_context, self._get_play_hosts(iterator))
+        self._refresh_facts(iterator, play_context, self._get_play_hosts(iterator))
+
+        result = True
+        while not self._tqm._terminated:
+
+            try:
+                hosts_left = self._get_hosts_left(iterator)
+
+                queued = self._advance_window(iterator, play_context, hosts_left)
+                results = self._process_pending_results(iterator)
+                if queued or results:
+                    continue
+
+                if self._pending_results > 0:
+                    # every host that may run ahead is busy, or waiting
+                    # on a slower host that is
+                    self._wait_for_results()
+                    continue
+
+                display.debug("window drained, running a lock step pass")
+                self._window_pos = {}
+                self._window_block = {}
+                self._invalidate_lockstep()
+                work_to_do, result = self._run_lockstep_pass(iterator, play_context, hosts_left)
+                if result is None:
+                    return False
+                if not result or not work_to_do:
+                    break
+
+            except (IOError, EOFError) as e:
+                display.debug("got IOError/EOFError in task loop: %s" % e)
+                # most likely an abort, return failed
+                return False
+
+        stats = self._task_vars_stats
+        display.debug("task vars cache: %d hits, %d misses, ~%.3fs of get_vars saved" %
+                      (stats['hits'], stats['misses'], stats['saved']))
+        self._shared_task_vars = {}
+
+        # skip bb_linear's run(), which would try to run the play again, and
+        # go straight to the base class to run any outstanding handlers
+        return super(LinearStrategyModule, self).run(iterator, play_context, result)
@@ -20,15 +20,66 @@ import yaml
 
 from ansible.constants import DEFAULTS, get_config, load_config_file
 
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Parsed defaults files, shared by every VarsModule in this process and keyed
+# by (realpath, mtime, size) so an edited file is picked up on the next run().
+_DEFAULTS_CACHE = {}
+_DEFAULTS_STATS = {'parses': 0, 'hits': 0}
+
 
 def deep_update_dict(d, u):
+    '''
+    Merges u into d and returns the result, with values from u taking
+    precedence. d is never modified: only the nested dicts on the path to an
+    updated key are shallow-copied, and every untouched subtree is shared
+    with d. Merging the cached defaults for many hosts therefore costs
+    memory in proportion to each host's own vars rather than to the size of
+    the defaults tree.
+
+    The result is a plain dict on purpose; ansible's Templar only recurses
+    into real dicts, so a lazy Mapping overlay would leave nested values
+    untemplated.
+    '''
+    r = dict(d)
     for k, v in u.iteritems():
         if isinstance(v, collections.Mapping):
-            r = deep_update_dict(d.get(k, {}), v)
-            d[k] = r
+            sub = d.get(k, {})
+            if sub is v:
+                continue
+            if not isinstance(sub, collections.Mapping):
+                sub = {}
+            r[k] = deep_update_dict(sub, v)
         else:
-            d[k] = u[k]
-    return d
+            r[k] = u[k]
+    return r
+
+
+def load_defaults(defaults_path):
+    '''
+    Returns the parsed contents of defaults_path, parsing the file only when
+    it has not been seen before or its mtime/size changed. Callers must treat
+    the result as read-only since it is shared across hosts.
+    '''
+    path = os.path.realpath(defaults_path)
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    if key in _DEFAULTS_CACHE:
+        _DEFAULTS_STATS['hits'] += 1
+    else:
+        with open(path) as fh:
+            data = yaml.safe_load(fh)
+        for stale in [k for k in _DEFAULTS_CACHE if k[0] == path]:
+            del _DEFAULTS_CACHE[stale]
+        _DEFAULTS_CACHE[key] = data
+        _DEFAULTS_STATS['parses'] += 1
+    display.debug("default_vars: %s (parses: %d, cache hits: %d)" %
+                  (path, _DEFAULTS_STATS['parses'], _DEFAULTS_STATS['hits']))
+    return _DEFAULTS_CACHE[key]
 
 
 class VarsModule(object):
@@ -36,19 +87,25 @@ class VarsModule(object):
     def __init__(self, inventory):
         self.inventory = inventory
         self.inventory_basedir = inventory.basedir()
+        self._defaults_file = None
+
+    def _get_defaults_file(self):
+        if self._defaults_file is None:
+            p, cfg_path = load_config_file()
+            self._defaults_file = get_config(p, DEFAULTS, 'var_defaults_file',
+                                             'ANSIBLE_VAR_DEFAULTS_FILE',
+                                             None) or ''
+        return self._defaults_file
 
     def _get_defaults(self):
-        p, cfg_path = load_config_file()
-        defaults_file = get_config(p, DEFAULTS, 'var_defaults_file',
-                                   'ANSIBLE_VAR_DEFAULTS_FILE', None)
+        defaults_file = self._get_defaults_file()
         if not defaults_file:
             return None
 
         ursula_env = os.environ.get('URSULA_ENV', '')
         defaults_path = os.path.join(ursula_env, defaults_file)
         if os.path.exists(defaults_path):
-            with open(defaults_path) as fh:
-                return yaml.safe_load(fh)
+            return load_defaults(defaults_path)
         print "could not find defaults: %s" % defaults_path
         return None
 
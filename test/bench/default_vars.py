@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Compares peak RSS and wall time of merging the example defaults file into
+# the vars of many synthetic hosts, the way plugins/vars/default_vars.py
+# does on every VarsModule.run().
+#
+#   "copy": the old behaviour, a full private copy of the defaults per host
+#           (equivalent to re-parsing the YAML) merged in place.
+#   "share": the cached defaults merged with copy-on-write deep_update_dict.
+#
+# Usage: test/bench/default_vars.py [--hosts N] [copy|share]
+# With no mode, both are run in separate processes so ru_maxrss is per mode.
+
+import argparse
+import collections
+import copy
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, os.path.join(ROOT, 'plugins', 'vars'))
+
+import default_vars  # noqa
+
+DEFAULTS = os.path.join(ROOT, 'envs', 'example', 'defaults-2.0.yml')
+
+
+def legacy_update(d, u):
+    for k, v in u.iteritems():
+        if isinstance(v, collections.Mapping):
+            d[k] = legacy_update(d.get(k, {}), v)
+        else:
+            d[k] = u[k]
+    return d
+
+
+def host_vars(i):
+    return {
+        'inventory_hostname': 'host%04d' % i,
+        'ansible_ssh_host': '10.0.%d.%d' % (i // 250, i % 250),
+        'primary_interface': 'ansible_eth%d' % (i % 2),
+        'secrets': {'db_password': 'pw%d' % i},
+        'nova': {'reserved_host_disk_mb': i},
+        'neutron': {'bridge_mappings': 'external:br-ex%d' % (i % 4)},
+    }
+
+
+def run(mode, hosts):
+    defaults = default_vars.load_defaults(DEFAULTS)
+    merged = []
+    start = time.time()
+    for i in range(hosts):
+        if mode == 'copy':
+            merged.append(legacy_update(copy.deepcopy(defaults),
+                                        host_vars(i)))
+        else:
+            merged.append(default_vars.deep_update_dict(defaults,
+                                                        host_vars(i)))
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%-6s hosts=%d wall=%.3fs peak_rss=%dKB" % (mode, hosts, elapsed,
+                                                      rss)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('mode', nargs='?', choices=['copy', 'share'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.hosts)
+        return
+    for mode in ('copy', 'share'):
+        subprocess.check_call([sys.executable, __file__,
+                               '--hosts', str(args.hosts), mode])
+
+
+if __name__ == '__main__':
+    main()
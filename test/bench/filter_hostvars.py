@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Times ursula_memcache_hosts and sensu_dependencies against Ansible's own
+# HostVars for a synthetic inventory (1,000 hosts by default: 3 controllers,
+# 3 db, 1 db_arbiter, the rest compute), the way a template rendering the
+# sensu checks and memcache settings of one host would call them.
+#
+#   "legacy":  the filters as they were, looking up hostvars[host] once per
+#              variable read.
+#   "current": the current plugins/filters, which look each host up once
+#              per call.
+#
+# Nothing is kept between calls: ansible forks a worker per task, so every
+# render starts cold, and each one here costs the same. After the renders,
+# the address of a controller is changed through set_host_facts to check
+# that the next call sees it.
+#
+# Usage: test/bench/filter_hostvars.py [--hosts N] [--renders N] [legacy|current]
+# With no mode, both are run in separate processes.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+# HostVars alone, without this tree's ansible.cfg and vars plugins
+os.environ['ANSIBLE_CONFIG'] = os.devnull
+sys.path.insert(0, os.path.join(ROOT, 'plugins', 'filters'))
+
+import sensu_filters  # noqa
+import ursula_filters  # noqa
+
+CHECKS = [
+    ('keepalive', 'controller,compute'),
+    ('keepalive', 'controller'),
+    ('keepalive', 'db,db_arbiter'),
+]
+
+
+def legacy_controller_ips(hostvars, groups, controller_name='controller'):
+    controller_ips = set()
+    for host in groups[controller_name]:
+        controller_primary_interface = hostvars[host]['primary_interface']
+        ip = hostvars[host][controller_primary_interface]['ipv4']['address']
+        controller_ips.add(ip)
+    return sorted(list(controller_ips))
+
+
+def legacy_memcache_hosts(hostvars, groups, memcache_port,
+                          controller_name='controller'):
+    controller_ips = legacy_controller_ips(hostvars, groups, controller_name)
+    host_strings = ['%s:%s' % (c, memcache_port) for c in controller_ips]
+    return ','.join(host_strings)
+
+
+def legacy_sensu_dependencies(check_name, hostvars, host_groups, check_groups):
+    deps = set()
+    check_groups = check_groups.split(',')
+    for group in check_groups:
+        if not group in host_groups:
+            continue
+        for host in host_groups[group]:
+            client_name = '{}.{}-{}'.format(host, hostvars[host]['ansible_domain'], hostvars[host]['stack_env'])
+            if 'monitoring' in hostvars[host]:
+                if 'client_name' in hostvars[host]['monitoring']:
+                    client_name = hostvars[host]['monitoring']['client_name']
+            deps.add("{}/{}".format(client_name, check_name))
+    return sorted(list(deps))
+
+
+def address(i):
+    return '10.%d.%d.%d' % (i // 62500, i // 250 % 250, i % 250)
+
+
+def host_facts(i):
+    facts = {
+        'ansible_domain': 'example.com',
+        'ansible_hostname': 'host%04d' % i,
+        'ansible_interfaces': ['lo', 'eth0', 'eth1'],
+        'ansible_eth0': {'ipv4': {'address': address(i)}, 'mtu': 1500},
+        'ansible_eth1': {'ipv4': {'address': address(i + 100000)}, 'mtu': 9000},
+    }
+    for n in range(100):
+        facts['ansible_fact%d' % n] = 'value %d of host %d' % (n, i)
+    return facts
+
+
+def setup(hosts, path):
+    from ansible.inventory import Inventory
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.vars import VariableManager
+    from ansible.vars.hostvars import HostVars
+
+    names = ['host%04d' % i for i in range(hosts)]
+    sections = [('controller', names[0:3]), ('db', names[3:6]),
+                ('db_arbiter', names[6:7]), ('compute', names[7:])]
+    with open(path, 'w') as f:
+        for group, members in sections:
+            f.write('[%s]\n%s\n' % (group, '\n'.join(members)))
+        f.write('[all:vars]\nprimary_interface=ansible_eth0\n'
+                'stack_env=bench\n')
+
+    loader = DataLoader()
+    variable_manager = VariableManager()
+    inventory = Inventory(loader=loader, variable_manager=variable_manager,
+                          host_list=path)
+    variable_manager.set_inventory(inventory)
+    for i, name in enumerate(names):
+        variable_manager.set_host_facts(inventory.get_host(name), host_facts(i))
+    hostvars = HostVars(inventory=inventory,
+                        variable_manager=variable_manager, loader=loader)
+    groups = dict((g.name, [h.name for h in g.get_hosts()])
+                  for g in inventory.groups.values())
+    return inventory, variable_manager, hostvars, groups
+
+
+def run(mode, hosts, renders):
+    if mode == 'legacy':
+        memcache_hosts = legacy_memcache_hosts
+        dependencies = legacy_sensu_dependencies
+    else:
+        memcache_hosts = ursula_filters.ursula_memcache_hosts
+        dependencies = sensu_filters.sensu_dependencies
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inventory, variable_manager, hostvars, groups = setup(
+            hosts, os.path.join(tmpdir, 'hosts'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    times = []
+    for _ in range(renders):
+        start = time.time()
+        memcache = memcache_hosts(hostvars, groups, 11211)
+        deps = [dependencies(name, hostvars, groups, check_groups)
+                for (name, check_groups) in CHECKS]
+        times.append(time.time() - start)
+    assert memcache == '10.0.0.0:11211,10.0.0.1:11211,10.0.0.2:11211'
+    assert len(deps[0]) == hosts - 4
+
+    variable_manager.set_host_facts(
+        inventory.get_host('host0000'),
+        {'ansible_eth0': {'ipv4': {'address': '10.255.0.1'}}})
+    memcache = memcache_hosts(hostvars, groups, 11211)
+    assert memcache.startswith('10.0.0.1:11211,10.0.0.2:11211,10.255.0.1'), memcache
+
+    print "%-7s hosts=%d renders=%d wall=%.3fs min=%.4fs max=%.4fs" % (
+        mode, hosts, renders, sum(times), min(times), max(times))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--renders', type=int, default=5)
+    parser.add_argument('mode', nargs='?', choices=['legacy', 'current'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.hosts, args.renders)
+        return
+    for mode in ('legacy', 'current'):
+        subprocess.check_call([sys.executable, __file__, '--hosts',
+                               str(args.hosts), '--renders',
+                               str(args.renders), mode])
+
+
+if __name__ == '__main__':
+    main()
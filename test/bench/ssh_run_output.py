@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Pushes a large amount of output (50MB by default) through the output
+# handling of plugins/connection/sshbb.py's Connection._run(), with a local
+# command standing in for ssh, and reports wall time, the CPU time spent in
+# this process and peak RSS.
+#
+#   "plain":  nothing to negotiate, output is accumulated straight away.
+#   "become": the output follows a become success line, so it first goes
+#             through the line-by-line prompt/escalation state machine.
+#
+# --plugin runs against another copy of sshbb.py, e.g. to compare with an
+# older revision:
+#
+#   git show HEAD~1:plugins/connection/sshbb.py > /tmp/sshbb_old.py
+#   test/bench/ssh_run_output.py --plugin /tmp/sshbb_old.py
+#
+# Usage: test/bench/ssh_run_output.py [--size MB] [--plugin PATH] [plain|become]
+# With no mode, both are run in separate processes so ru_maxrss is per mode.
+
+import argparse
+import imp
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+PLUGIN = os.path.join(ROOT, 'plugins', 'connection', 'sshbb.py')
+
+SUCCESS_KEY = 'BECOME-SUCCESS-benchmark'
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(mode, size, plugin):
+    from ansible.playbook.play_context import PlayContext
+
+    sshbb = imp.load_source('sshbb_bench', plugin)
+    play_context = PlayContext()
+    play_context.remote_addr = 'localhost'
+    play_context.timeout = 10
+    if mode == 'become':
+        play_context.become = True
+        play_context.success_key = SUCCESS_KEY
+    connection = sshbb.Connection(play_context, None)
+
+    # 100 byte lines, like pretty-printed JSON; the trailing 'ssh' makes
+    # _run() treat the command as ssh, which it needs to negotiate become
+    script = ('echo %s; head -c %d /dev/zero | tr "\\0" x | fold -w 99'
+              % (SUCCESS_KEY, size * 1024 * 1024))
+    cmd = ['sh', '-c', script, 'ssh']
+
+    start_cpu = cpu_time()
+    start = time.time()
+    (returncode, stdout, stderr) = connection._run(cmd, None)
+    elapsed = time.time() - start
+    cpu = cpu_time() - start_cpu
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert returncode == 0, stderr
+    print "%-6s bytes=%d wall=%.3fs cpu=%.3fs peak_rss=%dKB" % (
+        mode, len(stdout), elapsed, cpu, rss)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=50,
+                        help='MB of output (default: 50)')
+    parser.add_argument('--plugin', default=PLUGIN,
+                        help='sshbb.py to load (default: this tree\'s)')
+    parser.add_argument('mode', nargs='?', choices=['plain', 'become'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.size, args.plugin)
+        return
+    for mode in ('plain', 'become'):
+        subprocess.check_call([sys.executable, __file__, '--size',
+                               str(args.size), '--plugin', args.plugin, mode])
+
+
+if __name__ == '__main__':
+    main()